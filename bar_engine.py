@@ -0,0 +1,226 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+from data_preprocessing import raw_trade_file, get_lob_data
+from instrumentation import log, count, timed
+from frame_schema import memory_report
+
+# Activity based sampling of the raw trade files (the ones resampled by data_preprocessing.get_trade_data):
+#   time      -- one bar per threshold interval with trades (threshold: '1min', timedelta...)
+#   tick      -- one bar every threshold trades
+#   volume    -- one bar every threshold units of base volume traded
+#   dollar    -- one bar every threshold units of quote volume traded (amount * rate)
+#   imbalance -- one bar every time the cumulative signed volume (buys - sells) moves threshold away from the multiple
+#                of threshold the previous bar closed at
+# The bar variable is accumulated with cumsum and bar ends are located with searchsorted on the multiples of threshold
+# (imbalance bars loop over the trades crossing a multiple only, see band_ends). Each bar is then joined to the last
+# LOB snapshot known at its close (resampled snapshots are known at the end of their bin, see join_lob):
+#   bars = get_bars('USDT_BTC', '2021-01-01', '2021-12-31', 'dollar', 5e6, lob_levels=1)
+# Thresholds are fixed: the part of a trade overshooting a threshold is not carried to the next bar, and a trade
+# crossing several multiples closes a single bar.
+
+BAR_TYPES = ['time', 'tick', 'volume', 'dollar', 'imbalance']
+
+
+def read_trades(pair, date_start, date_end):
+    '''
+    Function to read the raw trades of a date range into arrays, downloading missing days (see raw_trade_file)
+
+    Arguments:
+    pair -- string, curency pair (e.g.'USDT_BTC')
+    date_start, date_end -- strings, '%Y-%m-%d', end included
+
+    Returns: pandas dataframe sorted by trade time, Datetime, Price, Amount and Side (+1 buy, -1 sell)
+    '''
+
+    start = datetime.strptime(date_start, '%Y-%m-%d')
+    days = [start + timedelta(days=i) for i in range((datetime.strptime(date_end, '%Y-%m-%d') - start).days + 1)]
+
+    day_trades = []
+    for day in days:
+        day_data = pd.read_csv(raw_trade_file(day, pair), usecols=['date', 'type', 'amount', 'rate', 'tradeID'], parse_dates=['date'])
+        day_trades.append(pd.DataFrame({
+            'Datetime': day_data['date'].values,
+            'Price': day_data['rate'].values.astype(np.float64),
+            'Amount': day_data['amount'].values.astype(np.float64), # float64, volumes are accumulated over the whole range
+            'Side': np.where(day_data['type'].values == 'buy', 1, -1).astype(np.int8),
+            'tradeID': day_data['tradeID'].values
+        }))
+
+    trades = pd.concat(day_trades, ignore_index=True).sort_values(by=['Datetime', 'tradeID'], kind='mergesort')
+    trades = trades.drop(columns='tradeID').reset_index(drop=True)
+    count('rows', trades.shape[0], layer='bar_trades')
+    memory_report(trades, 'bar_trades')
+    return trades
+
+
+def threshold_ends(cumulative, threshold):
+    '''
+    Index of the trade closing each bar of a non decreasing cumulative variable: the first trade reaching each
+    multiple of threshold. The last bar, not complete yet, is left out
+
+    Returns: int array
+    '''
+
+    if cumulative.shape[0] == 0 or cumulative[-1] < threshold:
+        return np.empty(0, dtype=np.int64)
+    multiples = np.arange(1, int(cumulative[-1] // threshold) + 1) * threshold
+    return np.unique(np.searchsorted(cumulative, multiples, side='left'))
+
+
+def band_ends(cumulative, threshold):
+    '''
+    Index of the trade closing each bar of a cumulative variable going up and down (e.g. signed volume), with hysteresis:
+    a bar closes when the variable reaches the multiple of threshold above or below the one the previous bar closed at
+    (0 for the first bar), so a variable oscillating around a multiple doesn't close a bar at every crossing.
+    Only the trades moving the variable across a multiple can close a bar, they are checked in order
+
+    Returns: int array
+    '''
+
+    multiples = np.concatenate(([0.0], cumulative)) / threshold
+    lower, upper = np.floor(multiples), np.ceil(multiples)
+    candidates = np.flatnonzero((lower[1:] != lower[:-1]) | (upper[1:] != upper[:-1]))
+
+    ends = []
+    anchor = 0.0 # multiple the previous bar closed at
+    for i in candidates:
+        if lower[i + 1] >= anchor + 1:
+            anchor = lower[i + 1]
+            ends.append(i)
+        elif upper[i + 1] <= anchor - 1:
+            anchor = upper[i + 1]
+            ends.append(i)
+    return np.array(ends, dtype=np.int64)
+
+
+def bar_ends(trades, bar_type, threshold):
+    '''
+    Function to find the trades closing each bar
+
+    Arguments:
+    trades -- pandas dataframe (see read_trades)
+    bar_type -- string, one of BAR_TYPES
+    threshold -- bar size: pandas frequency or timedelta for time bars, number of trades, base volume,
+                 quote volume or signed base volume for the other types
+
+    Returns: int array, sorted trade indices (inclusive bar ends)
+    '''
+
+    if bar_type == 'time':
+        bins = trades['Datetime'].values.astype('datetime64[ns]').astype(np.int64) // pd.Timedelta(threshold).value
+        return np.append(np.flatnonzero(bins[1:] != bins[:-1]), bins.shape[0] - 1) if bins.shape[0] > 0 else np.empty(0, dtype=np.int64)
+    elif bar_type == 'tick':
+        return threshold_ends(np.arange(1, trades.shape[0] + 1, dtype=np.float64), threshold)
+    elif bar_type == 'volume':
+        return threshold_ends(np.cumsum(trades['Amount'].values), threshold)
+    elif bar_type == 'dollar':
+        return threshold_ends(np.cumsum(trades['Amount'].values * trades['Price'].values), threshold)
+    elif bar_type == 'imbalance':
+        return band_ends(np.cumsum(trades['Amount'].values * trades['Side'].values), threshold)
+    else:
+        raise ValueError(f'Bar type {bar_type} not recognized')
+
+
+def aggregate_bars(trades, ends):
+    '''
+    Function to aggregate the trades of each bar with ufunc.reduceat on the bar start indices
+
+    Returns: pandas dataframe, one row per bar indexed by bar number. Datetime is the time of the closing trade
+    '''
+
+    if ends.shape[0] == 0:
+        return pd.DataFrame([], columns=['Datetime', 'Open_Datetime', 'Open', 'High', 'Low', 'Close', 'VWAP', 'Volume',
+                                         'Dollar_Volume', 'Buy_Volume', 'Imbalance', 'Ticks'])
+
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    price = trades['Price'].values[:ends[-1] + 1]
+    amount = trades['Amount'].values[:ends[-1] + 1]
+    side = trades['Side'].values[:ends[-1] + 1]
+    datetimes = trades['Datetime'].values
+
+    volume = np.add.reduceat(amount, starts)
+    dollar_volume = np.add.reduceat(amount * price, starts)
+
+    return pd.DataFrame({
+        'Datetime': datetimes[ends],
+        'Open_Datetime': datetimes[starts],
+        'Open': price[starts],
+        'High': np.maximum.reduceat(price, starts),
+        'Low': np.minimum.reduceat(price, starts),
+        'Close': price[ends],
+        'VWAP': dollar_volume / volume,
+        'Volume': volume,
+        'Dollar_Volume': dollar_volume,
+        'Buy_Volume': np.add.reduceat(np.where(side > 0, amount, 0.0), starts),
+        'Imbalance': np.add.reduceat(amount * side, starts),
+        'Ticks': ends - starts + 1
+    })
+
+
+def join_lob(bars, lob, levels=1, frequency=None):
+    '''
+    Function to join each bar to the last LOB snapshot known at its close, found with searchsorted on the snapshot times.
+    Resampled snapshots (see get_lob_data) are labelled with the start of their bin and hold the last snapshot of the bin:
+    they are known at the end of the bin only, so a bar is joined to the last bin ending at or before its close
+
+    Arguments:
+    bars -- pandas dataframe (see aggregate_bars)
+    lob -- pandas dataframe, one row per snapshot and level (as returned by get_lob_data)
+    levels -- integer, levels joined, as {column}_{level} columns
+    frequency -- timedelta, bin size of the resampled snapshots, None for snapshots at their own time (original frequency)
+
+    Returns: pandas dataframe, bars with the snapshot columns, the time it is known at (LOB_Datetime, end of the bin)
+             and its age in seconds at the bar close (LOB_Age). Bars closing before the first snapshot is known
+             have NaN snapshot columns
+    '''
+
+    lob = lob[lob['Level'] < levels]
+    book = lob.pivot_table(index='Datetime', columns='Level', values=['Ask_Price', 'Ask_Size', 'Bid_Price', 'Bid_Size'], aggfunc='last')
+    book.columns = [f'{column}_{level}' for column, level in book.columns]
+    book = book.sort_index()
+    if frequency is not None:
+        book.index = book.index + pd.Timedelta(frequency)
+
+    snapshot_times = book.index.values
+    position = np.searchsorted(snapshot_times, bars['Datetime'].values, side='right') - 1
+    matched = position >= 0
+
+    snapshots = book.iloc[np.maximum(position, 0)].reset_index()
+    snapshots = snapshots.rename(columns={'Datetime': 'LOB_Datetime'})
+    snapshots.loc[~matched, :] = np.nan
+    snapshots['LOB_Age'] = (bars['Datetime'].values - snapshots['LOB_Datetime'].values) / np.timedelta64(1, 's')
+
+    return pd.concat([bars.reset_index(drop=True), snapshots], axis=1)
+
+
+@timed('get_bars')
+def get_bars(pair, date_start, date_end, bar_type='dollar', threshold=1e6, frequency=timedelta(seconds=10), lob_depth=10,
+             lob_levels=1, workers=1, worker_memory_limit=None):
+    '''
+    Function to build bars from the raw trades of a date range and join them to the LOB snapshots
+
+    Arguments:
+    pair -- string, curency pair (e.g.'USDT_BTC')
+    date_start, date_end -- strings, '%Y-%m-%d', end included
+    bar_type -- string, one of BAR_TYPES
+    threshold -- bar size (see bar_ends)
+    frequency, lob_depth, workers, worker_memory_limit -- LOB snapshots to join to, see get_lob_data
+    lob_levels -- integer, levels of the snapshot joined to each bar, 0 to skip the join
+
+    Returns: pandas dataframe, one row per bar
+    '''
+
+    trades = read_trades(pair, date_start, date_end)
+    ends = bar_ends(trades, bar_type, threshold)
+    bars = aggregate_bars(trades, ends)
+    log(f'{bars.shape[0]} {bar_type} bars from {trades.shape[0]} trades', pair=pair, threshold=threshold)
+    count('bars', bars.shape[0], type=bar_type)
+
+    if lob_levels > 0 and bars.shape[0] > 0:
+        lob = get_lob_data(pair, date_start, date_end, frequency, lob_depth, workers, worker_memory_limit)
+        lob = lob[lob['Level'] < lob_levels].compute() # typed by get_lob_data, see frame_schema
+        bars = join_lob(bars, lob, lob_levels, frequency)
+
+    return bars
@@ -0,0 +1,574 @@
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import data_preprocessing as dp
+import labelling_class as lc
+from configuration import config
+from cache_storage import CODECS, CsvStorage, open_codec
+
+# Benchmarks for the data pipeline, run with:
+#   python benchmark_pipeline.py stages --sizes 1 6 24 --output results.json [--compare baseline.json]
+#   python benchmark_pipeline.py tabularization
+#   python benchmark_pipeline.py codecs [--files day files...] [--level 3]
+# stages generates synthetic raw hourly .json.gz files (optionally with the known corruption patterns), then times
+# each stage from raw files to labels at each size (hours of data), with throughput and peak memory (tracemalloc).
+# Results are saved as JSON, compare_results reports the stages slower than a baseline run.
+# codecs reports the compression ratio and encode/decode MB/s (of uncompressed CSV) of each cache codec on real day files.
+
+def synthetic_snapshot_day(pair='USDT_BTC', day=datetime(2021, 1, 1), depth=100, gaps=0, seed=0, hours=24):
+    '''
+    Function to generate one day of synthetic decoded snapshots in the same format returned by load_lob_json:
+    {"PAIR-%Y%m%d_%H%M%S": {"asks": [["px", size], ...], "bids": [...], "isFrozen": "0", "seq": int}}
+
+    Arguments:
+    pair -- string, currency pair used in the snapshot keys
+    day -- datetime, day to generate (00:00:00)
+    depth -- integer, number of levels per side in each snapshot
+    gaps -- integer, number of random seconds without a snapshot
+    seed -- integer, random generator seed
+    hours -- integer, hours generated from the start of the day
+
+    Returns: dictionary of snapshots
+    '''
+
+    rng = np.random.default_rng(seed)
+    seconds = hours * 60 * 60
+
+    mid = 30000 * np.exp(np.cumsum(rng.normal(0, 0.0002, seconds)))
+    ticks = np.cumsum(rng.integers(1, 5, (seconds, depth)), axis=1) * 0.5
+    ask_px = mid[:, None] + ticks
+    bid_px = mid[:, None] - ticks
+    ask_size = rng.exponential(0.5, (seconds, depth)).round(8)
+    bid_size = rng.exponential(0.5, (seconds, depth)).round(8)
+    seq = 900000000 + np.cumsum(rng.integers(1, 50, seconds))
+
+    missing = set(rng.choice(seconds, gaps, replace=False).tolist()) if gaps > 0 else set()
+
+    raw_data = {}
+    for i in range(seconds):
+        if i in missing:
+            continue
+        key = f'{pair}-{datetime.strftime(day + timedelta(seconds=i), "%Y%m%d_%H%M%S")}'
+        raw_data[key] = {
+            'asks': [[f'{p:.8f}', s] for p, s in zip(ask_px[i], ask_size[i])],
+            'bids': [[f'{p:.8f}', s] for p, s in zip(bid_px[i], bid_size[i])],
+            'isFrozen': '0',
+            'seq': int(seq[i])
+        }
+
+    return raw_data
+
+# corruption patterns repaired by load_lob_json, as found in the raw files
+CORRUPTIONS = ['0254', 'missing_delimiter', 'empty_value', 'extra_brace', 'doubled_seq', 'trailing_data']
+
+def snapshot_json_string(snapshots, corruption_rate=0.0, corruptions=CORRUPTIONS, rng=None):
+    '''
+    Function to serialize snapshots as in a raw file ({"key": {...}, "key": {...}}), injecting corruption
+    patterns in a fraction of the snapshots (never the last one, as in the raw files)
+
+    Arguments:
+    snapshots -- dictionary of snapshots (see synthetic_snapshot_day)
+    corruption_rate -- float, fraction of corrupted snapshots
+    corruptions -- list of patterns to inject, drawn at random for each corrupted snapshot
+    rng -- numpy random generator
+
+    Returns: json string and Counter of injected patterns
+    '''
+
+    rng = np.random.default_rng(0) if rng is None else rng
+    keys = list(snapshots)
+    corrupted = rng.random(len(keys)) < corruption_rate
+    corrupted[-1:] = False
+    injected = Counter()
+
+    pieces = []
+    for i, key in enumerate(keys):
+        value = json.dumps(snapshots[key])
+        separator = ', ' if i + 1 < len(keys) else ''
+
+        if corrupted[i]:
+            corruption = corruptions[rng.integers(len(corruptions))]
+            injected[corruption] += 1
+            if corruption == '0254':
+                value = value + '0254}' # "}0254}"
+            elif corruption == 'missing_delimiter':
+                separator = ' '
+            elif corruption == 'empty_value':
+                value = ''
+            elif corruption == 'extra_brace':
+                value = value + '}'
+            elif corruption == 'doubled_seq':
+                value = value + f', "seq": {snapshots[key]["seq"] - 22}}}'
+            elif corruption == 'trailing_data':
+                value = value + '4001}'
+
+        pieces.append(f'"{key}": {value}{separator}')
+
+    return '{' + ''.join(pieces) + '}', injected
+
+def write_synthetic_raw_day(raw_folder, pair='USDT_BTC', day=datetime(2021, 1, 1), hours=24, depth=100, gaps=0,
+                            corruption_rate=0.0, corruptions=CORRUPTIONS, seed=0):
+    '''
+    Function to write synthetic raw LOB files, one .json.gz file per hour in the raw folder layout read by
+    process_lob_day: {raw_folder}/{pair}/%Y/%m/%d/{pair}-%Y%m%d_%H0000.json.gz
+
+    Arguments: as synthetic_snapshot_day and snapshot_json_string, plus
+    raw_folder -- string, raw LOB data folder
+
+    Returns: list of file paths and Counter of injected corruption patterns
+    '''
+
+    rng = np.random.default_rng(seed)
+    raw_data = synthetic_snapshot_day(pair, day, depth, gaps, seed, hours)
+    day_folder = f'{raw_folder}/{pair}/{datetime.strftime(day, "%Y/%m/%d")}'
+    os.makedirs(day_folder, exist_ok=True)
+
+    file_paths, injected = [], Counter()
+    for hour in range(hours):
+        hour_prefix = f'{pair}-{datetime.strftime(day + timedelta(hours=hour), "%Y%m%d_%H")}'
+        snapshots = {key: value for key, value in raw_data.items() if key.startswith(hour_prefix)}
+        json_string, hour_injected = snapshot_json_string(snapshots, corruption_rate, corruptions, rng)
+        injected.update(hour_injected)
+
+        file_path = f'{day_folder}/{hour_prefix}0000.json.gz'
+        with gzip.open(file_path, 'wb') as f:
+            f.write(json_string.encode('utf-8'))
+        file_paths.append(file_path)
+
+    return file_paths, injected
+
+def legacy_lob_table(raw_data, day, lob_depth=10):
+    '''
+    Reference implementation: snapshot dictionary to table with the itertuples loop
+    previously used in get_lob_data. Kept to benchmark and validate lob_snapshots_to_array
+    '''
+
+    processed_data = []
+
+    raw_data_frame = pd.DataFrame.from_dict(raw_data, orient='index')
+    raw_data_frame.reset_index(inplace=True)
+    raw_data_frame['index'] = raw_data_frame['index'].str[-15:]
+    raw_data_frame['index'] = pd.to_datetime(raw_data_frame['index'], format='%Y%m%d_%H%M%S')
+    raw_data_frame.set_index('index',drop=True,inplace=True)
+    raw_data_frame.sort_index(inplace=True)
+    idx_start = day
+    idx_end = day + timedelta(days=1) - timedelta(seconds=1)
+    idx = pd.date_range(idx_start, idx_end, freq='1s')
+    raw_data_frame = raw_data_frame.reindex(idx).ffill().fillna(method='bfill') # forward fill gaps and back fill first item if missing
+
+    levels = list(range(lob_depth))
+    for row in raw_data_frame.itertuples():
+
+        ask_price, ask_volume = zip(* row.asks[0:lob_depth])
+        bid_price, bid_volume = zip(* row.bids[0:lob_depth])
+        sequences = [row.seq] * lob_depth
+        datetimes = [row.Index] * lob_depth
+
+        processed_data.append(list(zip(
+            ask_price,
+            ask_volume,
+            bid_price,
+            bid_volume,
+            levels,
+            sequences,
+            datetimes
+        )))
+
+    day_data = pd.DataFrame([y for x in processed_data for y in x], #flatten the list of lists structure
+                    columns = ['Ask_Price', 'Ask_Size', 'Bid_Price', 'Bid_Size','Level', 'Sequence','Datetime'])
+
+    day_data['Ask_Price'] = day_data['Ask_Price'].astype('float64')
+    day_data['Bid_Price'] = day_data['Bid_Price'].astype('float64')
+    day_data['Sequence'] = day_data['Sequence'].astype('int64')
+
+    return day_data
+
+def vectorized_lob_table(raw_data, day, lob_depth=10):
+    ''' Snapshot dictionary to table with lob_snapshots_to_array '''
+
+    book, sequences, datetimes = dp.lob_snapshots_to_array(raw_data, day, lob_depth)
+    return dp.lob_array_to_frame(book, sequences, datetimes)
+
+def legacy_load_lob_json(json_string):
+    '''
+    Reference implementation: recursive repair parser previously used as load_lob_json.
+    Re-parses the whole string after each repair. Kept to validate and benchmark load_lob_json
+    '''
+    try:
+        json_dict = json.loads(json_string)
+
+    except json.JSONDecodeError as e:
+
+        if '}0254}' in json_string:
+            fixed_json_string = json_string.replace('}0254}', '}')
+            return legacy_load_lob_json(fixed_json_string)
+
+        if e.msg == "Expecting ',' delimiter":
+            fixed_json_string = json_string[:e.pos] + ', ' + json_string[e.pos:]
+            return legacy_load_lob_json(fixed_json_string)
+
+        if e.msg == 'Expecting value':
+            prev_snapshot_start = json_string.rindex('{', 0, e.pos)
+
+            if prev_snapshot_start == 0:
+                fixed_json_string = json_string[:1] + json_string[e.pos+1:]
+
+            else:
+                prev_snapshot_end = json_string.rindex('}', 0, e.pos) + 1
+                fixed_json_string = json_string[:prev_snapshot_end] + json_string[e.pos:]
+
+        elif e.msg == 'Extra data':
+            if json_string[e.pos-2:e.pos] == '}}':
+                fixed_json_string = json_string.replace('}}', '}') + '}' # at the end should be }}
+
+            else:
+                previous_comma = json_string.rindex(',', 0, e.pos)
+                fixed_json_string = json_string[:previous_comma] + json_string[e.pos:]
+
+        else:
+            next_comma = json_string.index(',', e.pos)
+            fixed_json_string = json_string[:e.pos] + json_string[next_comma:]
+        return legacy_load_lob_json(fixed_json_string)
+
+    for key, value in list(json_dict.items()):
+        if not value['bids'] or not value['asks']:
+            del json_dict[key]
+
+    return json_dict
+
+def compare_json_parsers(corpus_folder):
+    '''
+    Check load_lob_json against the legacy recursive parser on a folder of raw .json.gz files
+    (e.g. known bad files), reporting timings and repairs per file.
+    Files the legacy parser can't decode (recursion errors) are reported and skipped
+
+    Returns: dictionary of per file results
+    '''
+
+    results = {}
+    for file_name in sorted(os.listdir(corpus_folder)):
+        with gzip.open(os.path.join(corpus_folder, file_name), 'r') as f:
+            json_string = f.read().decode('utf-8')
+
+        repairs = Counter()
+        new_time, new_dict = timeit(dp.load_lob_json, json_string, repairs, repeat=1)
+        try:
+            legacy_time, legacy_dict = timeit(legacy_load_lob_json, json_string, repeat=1)
+            match = legacy_dict == new_dict
+        except RecursionError:
+            legacy_time, match = None, None
+
+        results[file_name] = {'match': match, 'legacy_seconds': legacy_time, 'seconds': new_time, 'repairs': dict(repairs)}
+        print(f'{file_name}: match {match}, legacy {legacy_time}s, new {new_time:.3f}s, repairs {dict(repairs)}')
+
+    assert all(result['match'] is not False for result in results.values()), 'load_lob_json output differs from legacy parser'
+
+    return results
+
+def timeit(func, *args, repeat=3, **kwargs):
+    ''' Best wall clock time in seconds over repeat runs and the last output '''
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings), output
+
+def benchmark_lob_tabularization(lob_depth=10, gaps=500, repeat=3):
+    '''
+    Compare the legacy itertuples loop with the vectorized converter on one synthetic day.
+    Outputs are checked for equality before reporting timings
+    '''
+
+    day = datetime(2021, 1, 1)
+    raw_data = synthetic_snapshot_day(day=day, gaps=gaps)
+
+    legacy_time, legacy_df = timeit(legacy_lob_table, raw_data, day, lob_depth, repeat=repeat)
+    vector_time, vector_df = timeit(vectorized_lob_table, raw_data, day, lob_depth, repeat=repeat)
+
+    pd.testing.assert_frame_equal(legacy_df, vector_df, check_dtype=False)
+
+    print(f'LOB tabularization, 1 day, {lob_depth} levels, {gaps} gaps')
+    print(f'legacy loop: {legacy_time:.2f}s - vectorized: {vector_time:.2f}s - speed up: {legacy_time / vector_time:.1f}x')
+
+    return {'legacy_seconds': legacy_time, 'vectorized_seconds': vector_time}
+
+def measure(func, *args, repeat=3, **kwargs):
+    '''
+    Best wall clock time over repeat runs, peak memory allocated during one extra traced run (MB) and the output.
+    tracemalloc slows the traced run down, so it is not timed
+    '''
+
+    seconds, output = timeit(func, *args, repeat=repeat, **kwargs)
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak / 1024 ** 2, output
+
+def read_raw_files(file_paths):
+    ''' Decompressed and decoded raw file contents, as process_lob_day reads them '''
+
+    json_strings = []
+    for file_path in file_paths:
+        with gzip.open(file_path, 'r') as f:
+            json_strings.append(f.read().decode('utf-8'))
+    return json_strings
+
+def load_raw_strings(json_strings):
+    ''' load_lob_json on each file, merged in one dictionary '''
+
+    raw_data, repairs = {}, Counter()
+    for json_string in json_strings:
+        raw_data.update(dp.load_lob_json(json_string, repairs))
+    return raw_data, repairs
+
+def resample_day(day_data, freq):
+    ''' Resampling of the original frequency table, as process_lob_day '''
+
+    return day_data.groupby([pd.Grouper(key='Datetime', freq=freq), pd.Grouper(key='Level')]).last().reset_index()
+
+def standardize_day(resampled, lob_depth, roll):
+    ''' Dynamic z score of prices and sizes, as standardized_data_cache '''
+
+    data = resampled.set_index(['Datetime', 'Level'])
+    dyn_prices = dp.standardize(data[['Ask_Price', 'Bid_Price']], lob_depth, 'dyn_z_score', roll)
+    dyn_volumes = dp.standardize(data[['Ask_Size', 'Bid_Size']], lob_depth, 'dyn_z_score', roll)
+    return pd.concat([dyn_prices, dyn_volumes], axis=1).reset_index()
+
+def benchmark_stages(sizes=(1, 6, 24), lob_depth=10, frequency=timedelta(seconds=10), roll=60, window=100,
+                     corruption_rate=0.001, repeat=3, output=None, seed=0):
+    '''
+    Function to time each pipeline stage on synthetic data of increasing size
+
+    Arguments:
+    sizes -- list of integers, hours of data generated for each run
+    lob_depth -- integer, levels kept from the snapshots
+    frequency -- timedelta, resampling frequency
+    roll -- integer, dynamic z score window in timesteps
+    window -- integer, cnn_data_reshaping past timesteps
+    corruption_rate -- float, fraction of corrupted snapshots in the raw files
+    repeat -- integer, timed runs per stage (best is kept)
+    output -- string, JSON file to save the results to
+    seed -- integer, random generator seed
+
+    Returns: dictionary with run metadata and, for each size, stage results: seconds, peak_mb, rows,
+             rows_per_second (and mb_per_second for stages reading raw data)
+    '''
+
+    day = datetime(2021, 1, 1)
+    freq = f'{int(frequency.total_seconds())}s'
+    results = {'created': datetime.now().isoformat(), 'python': platform.python_version(), 'numpy': np.__version__,
+               'pandas': pd.__version__, 'lob_depth': lob_depth, 'frequency': freq, 'roll': roll, 'window': window,
+               'corruption_rate': corruption_rate, 'sizes': {}}
+
+    for hours in sizes:
+        print(f'##### {hours} hours #####')
+        stages = {}
+
+        def record(stage, seconds, peak_mb, rows, mb=None):
+            stages[stage] = {'seconds': seconds, 'peak_mb': peak_mb, 'rows': int(rows), 'rows_per_second': rows / seconds if seconds > 0 else None}
+            if mb is not None:
+                stages[stage]['mb_per_second'] = mb / seconds if seconds > 0 else None
+            print(f'{stage}: {seconds:.3f}s, {rows / seconds if seconds > 0 else 0:,.0f} rows/s, peak {peak_mb:.1f} MB')
+
+        with tempfile.TemporaryDirectory() as raw_folder:
+            file_paths, injected = write_synthetic_raw_day(raw_folder, day=day, hours=hours, corruption_rate=corruption_rate, seed=seed)
+            compressed_mb = sum(os.path.getsize(file_path) for file_path in file_paths) / 1024 ** 2
+
+            seconds, peak_mb, json_strings = measure(read_raw_files, file_paths, repeat=repeat)
+            record('read_raw_files', seconds, peak_mb, len(file_paths), compressed_mb)
+
+        json_mb = sum(len(json_string) for json_string in json_strings) / 1024 ** 2
+        seconds, peak_mb, (raw_data, repairs) = measure(load_raw_strings, json_strings, repeat=repeat)
+        record('load_lob_json', seconds, peak_mb, len(raw_data), json_mb)
+        stages['load_lob_json'].update({'injected': dict(injected), 'repairs': dict(repairs)})
+        del json_strings
+
+        seconds, peak_mb, day_data = measure(vectorized_lob_table, raw_data, day, lob_depth, repeat=repeat)
+        day_data = day_data[day_data['Datetime'] < day + timedelta(hours=hours)] # the table covers the whole day grid
+        record('lob_tabularization', seconds, peak_mb, day_data.shape[0])
+        del raw_data
+
+        seconds, peak_mb, resampled = measure(resample_day, day_data, freq, repeat=repeat)
+        record('resampling', seconds, peak_mb, day_data.shape[0])
+
+        seconds, peak_mb, dyn_df = measure(standardize_day, resampled, lob_depth, roll, repeat=repeat)
+        record('standardize', seconds, peak_mb, resampled.shape[0])
+
+        seconds, peak_mb, (depth_values, dt_index) = measure(dp.reshape_lob_levels, dyn_df, 'array', repeat=repeat)
+        record('reshape_lob_levels', seconds, peak_mb, dyn_df.shape[0])
+
+        labels = np.zeros((depth_values.shape[0], 3))
+        for output_type in ['array', 'view']:
+            seconds, peak_mb, _ = measure(dp.cnn_data_reshaping, depth_values, labels, window, output_type, repeat=repeat)
+            record(f'cnn_data_reshaping_{output_type}', seconds, peak_mb, depth_values.shape[0])
+
+        mid_px = resampled[resampled['Level'] == 0]
+        mid_px = pd.Series(((mid_px['Ask_Price'] + mid_px['Bid_Price']) / 2).values)
+        seconds, peak_mb, _ = measure(lc.cleaned_labels, mid_px, 'three_steps', False, repeat=repeat)
+        record('cleaned_labels', seconds, peak_mb, mid_px.shape[0])
+
+        seconds, peak_mb, barrier_labels = measure(lc.three_barrier_labelling, mid_px, 60, [1.0005, 0.9995], repeat=repeat)
+        record('three_barrier_labelling', seconds, peak_mb, mid_px.shape[0])
+
+        seconds, peak_mb, _ = measure(lc.get_strategy_pnl, mid_px, barrier_labels['labels'], repeat=repeat)
+        record('get_strategy_pnl', seconds, peak_mb, mid_px.shape[0])
+
+        results['sizes'][str(hours)] = stages
+
+    if output is not None:
+        save_results(results, output)
+
+    return results
+
+def save_results(results, path):
+    ''' Save benchmark results as JSON '''
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f'Saved {path}')
+
+def compare_results(baseline, current, threshold=1.2):
+    '''
+    Function to compare two benchmark runs (dictionaries or JSON file paths) stage by stage
+
+    Arguments:
+    baseline, current -- benchmark results, as returned by benchmark_stages
+    threshold -- float, a stage is a regression if current seconds / baseline seconds is above it
+
+    Returns: list of (size, stage, baseline seconds, current seconds, ratio) regressions
+    '''
+
+    if isinstance(baseline, str):
+        with open(baseline, 'r') as f:
+            baseline = json.load(f)
+    if isinstance(current, str):
+        with open(current, 'r') as f:
+            current = json.load(f)
+
+    regressions = []
+    for size, stages in current['sizes'].items():
+        for stage, result in stages.items():
+            baseline_result = baseline['sizes'].get(size, {}).get(stage)
+            if baseline_result is None or not baseline_result['seconds']:
+                continue
+
+            ratio = result['seconds'] / baseline_result['seconds']
+            print(f'{size}h {stage}: {baseline_result["seconds"]:.3f}s -> {result["seconds"]:.3f}s ({ratio:.2f}x), '
+                  f'peak {baseline_result["peak_mb"]:.1f} -> {result["peak_mb"]:.1f} MB')
+            if ratio > threshold:
+                regressions.append((size, stage, baseline_result['seconds'], result['seconds'], ratio))
+
+    for size, stage, _, _, ratio in regressions:
+        print(f'Regression: {size}h {stage} {ratio:.2f}x slower')
+
+    return regressions
+
+def codec_functions(codec, level=None):
+    ''' In memory compress and decompress functions of a cache codec (see cache_storage.CODECS) '''
+
+    if codec == 'gzip':
+        return (lambda data: gzip.compress(data, compresslevel=level if level is not None else 9)), gzip.decompress
+    elif codec == 'zstd':
+        import zstandard
+        return (zstandard.ZstdCompressor(level=level if level is not None else 3).compress,
+                lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data))
+    elif codec == 'lz4':
+        import lz4.frame
+        return (lambda data: lz4.frame.compress(data, compression_level=level if level is not None else 0)), lz4.frame.decompress
+    else:
+        raise ValueError(f'Codec {codec} not recognized')
+
+def cached_day_files(limit=5):
+    ''' Up to limit cached day files (LOB then trades) of the resampled_data folder of project.conf '''
+
+    files = []
+    for root, _, file_names in os.walk(config()['folders']['resampled_data']):
+        for file_name in sorted(file_names):
+            if any(file_name.endswith(extension) for extension, _ in CODECS.values()) and not file_name.startswith(('TRAIN', 'TEST')):
+                files.append(os.path.join(root, file_name))
+    return files[:limit]
+
+def benchmark_codecs(files=None, codecs=('gzip', 'zstd', 'lz4'), level=None, repeat=3):
+    '''
+    Function to compare the cache codecs on day files: each file is decompressed to CSV bytes, then compressed and
+    decompressed in memory with each codec. Codecs whose package is not installed are skipped
+
+    Arguments:
+    files -- list of cached csv files (any codec), defaults to cached_day_files()
+    codecs -- codecs to compare
+    level -- integer, compression level for all codecs, None for their defaults
+    repeat -- integer, best time over repeat runs
+
+    Returns: dictionary {codec: {'ratio', 'encode_mb_s', 'decode_mb_s'}}, over all files
+    '''
+
+    files = files if files is not None else cached_day_files()
+    assert files, 'No cached day files found, pass files'
+
+    storage = CsvStorage()
+    payloads = []
+    for path in files:
+        with open_codec(path, 'rb', storage.file_codec(path)) as f:
+            payloads.append(f.read())
+    raw_mb = sum(len(payload) for payload in payloads) / 1024 ** 2
+    print(f'{len(files)} files, {raw_mb:.1f} MB of CSV')
+
+    results = {}
+    for codec in codecs:
+        try:
+            compress, decompress = codec_functions(codec, level)
+        except ImportError as e:
+            print(f'{codec}: skipped ({e})')
+            continue
+
+        encode_seconds, compressed = timeit(lambda: [compress(payload) for payload in payloads], repeat=repeat)
+        decode_seconds, decompressed = timeit(lambda: [decompress(payload) for payload in compressed], repeat=repeat)
+        assert decompressed == payloads, f'{codec} round trip mismatch'
+
+        compressed_mb = sum(len(payload) for payload in compressed) / 1024 ** 2
+        results[codec] = {'ratio': raw_mb / compressed_mb, 'encode_mb_s': raw_mb / encode_seconds, 'decode_mb_s': raw_mb / decode_seconds}
+        print(f'{codec}: ratio {results[codec]["ratio"]:.2f} - encode {results[codec]["encode_mb_s"]:.1f} MB/s - '
+              f'decode {results[codec]["decode_mb_s"]:.1f} MB/s')
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data pipeline benchmarks')
+    parser.add_argument('benchmark', nargs='?', default='stages', choices=['stages', 'tabularization', 'codecs'])
+    parser.add_argument('--sizes', nargs='*', type=int, default=[1, 6, 24], help='hours of data for each run')
+    parser.add_argument('--corruption-rate', type=float, default=0.001)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='JSON file to save the results to')
+    parser.add_argument('--compare', default=None, help='baseline JSON file, exits with 1 if a stage regressed')
+    parser.add_argument('--files', nargs='*', default=None, help='cached day files for the codecs benchmark')
+    parser.add_argument('--level', type=int, default=None, help='compression level for the codecs benchmark')
+    args = parser.parse_args()
+
+    if args.benchmark == 'tabularization':
+        benchmark_lob_tabularization()
+    elif args.benchmark == 'codecs':
+        results = benchmark_codecs(args.files, level=args.level, repeat=args.repeat)
+        if args.output is not None:
+            save_results(results, args.output)
+    else:
+        results = benchmark_stages(args.sizes, corruption_rate=args.corruption_rate, repeat=args.repeat, output=args.output)
+        if args.compare is not None and compare_results(args.compare, results):
+            sys.exit(1)
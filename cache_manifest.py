@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+
+from configuration import config
+from instrumentation import log, count
+
+# Manifest of the derived cache files (day level LOB and trade files, standardized train/test files).
+# Each artefact has a small JSON entry next to it, {artefact}.manifest.json, written after the artefact:
+#   key        -- hash of the parameters and of the fingerprints of the inputs the artefact was built from
+#   parameters -- parameters used to build the artefact
+#   inputs     -- {input path: fingerprint}. Cached artefacts are fingerprinted by their checksum, so derived
+#                 files are content addressed; raw files by size and modification time
+#   checksum   -- hash of the artefact content, verified before the artefact is used
+# An artefact is reused only if its entry exists, its key matches the current parameters and inputs and
+# its content matches the checksum: half-written files, files built before the manifest existed or from
+# different raw data are rebuilt.
+#   if not is_valid(storage.path(file_name), parameters, inputs):
+#       ... build and write file_name
+#       record(storage.path(file_name), parameters, inputs)
+# Files built before the manifest existed can be adopted instead of rebuilt, setting adopt_unrecorded = yes in the
+# [cache] section of project.conf: an artefact without entry is then trusted as built from the parameters and inputs
+# it is checked against, and its entry is recorded. Only the files without entry are adopted, stale entries still
+# cause a rebuild. Migrated caches keep their entries, see cache_storage.migrate_csv_cache
+
+def entry_path(path):
+    return f'{path}.manifest.json'
+
+
+def file_checksum(path, chunk_size=1024 ** 2):
+    ''' blake2b hash of a file content, or of all files of a directory (e.g. parquet datasets) '''
+
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, file_name) for root, _, file_names in os.walk(path) for file_name in file_names)
+    else:
+        files = [path]
+
+    file_hash = hashlib.blake2b(digest_size=20)
+    for file_path in files:
+        file_hash.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def read_entry(path):
+    ''' Manifest entry of an artefact, None if missing or unreadable '''
+
+    try:
+        with open(entry_path(path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def input_fingerprint(path):
+    ''' Checksum recorded in the manifest for cached artefacts, size and modification time for other files. None if missing '''
+
+    entry = read_entry(path)
+    if entry is not None:
+        return entry['checksum']
+
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def artefact_key(parameters, fingerprints):
+    ''' Hash of parameters and input fingerprints '''
+
+    content = json.dumps({'parameters': parameters, 'inputs': fingerprints}, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def adopt_unrecorded():
+    ''' True if artefacts without manifest entry are adopted, from the [cache] section of project.conf '''
+
+    configuration = config()
+    return configuration.has_section('cache') and configuration['cache'].get('adopt_unrecorded', 'no') in ('yes', 'true', '1')
+
+
+def is_valid(path, parameters, inputs=()):
+    '''
+    Function to check if a cached artefact can be reused.
+    Inputs missing from disk (e.g. raw files deleted after processing) keep the fingerprint recorded in the entry.
+    An artefact without entry is valid only if adopt_unrecorded is set, its entry is recorded then
+
+    Arguments:
+    path -- string, artefact path (with extension, e.g. storage.path(file_name))
+    parameters -- dictionary of parameters the artefact depends on
+    inputs -- list of input file paths the artefact is built from, None to check the inputs recorded in the entry
+              (e.g. a raw data folder not available locally)
+
+    Returns: boolean
+    '''
+
+    if not os.path.exists(path):
+        return False
+
+    entry = read_entry(path)
+    if entry is None:
+        if adopt_unrecorded():
+            log(f'Adopting {path}, no manifest entry')
+            count('cache_adopted')
+            record(path, parameters, inputs if inputs is not None else ())
+            return True
+        log(f'No manifest entry for {path}')
+        return False
+
+    if inputs is None:
+        inputs = list(entry['inputs'])
+
+    fingerprints = {}
+    for input_path in inputs:
+        fingerprint = input_fingerprint(input_path)
+        fingerprints[input_path] = fingerprint if fingerprint is not None else entry['inputs'].get(input_path)
+
+    if artefact_key(parameters, fingerprints) != entry['key']:
+        log(f'Parameters or inputs changed for {path}')
+        return False
+
+    if file_checksum(path) != entry['checksum']:
+        log(f'Checksum mismatch for {path}')
+        return False
+
+    return True
+
+
+def record(path, parameters, inputs=(), metadata=None, checksum=None):
+    '''
+    Function to save the manifest entry of an artefact, once the artefact has been completely written.
+    The entry is written to a temporary file and moved in place
+
+    Arguments:
+    path -- string, artefact path (with extension)
+    parameters -- dictionary of parameters the artefact depends on
+    inputs -- list of input file paths, or dictionary {path: fingerprint} to reuse the inputs of another entry
+    metadata -- dictionary, saved in the entry and not part of the key (e.g. number of rows)
+    checksum -- string, artefact checksum if already known (e.g. file renamed), computed otherwise
+
+    Returns: dictionary, manifest entry
+    '''
+
+    if isinstance(inputs, dict):
+        fingerprints = dict(inputs)
+    else:
+        fingerprints = {input_path: input_fingerprint(input_path) for input_path in inputs}
+    entry = {
+        'key': artefact_key(parameters, fingerprints),
+        'parameters': parameters,
+        'inputs': fingerprints,
+        'checksum': checksum if checksum is not None else file_checksum(path),
+        'metadata': metadata if metadata is not None else {},
+        'created': datetime.now().isoformat()
+    }
+
+    tmp_path = f'{entry_path(path)}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f, indent=2, default=str)
+    os.replace(tmp_path, entry_path(path))
+
+    return entry
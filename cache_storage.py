@@ -0,0 +1,323 @@
+import io
+import os
+import sys
+import gzip
+
+import pandas as pd
+import dask
+import dask.dataframe as dd
+
+import cache_manifest as manifest
+from configuration import config
+from instrumentation import log
+
+# Storage backends for the cached data layers (original_frequency, resampled quotes and trades,
+# standardized train/test files, Preprocessing bars). Cached files are referred to by their path
+# without extension, each backend appends its own:
+#   storage = get_storage()
+#   storage.write(df, f'{resampled_data_folder}/{pair}/trades/{freq}/2021-01-01')
+#   df = storage.read(f'{resampled_data_folder}/{pair}/trades/{freq}/2021-01-01', columns=['Datetime', 'Ask_Price'])
+
+# CSV codecs: file extension and fsspec name (used by Dask). Files of any codec are readable whatever the configured
+# one, so caches written with gzip stay valid after switching codec (see CsvStorage.path)
+CODECS = {
+    'none': ('.csv', None),
+    'gzip': ('.csv.gz', 'gzip'),
+    'zstd': ('.csv.zst', 'zstd'),
+    'lz4': ('.csv.lz4', 'lz4'),
+}
+
+
+def open_codec(path, mode, codec, level=None):
+    '''
+    Binary file object compressing/decompressing with codec. Appending adds a new compressed stream (gzip member,
+    zstd or lz4 frame), read back as a single file. zstd and lz4 require the zstandard and lz4 packages
+
+    Arguments:
+    path -- string, file path
+    mode -- string, 'rb', 'wb' or 'ab'
+    codec -- string, one of CODECS
+    level -- integer, compression level, None for the codec default
+
+    Returns: file object
+    '''
+
+    if codec == 'none':
+        return open(path, mode)
+    elif codec == 'gzip':
+        return gzip.open(path, mode, compresslevel=level if level is not None else 9)
+    elif codec == 'zstd':
+        import zstandard
+        if mode == 'rb':
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+        return zstandard.ZstdCompressor(level=level if level is not None else 3).stream_writer(open(path, mode), closefd=True)
+    elif codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.open(path, mode, compression_level=level if level is not None else 0)
+    else:
+        raise ValueError(f'Codec {codec} not recognized')
+
+
+class CsvStorage:
+    '''
+    CSV files, gzip compressed by default - the original cache format.
+    compression can be any of CODECS (None for uncompressed files), level is the compression level
+    '''
+
+    name = 'csv'
+
+    def __init__(self, compression='gzip', level=None):
+        self.codec = compression if compression is not None else 'none'
+        self.level = level
+        self.extension = CODECS[self.codec][0]
+
+    def path(self, base_path):
+        '''
+        File of base_path: the one of the configured codec, or if there is none the file written with another codec
+        (e.g. a gzip cache read after switching to zstd). New files are always written with the configured codec
+        '''
+        if not os.path.isfile(f'{base_path}{self.extension}'):
+            for extension, _ in CODECS.values():
+                if os.path.isfile(f'{base_path}{extension}'):
+                    return f'{base_path}{extension}'
+        return f'{base_path}{self.extension}'
+
+    def file_codec(self, path):
+        return csv_codec(path)
+
+    def exists(self, base_path):
+        return os.path.isfile(self.path(base_path))
+
+    def write(self, df, base_path, index=True):
+        with io.TextIOWrapper(open_codec(f'{base_path}{self.extension}', 'wb', self.codec, self.level), encoding='utf-8', newline='') as f:
+            df.to_csv(f, index=index)
+        # the file written with another codec, if any, is replaced
+        for extension, _ in CODECS.values():
+            if extension != self.extension and os.path.isfile(f'{base_path}{extension}'):
+                os.remove(f'{base_path}{extension}')
+
+    def read(self, base_path, columns=None, index_col=None, parse_dates=None, dtype=None):
+        # dtype parses columns directly in to compact arrays (see frame_schema.csv_dtypes), missing columns are ignored
+        path = self.path(base_path)
+        with open_codec(path, 'rb', self.file_codec(path)) as f:
+            return pd.read_csv(f, usecols=columns, index_col=index_col, parse_dates=parse_dates, dtype=dtype)
+
+    def read_dask(self, base_paths, columns=None, dtype=None):
+        paths = [self.path(p) for p in base_paths]
+        codecs = {self.file_codec(path) for path in paths}
+        if len(codecs) == 1:
+            compression = CODECS[codecs.pop()][1]
+            return dd.read_csv(paths, compression=compression, blocksize=None if compression else 'default', usecols=columns, dtype=dtype)
+        # files written with different codecs, one partition per file in order
+        return dd.from_delayed([dask.delayed(self.read)(p, columns=columns, dtype=dtype) for p in base_paths])
+
+    def create_appendable(self, base_path, columns):
+        ''' Create an empty file with headers, rows are added with append() '''
+        self.write(pd.DataFrame([], columns=columns), base_path)
+
+    def append(self, df, base_path, partition):
+        ''' Append rows to an existing file. partition is not used, kept for compatibility with ParquetStorage '''
+        path = self.path(base_path)
+        with io.TextIOWrapper(open_codec(path, 'ab', self.file_codec(path), self.level), encoding='utf-8', newline='') as f:
+            df.to_csv(f, header=False)
+
+
+class ParquetStorage:
+    '''
+    Parquet files with typed columns, row groups and column projection.
+    Day partitioned caches are stored as one file per day, appendable caches (see Preprocessing)
+    are stored as a directory with one file per partition
+    '''
+
+    name = 'parquet'
+    extension = '.parquet'
+
+    def __init__(self, row_group_size=100000, compression='snappy'):
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+    def path(self, base_path):
+        return f'{base_path}{self.extension}'
+
+    def exists(self, base_path):
+        return os.path.exists(self.path(base_path))
+
+    def write(self, df, base_path, index=True):
+        frame_to_columns(df, index).to_parquet(self.path(base_path), engine='pyarrow', index=False,
+                                               compression=self.compression, row_group_size=self.row_group_size)
+
+    def read(self, base_path, columns=None, index_col=None, parse_dates=None, dtype=None):
+        # parse_dates and dtype are accepted for compatibility with CsvStorage, columns are stored typed
+        if os.path.isdir(self.path(base_path)) and not os.listdir(self.path(base_path)):
+            return pd.DataFrame([], columns=columns) # appendable dataset with no partitions yet
+        df = pd.read_parquet(self.path(base_path), engine='pyarrow', columns=columns)
+        if index_col is not None:
+            df = df.set_index(df.columns[index_col] if isinstance(index_col, int) else index_col)
+        return df
+
+    def read_dask(self, base_paths, columns=None, dtype=None):
+        # a single path can be a dataset directory (see append), read as one dataset with a partition per file
+        paths = [self.path(p) for p in base_paths]
+        return dd.read_parquet(paths[0] if len(paths) == 1 else paths, engine='pyarrow', columns=columns)
+
+    def create_appendable(self, base_path, columns):
+        os.makedirs(self.path(base_path), exist_ok=True)
+
+    def append(self, df, base_path, partition):
+        '''
+        Write rows as a new file in the dataset directory. Re-processing a partition overwrites it instead of duplicating rows.
+        A single file written with write() is converted to a dataset first, its rows become partition "0".
+        Partitions are read back in name order
+        '''
+        if os.path.isfile(self.path(base_path)):
+            os.replace(self.path(base_path), f'{self.path(base_path)}.tmp')
+            os.makedirs(self.path(base_path))
+            os.replace(f'{self.path(base_path)}.tmp', f'{self.path(base_path)}/0{self.extension}')
+
+        frame_to_columns(df, True).to_parquet(f'{self.path(base_path)}/{partition}{self.extension}', engine='pyarrow',
+                                              index=False, compression=self.compression, row_group_size=self.row_group_size)
+
+
+def frame_to_columns(df, index=True):
+    '''
+    Move the index in to columns, named as they would be read back from a CSV written with to_csv
+    (unnamed levels become 'Unnamed: n'), so both backends return the same frames
+    '''
+
+    if not index:
+        return df.reset_index(drop=True)
+
+    names = [name if name is not None else f'Unnamed: {i}' for i, name in enumerate(df.index.names)]
+    df = df.copy(deep=False)
+    df.index = df.index.set_names(names)
+    return df.reset_index()
+
+
+def get_storage(name=None):
+    '''
+    Function that returns the cache storage backend.
+    If name is not specified, it is read from the [cache] section of project.conf (format = csv | parquet).
+    codec (gzip | zstd | lz4 | none, csv only) and codec_level set the compression of new csv files, files written
+    with another codec stay readable
+
+    Returns: storage backend object
+    '''
+
+    configuration = config()
+    cache_config = configuration['cache'] if configuration.has_section('cache') else {}
+
+    if name is None:
+        name = cache_config.get('format', 'csv')
+
+    if name == 'csv':
+        level = cache_config.get('codec_level', '')
+        return CsvStorage(compression=cache_config.get('codec', '') or 'gzip', level=int(level) if level else None)
+    elif name == 'parquet':
+        return ParquetStorage(row_group_size=int(cache_config.get('row_group_size', 100000)))
+    else:
+        raise ValueError(f'Cache format {name} not recognized')
+
+
+def csv_codec(file_name):
+    ''' Codec of a csv cache file from its extension (longest match first), None if it isn't a csv cache '''
+
+    for codec, (extension, _) in sorted(CODECS.items(), key=lambda item: -len(item[1][0])):
+        if file_name.endswith(extension):
+            return codec
+    return None
+
+
+def migrate_csv_cache(folder, storage='parquet', remove_csv=False):
+    '''
+    One-off migration of all csv caches found in folder (and subfolders) to another storage backend, whatever their
+    codec: .csv.gz day and standardized files as well as the plain .csv bbo and depth caches of Preprocessing.
+    Files already migrated are skipped. Manifest entries are migrated too (see migrate_manifest_entries), so the
+    migrated files are reused by import_px_data instead of being rebuilt
+
+    Arguments:
+    folder -- string, root folder to migrate (e.g. the resampled_data folder)
+    storage -- string, target backend name
+    remove_csv -- boolean, delete the csv file once migrated
+
+    Returns: list of migrated files
+    '''
+
+    target = get_storage(storage)
+    migrated = []
+    targets = {} # csv path: migrated path
+
+    for root, _, files in os.walk(folder):
+        for file_name in sorted(files):
+            codec = csv_codec(file_name)
+            if codec is None:
+                continue
+
+            csv_path = os.path.join(root, file_name)
+            base_path = csv_path[:-len(CODECS[codec][0])]
+            targets[csv_path] = target.path(base_path)
+            if target.exists(base_path):
+                log(f'Found {target.path(base_path)}')
+                continue
+
+            with open_codec(csv_path, 'rb', codec) as f:
+                df = pd.read_csv(f)
+            if 'Datetime' in df.columns:
+                df['Datetime'] = pd.to_datetime(df['Datetime'])
+            target.write(df, base_path, index=False)
+            log(f'Migrated {csv_path} to {target.path(base_path)}')
+            migrated.append(target.path(base_path))
+
+    migrate_manifest_entries(targets)
+
+    if remove_csv:
+        for csv_path in targets:
+            for path in (csv_path, manifest.entry_path(csv_path)):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    return migrated
+
+
+def migrate_manifest_entries(targets):
+    '''
+    Function to copy the manifest entries of csv caches to their migrated files. Inputs migrated as well
+    (e.g. the day files of a standardized file, the previous day of a trade day) are replaced by the migrated
+    file and its fingerprint, so the keys match the ones import_px_data computes with the new backend.
+    Migrated files that already have an entry are kept, csv files without entry are left without one
+    (see adopt_unrecorded in cache_manifest)
+
+    Arguments:
+    targets -- dictionary {csv path: migrated path}
+    '''
+
+    done = set()
+
+    def migrate_entry(csv_path):
+        if csv_path in done:
+            return
+        done.add(csv_path)
+
+        target_path = targets[csv_path]
+        entry = manifest.read_entry(csv_path)
+        if manifest.read_entry(target_path) is not None:
+            return
+        if entry is None:
+            log(f'No manifest entry for {csv_path}, {target_path} is rebuilt unless adopted')
+            return
+
+        inputs = {}
+        for input_path, fingerprint in entry['inputs'].items():
+            if input_path in targets:
+                migrate_entry(input_path) # entry of the input first, its checksum is the fingerprint
+                inputs[targets[input_path]] = manifest.input_fingerprint(targets[input_path])
+            else:
+                inputs[input_path] = fingerprint
+        manifest.record(target_path, entry['parameters'], inputs, entry.get('metadata'))
+
+    for csv_path in targets:
+        migrate_entry(csv_path)
+
+
+if __name__ == '__main__':
+    # python cache_storage.py <folder> [parquet]
+    migrate_csv_cache(sys.argv[1], *sys.argv[2:3])
@@ -29,9 +29,18 @@ def config():
             'lob_data': 'limit-order-books-polonie-limitorderbooksnapshots-1ggf6vguvne3r',
             'trade_data': 'trades-poloniex'
             }
+        config['cache'] = {
+            'format': 'csv', # csv or parquet, see cache_storage.py
+            'row_group_size': '100000',
+            'float32_features': 'no', # standardized features stored as float32, see frame_schema.py
+            'codec': 'gzip', # csv compression: gzip, zstd, lz4 or none, see cache_storage.py
+            'codec_level': '', # compression level, empty for the codec default
+            'adopt_unrecorded': 'no' # trust cache files built before the manifest existed, see cache_manifest.py
+            }
         config['other'] = {
             'cross_account_access': 'yes',
             'cross_account_access_role': 'arn:aws:iam::589435931329:role/S3CrossAccountAccess',
+            's3_stand_in': '', # local folder replacing S3 (one subfolder per bucket), see s3_download.py
             }
 
         with open('project.conf', 'w') as configfile:    # save
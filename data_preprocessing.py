@@ -4,15 +4,28 @@ from datetime import datetime, timedelta
 import gzip
 import json
 import os
+import re
 import shutil
+import queue
+import logging
+import threading
 import boto3
 from os import listdir
 from os.path import isfile, join
+from itertools import chain
+from collections import Counter
 from concurrent import futures
 
 import dask.dataframe as dd
 
 from configuration import config
+from cache_storage import get_storage
+import cache_manifest as manifest
+from normalizationClass import DynamicZScore
+from tensor_store import TensorStore, tensor_store_exists, write_tensor_store, open_tensor_store
+from s3_download import download_objects, LocalS3Resource
+from instrumentation import log, count, timed, metrics, with_metrics
+from frame_schema import apply_schema, csv_dtypes, memory_report
 
 def intraday_vol_ret(px_ts, span=100):
     '''
@@ -38,7 +51,9 @@ def intraday_vol_ret(px_ts, span=100):
 # 2) if no file is found it would import the CSV for the non std file from Experiments/input
 # 3) the loaded file is passed to standardized_data_cache() which uses standardize() to actual perform standardization
 
-def import_px_data(frequency, pair, date_start, date_end, lob_depth, norm_type, roll):
+@timed('import_px_data')
+def import_px_data(frequency, pair, date_start, date_end, lob_depth, norm_type, roll, workers=1, worker_memory_limit=None, tensor_store=False, extend_from=None, lazy=False,
+                   executor=None, test_start=None, align='inner'):
     '''
     Function that loads preprocessed data ready to be shaped/used for the model to train.
     Experiment folder is the path where data has been cached. The other parameters are part of the
@@ -47,97 +62,448 @@ def import_px_data(frequency, pair, date_start, date_end, lob_depth, norm_type,
 
     Arguments:
     frequency --  timedelta, the minimum time granularity (e.g. timedelta(seconds=10))
-    pair -- string, curency pair to return (e.g.'USDT_BTC')
+    pair -- string, curency pair to return (e.g.'USDT_BTC'). A list of pairs returns an aligned panel (see import_px_panel)
     date_start -- string, timeseries start
     date_end -- string, timeseries end
     lob_depth -- integer, how many levels of the order book to be considered
     norm_type -- string, can assume values of 'z' or 'dyn' for z-score or dynamic z-score
     roll -- integer, function of the granularity provided
+    workers -- integer, number of processes generating missing days in parallel (see get_lob_data)
+    worker_memory_limit -- float, memory cap in GB for each worker process
+    tensor_store -- boolean, also save model-ready train and test arrays to memory-mapped tensor stores (see import_px_tensors)
+    extend_from -- string, date_end of cached files to extend with the days up to date_end instead of processing
+                   the whole range. The train/test split of the cached files is kept and new days are added to the
+                   test set (see extend_px_cache)
+    lazy -- boolean, out of core mode for ranges larger than memory: standardized files are built day by day
+            (see lazy_standardized_data_cache) and returned as Dask dataframes read from the cache. With the csv
+            backend each file is a single partition, use the parquet backend to keep reads bounded
+    executor -- process pool shared with other calls generating days, instead of a pool of workers processes (see map_days)
+    test_start -- pandas Timestamp, first test timestep (e.g. the split shared by the pairs of a panel, see import_px_panel).
+                  None splits the first 70% of the timesteps of the pair for training. Files split on test_start are cached
+                  separately (see px_cache_files)
+    align -- string, panels only: 'inner' or 'outer' datetime grid of the pairs (see import_px_panel)
+
+    Cached files are reused only if their manifest entry matches the parameters and the day level files they
+    were built from (see cache_manifest). Day level files are checked first and only missing or stale days are
+    generated, so a different date range reuses the days it has in common with previous runs
     '''
 
-    configuration = config()
+    if isinstance(pair, (list, tuple)):
+        assert not (lazy or tensor_store), 'Panels are built from in memory frames, use lazy=False and tensor_store=False'
+        return import_px_panel(frequency, pair, date_start, date_end, lob_depth, norm_type, roll, workers, worker_memory_limit,
+                               align=align, extend_from=extend_from)
+
+    assert not (lazy and tensor_store), 'Tensor stores are built from in memory frames, use lazy=False and tensor_store=False'
+    assert not (tensor_store and test_start is not None), 'Tensor stores are built on the default split, use test_start=None'
+
+    storage = get_storage()
 
-    resampled_data_folder = configuration['folders']['resampled_data']
     frequency_seconds = int(frequency.total_seconds())
 
     # Data import - needs to be adjusted importing from several files using Dask
-    quotes_file_name = f'{pair}--{lob_depth}lev--{frequency_seconds}sec--{date_start}--{date_end}.csv.gz'
+    # cache files are named without extension, the storage backend adds its own
+    cache_files = px_cache_files(pair, date_start, date_end, lob_depth, frequency, norm_type, roll, test_start)
+    standardized_train_file, standardized_test_file, top_ob_train_file, top_ob_test_file = cache_files
 
-    standardized_train_file = f'{resampled_data_folder}/{pair}/TRAIN--{norm_type}-{roll}--{quotes_file_name}'
-    standardized_test_file = f'{resampled_data_folder}/{pair}/TEST--{norm_type}-{roll}--{quotes_file_name}'
+    parameters = {'pair': pair, 'lob_depth': lob_depth, 'frequency': frequency_seconds, 'date_start': date_start,
+                  'date_end': date_end, 'norm_type': norm_type, 'roll': roll}
+    if test_start is not None:
+        parameters['test_start'] = str(test_start)
 
-    top_ob_train_file = f'{resampled_data_folder}/{pair}/TRAIN_TOP--{quotes_file_name}'
-    top_ob_test_file = f'{resampled_data_folder}/{pair}/TEST_TOP--{quotes_file_name}'
+    # day level files are checked (and generated if missing or stale) first, standardized files depend on them
+    quotes_data_input = get_lob_data(pair, date_start, date_end, frequency, lob_depth, workers, worker_memory_limit, executor)
+    trades_data_input = get_trade_data(pair, date_start, date_end, frequency, workers, worker_memory_limit, executor)
+    cache_inputs = [storage.path(file_name) for file_name in day_cache_files(pair, date_start, date_end, frequency, lob_depth)]
+
+    if extend_from is not None:
+        parameters = extend_px_cache(frequency, pair, date_start, date_end, extend_from, lob_depth, norm_type, roll,
+                                     parameters, cache_inputs, storage, workers, worker_memory_limit, executor, test_start)
 
     # standardized test file contains both trades and quotes
-    if os.path.isfile(standardized_test_file): # testing for one of cache files, assuming all were saved
-        # Import cached standardized data
-        print(f'Reading cached {standardized_train_file}')
-        train_dyn_df = pd.read_csv(standardized_train_file)#, index_col=1)
-        train_dyn_df.drop('Unnamed: 0', axis=1, inplace=True)
+    if all(manifest.is_valid(storage.path(file_name), parameters, cache_inputs) for file_name in cache_files):
+        if lazy:
+            log(f'Found {storage.path(standardized_test_file)}')
+            count('cache_hits', layer='standardized')
+        else:
+            # Import cached standardized data
+            count('cache_hits', layer='standardized')
+            log(f'Reading cached {storage.path(standardized_train_file)}')
+            train_dyn_df = storage.read(standardized_train_file, parse_dates=['Datetime'], dtype=csv_dtypes(normalized=True))#, index_col=1)
 
-        print(f'Reading cached {standardized_test_file}')
-        test_dyn_df = pd.read_csv(standardized_test_file)#, index_col=1)
-        test_dyn_df.drop('Unnamed: 0', axis=1, inplace=True)
+            log(f'Reading cached {storage.path(standardized_test_file)}')
+            test_dyn_df = storage.read(standardized_test_file, parse_dates=['Datetime'], dtype=csv_dtypes(normalized=True))#, index_col=1)
 
-        print(f'Reading cached {top_ob_train_file}')
-        top_ob_train = pd.read_csv(top_ob_train_file)#, index_col=[0,1])
+            log(f'Reading cached {storage.path(top_ob_train_file)}')
+            top_ob_train = storage.read(top_ob_train_file, parse_dates=['Datetime'], dtype=csv_dtypes())#, index_col=[0,1])
 
-        print(f'Reading cached {top_ob_test_file}')
-        top_ob_test = pd.read_csv(top_ob_test_file)#, index_col=[0,1])
+            log(f'Reading cached {storage.path(top_ob_test_file)}')
+            top_ob_test = storage.read(top_ob_test_file, parse_dates=['Datetime'], dtype=csv_dtypes())#, index_col=[0,1])
 
-    else: # check separately for quotes and trades input files
+    elif lazy:
+        count('cache_misses', layer='standardized')
+        # day by day, each day is read and standardized once carrying the rolling state (see LazyStandardizedSet)
+        stdz_depth = lob_depth + 1
+        days = lazy_input_days(pair, date_start, date_end, frequency, lob_depth, storage)
+        split_start, test_rows, top_test_rows = lazy_standardized_data_cache(days, roll, stdz_depth, standardized_train_file, standardized_test_file,
+                                                                             top_ob_train_file, top_ob_test_file, storage, workers, test_start)
 
-        quotes_data_input = get_lob_data(pair, date_start, date_end, frequency, lob_depth)
-        quotes_data_input['Datetime'] = dd.to_datetime(quotes_data_input['Datetime'])
+        metadata = [{}, {'rows': test_rows, 'test_start': str(split_start)}, {}, {'rows': top_test_rows}]
+        for file_name, file_metadata in zip(cache_files, metadata):
+            manifest.record(storage.path(file_name), parameters, cache_inputs, file_metadata)
 
-        trades_data_input = get_trade_data(pair, date_start, date_end, frequency)
-        trades_data_input['Datetime'] = dd.to_datetime(trades_data_input['Datetime'])
+    else: # check separately for quotes and trades input files
+        count('cache_misses', layer='standardized')
 
         # once input files have been correctly read from the input folder, it's time to create a single standardized cache for trades and quotes
-
-        # TODO - concatenate Dask dataframes
-        quotes_data_input_pd = quotes_data_input.compute()
-        trades_data_input_pd = trades_data_input.compute()
-
-        data = pd.concat([trades_data_input_pd, quotes_data_input_pd]).sort_values(by=['Datetime', 'Level'])
+        data = input_data(quotes_data_input, trades_data_input)
 
         roll = roll #+ 1 # +1 from extra level trades(level -1)
         stdz_depth = lob_depth + 1
-        train_dyn_df, test_dyn_df, top_ob_train, top_ob_test = standardized_data_cache(data, roll, stdz_depth, standardized_train_file, standardized_test_file, top_ob_train_file, top_ob_test_file)
+        train_dyn_df, test_dyn_df, top_ob_train, top_ob_test = standardized_data_cache(data, roll, stdz_depth, standardized_train_file, standardized_test_file, top_ob_train_file, top_ob_test_file, storage,
+                                                                                       test_start)
 
-    # reset indexes, cast datetime type and clean unwanted columns
-    print(f'train_dyn_df {train_dyn_df.head(3)}')
-    print(f'test_dyn_df {test_dyn_df.head(3)}')
-    print(f'top_ob_train {top_ob_train.head(3)}')
-    print(f'top_ob_test {top_ob_test.head(3)}')
-    #train_dyn_df = train_dyn_df.reset_index()
-    train_dyn_df['Datetime'] = pd.to_datetime(train_dyn_df['Datetime'])
-    
+        # test metadata is needed to extend the files with new days (see extend_px_cache)
+        metadata = [{}, {'rows': test_dyn_df.shape[0], 'test_start': str(train_test_timestamps(data, stdz_depth, test_start)[1][0])}, {}, {'rows': top_ob_test.shape[0]}]
+        for file_name, file_metadata in zip(cache_files, metadata):
+            manifest.record(storage.path(file_name), parameters, cache_inputs, file_metadata)
 
-    #test_dyn_df = test_dyn_df.reset_index()
-    test_dyn_df['Datetime'] = pd.to_datetime(test_dyn_df['Datetime'])
-    #test_dyn_df.set_index('index', inplace=True)
-    
-    #top_ob_train = top_ob_train.reset_index()
-    top_ob_train['Datetime'] = pd.to_datetime(top_ob_train['Datetime'])
-    top_ob_train.drop('Unnamed: 0', axis=1, inplace=True)
+    if lazy:
+        return tuple(read_px_cache_lazy(file_name, storage, normalized) for file_name, normalized in zip(cache_files, [True, True, False, False]))
 
-    #top_ob_test = top_ob_test.reset_index()
-    top_ob_test['Datetime'] = pd.to_datetime(top_ob_test['Datetime'])
-    top_ob_test.drop('Unnamed: 0', axis=1, inplace=True)
+    # reset indexes, cast datetime type and clean unwanted columns
+    log(f'train_dyn_df {train_dyn_df.head(3)}', logging.DEBUG)
+    log(f'test_dyn_df {test_dyn_df.head(3)}', logging.DEBUG)
+    log(f'top_ob_train {top_ob_train.head(3)}', logging.DEBUG)
+    log(f'top_ob_test {top_ob_test.head(3)}', logging.DEBUG)
+    # compact dtypes (datetime64 Datetime, no unnamed index columns), see frame_schema
+    train_dyn_df = apply_schema(train_dyn_df, normalized=True)
+    test_dyn_df = apply_schema(test_dyn_df, normalized=True)
+    top_ob_train = apply_schema(top_ob_train)
+    top_ob_test = apply_schema(top_ob_test)
+    for df, name in [(train_dyn_df, 'train_dyn_df'), (test_dyn_df, 'test_dyn_df'), (top_ob_train, 'top_ob_train'), (top_ob_test, 'top_ob_test')]:
+        memory_report(df, name)
+
+    if tensor_store:
+        train_store_folder, test_store_folder = px_tensor_folders(frequency, pair, date_start, date_end, lob_depth, norm_type, roll)
+        parameters = {'pair': pair, 'frequency': frequency_seconds, 'date_start': date_start, 'date_end': date_end,
+                      'lob_depth': lob_depth, 'norm_type': norm_type, 'roll': roll}
+
+        for store_folder, dyn_df, top_ob, source_file in [(train_store_folder, train_dyn_df, top_ob_train, standardized_train_file),
+                                                          (test_store_folder, test_dyn_df, top_ob_test, standardized_test_file)]:
+            source_checksum = manifest.read_entry(storage.path(source_file))['checksum']
+            if not tensor_store_current(store_folder, source_checksum):
+                depth_values, dt_index = reshape_lob_levels(dyn_df, output_type='array')
+                write_tensor_store(store_folder, depth_values, dt_index, top_ob, {**parameters, 'source_checksum': source_checksum},
+                                   levels=sorted(dyn_df['Level'].unique()))
 
     return train_dyn_df, test_dyn_df, top_ob_train, top_ob_test
 
-def standardized_data_cache(data, roll, stdz_depth, standardized_train_file, standardized_test_file, top_ob_train_file, top_ob_test_file):
+@timed('import_px_panel')
+def import_px_panel(frequency, pairs, date_start, date_end, lob_depth, norm_type, roll, workers=1, worker_memory_limit=None, align='inner',
+                    extend_from=None):
+    '''
+    Function to load several pairs at once (see import_px_data) and align them in a panel for cross asset models.
+    Pairs are loaded concurrently, one thread each, and the days they generate all run on one process pool of
+    workers processes, so the number of processes is bounded whatever the number of pairs.
+    All pairs are split on the same timestamp, the first test timestep of their common datetime grid (see panel_test_start),
+    so no train timestep of a pair is later than a test timestep of another. Extended panels (extend_from) keep the split
+    of the extend_from range
+
+    Arguments: as import_px_data, plus
+    pairs -- list of strings, curency pairs (e.g. ['USDT_BTC', 'BTC_AAVE'])
+    align -- string, 'inner' keeps the timesteps all pairs have, 'outer' keeps all timesteps with NaN for missing pairs
+
+    Returns: train and test panels (time, pair, levels * 4) with the features of reshape_lob_levels for each pair,
+             their Datetime index and a dictionary {pair: (top_ob_train, top_ob_test)}
+    '''
+
+    if workers > 1:
+        executor = futures.ProcessPoolExecutor(max_workers=workers, initializer=limit_worker_memory, initargs=(worker_memory_limit,))
+    else:
+        executor = None
+
+    try:
+        with futures.ThreadPoolExecutor(max_workers=len(pairs)) as pair_executor:
+            test_start = panel_test_start(frequency, pairs, date_start, extend_from if extend_from is not None else date_end, lob_depth,
+                                          align, workers, worker_memory_limit, executor, pair_executor)
+            pair_futures = [pair_executor.submit(import_px_data, frequency, pair, date_start, date_end, lob_depth, norm_type, roll,
+                                                 workers, worker_memory_limit, extend_from=extend_from, executor=executor,
+                                                 test_start=test_start) for pair in pairs]
+            pair_data = [future.result() for future in pair_futures]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    train_panel, train_index = px_panel([train_dyn_df for train_dyn_df, _, _, _ in pair_data], align)
+    test_panel, test_index = px_panel([test_dyn_df for _, test_dyn_df, _, _ in pair_data], align)
+    log(f'Panel of {len(pairs)} pairs - train shape: {train_panel.shape} - test shape: {test_panel.shape}')
+
+    top_obs = {pair: (top_ob_train, top_ob_test) for pair, (_, _, top_ob_train, top_ob_test) in zip(pairs, pair_data)}
+    return train_panel, test_panel, train_index, test_index, top_obs
+
+def panel_test_start(frequency, pairs, date_start, date_end, lob_depth, align='inner', workers=1, worker_memory_limit=None, executor=None,
+                     pair_executor=None):
+    '''
+    Function to find the train/test split shared by the pairs of a panel: the first test timestep of their common
+    datetime grid, the first 70% of the grid timesteps being used for training (as train_test_timestamps).
+    Day level files are generated if needed, the grid is built reading only their Datetime column (see timestep_rows)
+
+    Arguments: as import_px_panel, plus
+    pair_executor -- thread pool running the pairs concurrently, None to run them sequentially
+
+    Returns: pandas Timestamp. Raises AssertionError if a pair has no timestep on one side of the split (align='outer')
+    '''
+
+    storage = get_storage()
+
+    def pair_timestamps(pair):
+        get_lob_data(pair, date_start, date_end, frequency, lob_depth, workers, worker_memory_limit, executor)
+        get_trade_data(pair, date_start, date_end, frequency, workers, worker_memory_limit, executor)
+        days = lazy_input_days(pair, date_start, date_end, frequency, lob_depth, storage)
+        return np.unique(np.concatenate([timestep_rows(files, storage).index.values for files in days]))
+
+    grids = list(pair_executor.map(pair_timestamps, pairs)) if pair_executor is not None else [pair_timestamps(pair) for pair in pairs]
+    grid = grids[0]
+    for pair_grid in grids[1:]:
+        grid = np.intersect1d(grid, pair_grid) if align == 'inner' else np.union1d(grid, pair_grid)
+
+    train_test_split = int(grid.shape[0] * 0.7)
+    assert train_test_split < grid.shape[0], 'Not enough common timesteps for a test set'
+    test_start = pd.Timestamp(grid[train_test_split])
+    for pair, pair_grid in zip(pairs, grids):
+        assert pair_grid[0] < test_start <= pair_grid[-1], f'No {pair} train or test timesteps when splitting the panel on {test_start}, use align="inner"'
+    log(f'Panel split on {test_start} - grid timesteps: {grid.shape[0]} - train timesteps: {train_test_split}')
+    return test_start
+
+def px_panel(dyn_dfs, align='inner'):
+    '''
+    Function to stack standardized frames of several pairs on a common datetime grid
+
+    Arguments:
+    dyn_dfs -- list of standardized dataframes, one per pair (same levels)
+    align -- string, 'inner' (timesteps of all pairs) or 'outer' (any pair, NaN where a pair is missing)
+
+    Returns: array (time, pair, levels * 4), Datetime index of the time axis
+    '''
+
+    reshaped = [reshape_lob_levels(dyn_df, output_type='array') for dyn_df in dyn_dfs]
+    grids = [dt_index.values for _, dt_index in reshaped]
+    grid = grids[0]
+    for pair_grid in grids[1:]:
+        grid = np.intersect1d(grid, pair_grid) if align == 'inner' else np.union1d(grid, pair_grid)
+
+    panel = np.full((grid.shape[0], len(reshaped), reshaped[0][0].shape[1]), np.nan, dtype=np.result_type(*[values.dtype for values, _ in reshaped]))
+    for i, (values, pair_grid) in enumerate(zip([values for values, _ in reshaped], grids)):
+        in_grid = np.isin(pair_grid, grid)
+        panel[np.searchsorted(grid, pair_grid[in_grid]), i] = values[in_grid]
+
+    return panel, pd.DatetimeIndex(grid, name='Datetime')
+
+def import_px_tensors(frequency, pair, date_start, date_end, lob_depth, norm_type, roll, **kwargs):
+    '''
+    Function that opens model-ready train and test arrays from memory-mapped tensor stores.
+    Opening is instantaneous and only the slices accessed are read from disk, so it can be used
+    on date ranges larger than RAM. If stores do not exist, they are generated through import_px_data.
+    Same arguments as import_px_data, kwargs are passed to it
+
+    Returns: train and test TensorStore objects, with depth (array as returned by reshape_lob_levels),
+             dt_index and top_ob attributes
+    '''
+
+    train_store_folder, test_store_folder = px_tensor_folders(frequency, pair, date_start, date_end, lob_depth, norm_type, roll)
+
+    # stores are rebuilt if the standardized files they were built from changed
+    storage = get_storage()
+    resampled_data_folder = config()['folders']['resampled_data']
+    quotes_file_name = f'{pair}--{lob_depth}lev--{int(frequency.total_seconds())}sec--{date_start}--{date_end}'
+    current = True
+    for store_folder, split in [(train_store_folder, 'TRAIN'), (test_store_folder, 'TEST')]:
+        source_entry = manifest.read_entry(storage.path(f'{resampled_data_folder}/{pair}/{split}--{norm_type}-{roll}--{quotes_file_name}'))
+        current = current and source_entry is not None and tensor_store_current(store_folder, source_entry['checksum'])
+
+    if not current:
+        import_px_data(frequency, pair, date_start, date_end, lob_depth, norm_type, roll, tensor_store=True, **kwargs)
+
+    log(f'Opening {train_store_folder}')
+    log(f'Opening {test_store_folder}')
+    return open_tensor_store(train_store_folder), open_tensor_store(test_store_folder)
+
+def px_tensor_folders(frequency, pair, date_start, date_end, lob_depth, norm_type, roll):
+    ''' Train and test tensor store folders, named as the import_px_data cache files '''
+
+    resampled_data_folder = config()['folders']['resampled_data']
+    quotes_file_name = f'{pair}--{lob_depth}lev--{int(frequency.total_seconds())}sec--{date_start}--{date_end}'
+
+    return (f'{resampled_data_folder}/{pair}/TENSOR_TRAIN--{norm_type}-{roll}--{quotes_file_name}',
+            f'{resampled_data_folder}/{pair}/TENSOR_TEST--{norm_type}-{roll}--{quotes_file_name}')
+
+def px_cache_files(pair, date_start, date_end, lob_depth, frequency, norm_type, roll, test_start=None):
+    '''
+    Standardized train and test, top of the order book train and test cache files (without storage extension).
+    Files split on a given test_start (see import_px_panel) are named after it, so they don't replace the files split
+    on the pair's own timesteps
+    '''
+
+    resampled_data_folder = config()['folders']['resampled_data']
+    quotes_file_name = f'{pair}--{lob_depth}lev--{int(frequency.total_seconds())}sec--{date_start}--{date_end}'
+    if test_start is not None:
+        quotes_file_name = f'{quotes_file_name}--split-{pd.Timestamp(test_start):%Y%m%d_%H%M%S}'
+
+    return [f'{resampled_data_folder}/{pair}/TRAIN--{norm_type}-{roll}--{quotes_file_name}',
+            f'{resampled_data_folder}/{pair}/TEST--{norm_type}-{roll}--{quotes_file_name}',
+            f'{resampled_data_folder}/{pair}/TRAIN_TOP--{quotes_file_name}',
+            f'{resampled_data_folder}/{pair}/TEST_TOP--{quotes_file_name}']
+
+@timed('extend_px_cache')
+def extend_px_cache(frequency, pair, date_start, date_end, extend_from, lob_depth, norm_type, roll, parameters, cache_inputs, storage,
+                    workers=1, worker_memory_limit=None, executor=None, test_start=None):
+    '''
+    Function to extend cached import_px_data files ending on extend_from with the days up to date_end, without
+    processing the whole range again. Train files are kept as they are, the new days are standardized and appended
+    to the test files: the rolling normalization state is initialized with the last roll + 1 timesteps of the test set,
+    so appended rows are the same as standardizing the extended test set at once. Files are then renamed to date_end.
+    Extended files keep the split of the range they were built on, recorded as split_end in their manifest parameters
+
+    Arguments: as import_px_data, plus
+    parameters -- dictionary, manifest parameters of the date_end files
+    cache_inputs -- list, day level files of the date_start to date_end range
+
+    Returns: dictionary, manifest parameters of the date_end files (with split_end if they are extended files)
+    '''
+
+    cache_files = px_cache_files(pair, date_start, date_end, lob_depth, frequency, norm_type, roll, test_start)
+    source_files = px_cache_files(pair, date_start, extend_from, lob_depth, frequency, norm_type, roll, test_start)
+    assert extend_from < date_end, 'extend_from must be before date_end'
+
+    # already built for the whole range or already extended
+    if all(manifest.is_valid(storage.path(file_name), parameters, cache_inputs) for file_name in cache_files):
+        return parameters
+    target_entry = manifest.read_entry(storage.path(cache_files[1]))
+    if target_entry is not None and 'split_end' in target_entry['parameters']:
+        extended_parameters = {**parameters, 'split_end': target_entry['parameters']['split_end']}
+        if all(manifest.is_valid(storage.path(file_name), extended_parameters, cache_inputs) for file_name in cache_files):
+            return extended_parameters
+
+    source_inputs = [storage.path(file_name) for file_name in day_cache_files(pair, date_start, extend_from, frequency, lob_depth)]
+    source_entries = [manifest.read_entry(storage.path(file_name)) for file_name in source_files]
+    if (any(entry is None for entry in source_entries) or 'test_start' not in source_entries[1]['metadata'] or
+        not all(manifest.is_valid(storage.path(file_name), entry['parameters'], source_inputs) for file_name, entry in zip(source_files, source_entries))):
+        log(f'No valid cached data until {extend_from} to extend, processing the whole range')
+        return parameters
+
+    extended_parameters = {**parameters, 'split_end': source_entries[1]['parameters'].get('split_end', extend_from)}
+    stdz_depth = lob_depth + 1
+    test_start = pd.Timestamp(source_entries[1]['metadata']['test_start'])
+
+    # new days and the last days of the test set, enough to fill the rolling window
+    new_start = datetime.strftime(datetime.strptime(extend_from, '%Y-%m-%d') + timedelta(days=1), '%Y-%m-%d')
+    new_data = input_data(get_lob_data(pair, new_start, date_end, frequency, lob_depth, workers, worker_memory_limit, executor),
+                          get_trade_data(pair, new_start, date_end, frequency, workers, worker_memory_limit, executor)).set_index(['Datetime', 'Level'])
+
+    window_days = int(np.ceil((roll + 1) * frequency.total_seconds() / (24 * 60 * 60)))
+    tail_start = max(test_start.normalize(), pd.Timestamp(extend_from) - timedelta(days=window_days))
+    tail_data = input_data(get_lob_data(pair, datetime.strftime(tail_start, '%Y-%m-%d'), extend_from, frequency, lob_depth, workers, worker_memory_limit, executor),
+                           get_trade_data(pair, datetime.strftime(tail_start, '%Y-%m-%d'), extend_from, frequency, workers, worker_memory_limit, executor))
+    tail_data = tail_data[tail_data['Datetime'] >= test_start]
+    tail_timestamps = tail_data['Datetime'].unique()[-(roll + 1):]
+    tail_data = tail_data[tail_data['Datetime'].isin(tail_timestamps)].set_index(['Datetime', 'Level'])
+
+    if not (regular_levels(pd.concat([tail_data, new_data])[['Ask_Price', 'Bid_Price', 'Ask_Size', 'Bid_Size']], stdz_depth)):
+        log('Missing levels or NaNs, rolling state can not be carried over. Processing the whole range')
+        return parameters
+
+    log(f'Extending {storage.path(source_files[1])} with {new_start} to {date_end}')
+
+    # custom rolling standardization for px and size separately, starting from the state of the test set tail
+    dyn_frames = []
+    for columns in [['Ask_Price', 'Bid_Price'], ['Ask_Size', 'Bid_Size']]:
+        engine = DynamicZScore(roll, stdz_depth, len(columns))
+        engine.update(tail_data[columns].values.reshape(-1, stdz_depth, len(columns)))
+        dyn_frames.append(dyn_z_score_frame(new_data[columns], stdz_depth, engine))
+    test_rows = source_entries[1]['metadata']['rows']
+    new_dyn_df = pd.concat(dyn_frames, axis=1).reset_index()
+    new_dyn_df.index = np.arange(test_rows, test_rows + new_dyn_df.shape[0])
+
+    # top of the order book rows, the first roll rows of the test set are skipped as in standardized_data_cache
+    top_rows = source_entries[3]['metadata']['rows']
+    skip_rows = max(0, roll - len(tail_timestamps)) if len(tail_timestamps) < roll + 1 else 0
+    new_top_ob = new_data[new_data.index.get_level_values(1)==0][skip_rows:]
+    new_top_ob['Mid_Price'] = (new_top_ob['Ask_Price'] + new_top_ob['Bid_Price']) / 2
+    new_top_ob['Spread'] = (new_top_ob['Ask_Price'] - new_top_ob['Bid_Price']) / new_top_ob['Mid_Price']
+    new_top_ob['merge_index'] = np.arange(top_rows, top_rows + new_top_ob.shape[0])
+
+    partition = f'{new_start}--{date_end}'
+    storage.append(apply_schema(new_dyn_df, normalized=True), source_files[1], partition)
+    storage.append(apply_schema(new_top_ob), source_files[3], partition)
+
+    # move files to the date_end names
+    metadata = [{}, {'rows': test_rows + new_dyn_df.shape[0], 'test_start': str(test_start)}, {}, {'rows': top_rows + new_top_ob.shape[0]}]
+    for source_file, file_name, entry, file_metadata in zip(source_files, cache_files, source_entries, metadata):
+        if os.path.isdir(storage.path(file_name)): # stale dataset directory
+            shutil.rmtree(storage.path(file_name))
+        os.replace(storage.path(source_file), storage.path(file_name))
+        os.remove(manifest.entry_path(storage.path(source_file)))
+        checksum = entry['checksum'] if not file_metadata else None # train files are unchanged
+        manifest.record(storage.path(file_name), extended_parameters, cache_inputs, file_metadata, checksum)
+        log(f'Saved {storage.path(file_name)}')
+
+    return extended_parameters
+
+def tensor_store_current(folder, source_checksum):
+    ''' True if the tensor store exists and was built from the standardized file with source_checksum '''
+
+    if not tensor_store_exists(folder):
+        return False
+    with open(f'{folder}/header.json', 'r') as f:
+        return json.load(f)['parameters'].get('source_checksum') == source_checksum
+
+def day_cache_files(pair, date_start, date_end, frequency, lob_depth):
+    ''' Day level cache files (without storage extension) of LOB and trade data used by import_px_data '''
+
+    resampled_data_folder = config()['folders']['resampled_data']
+    freq = f'{int(frequency.total_seconds())}s'
+    date_start = datetime.strptime(date_start, '%Y-%m-%d')
+    days = [datetime.strftime(date_start + timedelta(days=i), '%Y-%m-%d') for i in range((datetime.strptime(date_end, '%Y-%m-%d') - date_start).days + 1)]
+
+    return ([f'{resampled_data_folder}/{pair}/{lob_depth}_levels/{freq}/{day}' for day in days] +
+            [f'{resampled_data_folder}/{pair}/trades/{freq}/{day}' for day in days])
+
+def train_test_timestamps(data, stdz_depth, test_start=None):
+    ''' Train and test timestamps, the first 70% of the timesteps are used for training or the ones before test_start if given '''
+
+    timestamps = data['Datetime'].unique()
+    if test_start is not None:
+        train_test_split = np.searchsorted(timestamps, np.datetime64(pd.Timestamp(test_start)))
+    else:
+        train_test_split = int((data.shape[0] / stdz_depth) * 0.7) # slice reference for train and test
+    return timestamps[:train_test_split], timestamps[train_test_split:]
+
+def input_data(quotes_data_input, trades_data_input):
+    ''' Quotes and trades Dask dataframes to a single pandas dataframe sorted by Datetime and Level '''
+
+    quotes_data_input['Datetime'] = dd.to_datetime(quotes_data_input['Datetime'])
+    trades_data_input['Datetime'] = dd.to_datetime(trades_data_input['Datetime'])
+
+    # whole range in memory, see lazy_input_days for the out of core version
+    quotes_data_input_pd = quotes_data_input.compute()
+    trades_data_input_pd = trades_data_input.compute()
+
+    data = pd.concat([trades_data_input_pd, quotes_data_input_pd]).sort_values(by=['Datetime', 'Level'])
+    memory_report(data, 'input_data')
+    return data
+
+@timed('standardized_data_cache')
+def standardized_data_cache(data, roll, stdz_depth, standardized_train_file, standardized_test_file, top_ob_train_file, top_ob_test_file, storage=None,
+                            test_start=None):
+    if storage is None:
+        storage = get_storage()
+
     # Train test split
-    train_test_split = int((data.shape[0] / stdz_depth) * 0.7) # slice reference for train and test
-    train_timestamps = data['Datetime'].unique()[:train_test_split]
-    test_timestamps = data['Datetime'].unique()[train_test_split:]
+    train_timestamps, test_timestamps = train_test_timestamps(data, stdz_depth, test_start)
     train_cached_data = data[data['Datetime'].isin(train_timestamps)].set_index(['Datetime', 'Level'])
     test_cached_data = data[data['Datetime'].isin(test_timestamps)].set_index(['Datetime', 'Level'])
 
-    print(f'All data shape: {data.shape} - Train dataset shape: {train_cached_data.shape} - Test dataset shape: {test_cached_data.shape}')
+    log(f'All data shape: {data.shape} - Train dataset shape: {train_cached_data.shape} - Test dataset shape: {test_cached_data.shape}')
 
     roll_shift = roll # rolling period for dyn z score - + 1 from shift in standardize()
 
@@ -145,17 +511,18 @@ def standardized_data_cache(data, roll, stdz_depth, standardized_train_file, sta
     # custom rolling standardization for px and size separately
     train_dyn_prices = standardize(train_cached_data[['Ask_Price', 'Bid_Price']], stdz_depth, 'dyn_z_score', roll)
     train_dyn_volumes = standardize(train_cached_data[['Ask_Size', 'Bid_Size']], stdz_depth, 'dyn_z_score', roll)
-    train_dyn_df = pd.concat([train_dyn_prices, train_dyn_volumes], axis=1).reset_index() # concat along row index #1
-    print(f'Saving {standardized_train_file}')
-    train_dyn_df.to_csv(standardized_train_file, compression='gzip') # save standardized data to csv
+    train_dyn_df = apply_schema(pd.concat([train_dyn_prices, train_dyn_volumes], axis=1).reset_index(), normalized=True) # concat along row index #1
+    log(f'Saving {storage.path(standardized_train_file)}')
+    storage.write(train_dyn_df, standardized_train_file) # save standardized data
     #train_dyn_df.reset_index(inplace=True)
 
     top_ob_train = train_cached_data[train_cached_data.index.get_level_values(1)==0][roll_shift:] #3
     top_ob_train['Mid_Price'] = (top_ob_train['Ask_Price'] + top_ob_train['Bid_Price']) / 2
     top_ob_train['Spread'] = (top_ob_train['Ask_Price'] - top_ob_train['Bid_Price']) / top_ob_train['Mid_Price']
     top_ob_train['merge_index'] = top_ob_train.reset_index().index.values # useful for merging later
-    print(f'Saving {top_ob_train_file}')
-    top_ob_train.to_csv(top_ob_train_file, compression='gzip') # save top level not standardized to csv
+    top_ob_train = apply_schema(top_ob_train)
+    log(f'Saving {storage.path(top_ob_train_file)}')
+    storage.write(top_ob_train, top_ob_train_file) # save top level not standardized
     top_ob_train.reset_index(inplace=True)
     # print(f'Saving {standardized_data_folder}/{pair}/TRAIN_top--{norm_type}-{roll}--{input_file_name}')
     # train_dyn_df[train_dyn_df['Level']==0].to_csv(f'{standardized_data_folder}/{pair}/TRAIN_TOP--{norm_type}-{roll}--{input_file_name}', compression='gzip') # save top level to csv 
@@ -164,22 +531,227 @@ def standardized_data_cache(data, roll, stdz_depth, standardized_train_file, sta
     # custom rolling standardization for px and size separately
     test_dyn_prices = standardize(test_cached_data[['Ask_Price', 'Bid_Price']], stdz_depth, 'dyn_z_score', roll)
     test_dyn_volumes = standardize(test_cached_data[['Ask_Size', 'Bid_Size']], stdz_depth, 'dyn_z_score', roll)
-    test_dyn_df = pd.concat([test_dyn_prices, test_dyn_volumes], axis=1).reset_index() # concat along row index #2
-    print(f'Saving {standardized_test_file}')
-    test_dyn_df.to_csv(standardized_test_file, compression='gzip') # save standardized data to csv
+    test_dyn_df = apply_schema(pd.concat([test_dyn_prices, test_dyn_volumes], axis=1).reset_index(), normalized=True) # concat along row index #2
+    log(f'Saving {storage.path(standardized_test_file)}')
+    storage.write(test_dyn_df, standardized_test_file) # save standardized data
     #test_dyn_df.reset_index(inplace=True)
 
     top_ob_test = test_cached_data[test_cached_data.index.get_level_values(1)==0][roll_shift:] #4
     top_ob_test['Mid_Price'] = (top_ob_test['Ask_Price'] + top_ob_test['Bid_Price']) / 2
     top_ob_test['Spread'] = (top_ob_test['Ask_Price'] - top_ob_test['Bid_Price']) / top_ob_test['Mid_Price']
     top_ob_test['merge_index'] = top_ob_test.reset_index().index.values # useful for merging later
-    print(f'Saving {top_ob_test_file}')
-    top_ob_test.to_csv(top_ob_test_file, compression='gzip') # # save top level not standardized to csv
+    top_ob_test = apply_schema(top_ob_test)
+    log(f'Saving {storage.path(top_ob_test_file)}')
+    storage.write(top_ob_test, top_ob_test_file) # # save top level not standardized
     top_ob_test.reset_index(inplace=True)
 
     return train_dyn_df, test_dyn_df, top_ob_train, top_ob_test
 
+def lazy_input_days(pair, date_start, date_end, frequency, lob_depth, storage):
+    '''
+    Out of core version of input_data: the cache files of each day, in date order, read one day at a time
+    with read_input_day. Days missing from the cache (e.g. failed in get_lob_data) are skipped
+
+    Returns: list of lists of file names (trades and quotes files of a day)
+    '''
+
+    day_files = day_cache_files(pair, date_start, date_end, frequency, lob_depth)
+    quotes_files, trades_files = day_files[:len(day_files) // 2], day_files[len(day_files) // 2:]
+
+    days = []
+    for quotes_file, trades_file in zip(quotes_files, trades_files):
+        files = [file_name for file_name in (trades_file, quotes_file) if storage.exists(file_name)]
+        if files:
+            days.append(files)
+
+    return days
+
+def read_input_day(files, storage):
+    ''' Trades and quotes files of one day to a single dataframe sorted by Datetime and Level, as input_data '''
+
+    day_data = pd.concat([apply_schema(storage.read(file_name, parse_dates=['Datetime'], dtype=csv_dtypes())) for file_name in files])
+    return day_data.sort_values(by=['Datetime', 'Level'])
+
+def timestep_rows(files, storage):
+    ''' Number of rows of each timestep of a day, indexed by Datetime. Only the Datetime column is read '''
+
+    datetimes = pd.concat([pd.to_datetime(storage.read(file_name, columns=['Datetime'])['Datetime']) for file_name in files])
+    return datetimes.value_counts().sort_index()
+
+class LazyStandardizedSet:
+    '''
+    Train or test set of lazy_standardized_data_cache, standardized and written day by day with the same result as
+    standardizing the whole set at once (see standardized_data_cache). The rolling state is carried from one day to
+    the next by a DynamicZScore engine for prices and one for sizes, so each day is standardized once.
+    Days with missing levels or NaNs go through the pandas path of standardize() together with the raw rows of the
+    previous timesteps filling their rolling window, the engines are then rebuilt from those rows
+    '''
+
+    COLUMNS = [['Ask_Price', 'Bid_Price'], ['Ask_Size', 'Bid_Size']] # standardized separately
+
+    def __init__(self, roll, stdz_depth, dyn_file, top_ob_file, storage):
+        self.roll = roll
+        self.stdz_depth = stdz_depth
+        self.dyn_file = dyn_file
+        self.top_ob_file = top_ob_file
+        self.storage = storage
+
+        self.engines = [DynamicZScore(roll, stdz_depth, len(columns)) for columns in self.COLUMNS]
+        # values before a timestep in its rolling window. NaNs are dropped when values are stacked (see standardize),
+        # so the window is counted in values and not in rows
+        self.window_values = np.array([(roll + 1) * stdz_depth * len(columns) for columns in self.COLUMNS])
+        self.recent_days = [] # raw rows of the last days of the set, at least window_values
+        self.recent_values = [] # values of each group of columns of recent_days
+        self.dyn_rows, self.top_ob_seen, self.top_ob_rows = 0, 0, 0
+        self.columns = {} # columns of the files written, later days are appended with the same columns
+
+    def window_tail(self):
+        ''' Raw rows of the last whole timesteps filling the rolling window of the next timestep '''
+
+        if not self.recent_days:
+            return None
+        recent = pd.concat(self.recent_days)
+        start = recent.shape[0]
+        for columns, window_values in zip(self.COLUMNS, self.window_values):
+            # values from each row to the end
+            values = recent[columns].notna().values.sum(axis=1)[::-1].cumsum()[::-1]
+            start = min(start, np.flatnonzero(values >= window_values)[-1] if (values >= window_values).any() else 0)
+        first_timestep = recent.index.get_level_values(0)[start]
+        return recent[recent.index.get_level_values(0) >= first_timestep]
+
+    def standardize(self, day_data):
+        ''' Standardized rows of a day of the set, day_data is indexed by Datetime and Level '''
+
+        if self.engines is not None and regular_levels(day_data[self.COLUMNS[0] + self.COLUMNS[1]], self.stdz_depth):
+            dyn_frames = [dyn_z_score_frame(day_data[columns], self.stdz_depth, engine) for columns, engine in zip(self.COLUMNS, self.engines)]
+        else:
+            tail = self.window_tail()
+            window_data = pd.concat([tail, day_data]) if tail is not None else day_data
+            dyn_frames = [standardize(window_data[columns], self.stdz_depth, 'dyn_z_score', self.roll) for columns in self.COLUMNS]
+            dyn_frames = [df[df.index.get_level_values(0) >= day_data.index.get_level_values(0)[0]] for df in dyn_frames]
+            self.engines = None
+
+        self.recent_days.append(day_data)
+        self.recent_values.append(np.array([day_data[columns].notna().values.sum() for columns in self.COLUMNS]))
+        while len(self.recent_days) > 1 and (sum(self.recent_values[1:]) >= self.window_values).all():
+            self.recent_days.pop(0)
+            self.recent_values.pop(0)
+
+        if self.engines is None:
+            # state of the rolling windows rebuilt from the raw rows, once the last timesteps have all levels again
+            tail = self.window_tail()
+            if regular_levels(tail[self.COLUMNS[0] + self.COLUMNS[1]], self.stdz_depth):
+                self.engines = [DynamicZScore(self.roll, self.stdz_depth, len(columns)) for columns in self.COLUMNS]
+                for columns, engine in zip(self.COLUMNS, self.engines):
+                    engine.update(tail[columns].values.reshape(-1, self.stdz_depth, len(columns)))
+
+        return pd.concat(dyn_frames, axis=1)
+
+    def add_day(self, day_data, day_name):
+        '''
+        Standardize a day of the set and append it to the output files. The index of the standardized file,
+        the first roll rows and merge_index of the top of the order book file are carried over from one day to the next
+        '''
+
+        if day_data.shape[0] == 0:
+            return
+
+        dyn_df = apply_schema(self.standardize(day_data).reset_index(), normalized=True)
+        dyn_df.index = np.arange(self.dyn_rows, self.dyn_rows + dyn_df.shape[0])
+        self.dyn_rows += dyn_df.shape[0]
+
+        top_ob = day_data[day_data.index.get_level_values(1)==0]
+        skip_rows = max(0, self.roll - self.top_ob_seen) # first roll rows of the set, as standardized_data_cache
+        self.top_ob_seen += top_ob.shape[0]
+        top_ob = top_ob[skip_rows:].copy()
+        top_ob['Mid_Price'] = (top_ob['Ask_Price'] + top_ob['Bid_Price']) / 2
+        top_ob['Spread'] = (top_ob['Ask_Price'] - top_ob['Bid_Price']) / top_ob['Mid_Price']
+        top_ob['merge_index'] = np.arange(self.top_ob_rows, self.top_ob_rows + top_ob.shape[0])
+        top_ob = apply_schema(top_ob)
+        self.top_ob_rows += top_ob.shape[0]
+
+        for df, file_name in [(dyn_df, self.dyn_file), (top_ob, self.top_ob_file)]:
+            if df.shape[0] == 0:
+                continue
+            if file_name not in self.columns: # first day creates the file
+                self.columns[file_name] = df.columns
+                self.storage.write(df, file_name)
+            else:
+                self.storage.append(df.reindex(columns=self.columns[file_name]), file_name, day_name)
+
+    def close(self):
+        ''' Create the files of a set without rows '''
+
+        for file_name in (self.dyn_file, self.top_ob_file):
+            if file_name not in self.columns:
+                self.storage.write(pd.DataFrame([]), file_name)
+
+@timed('lazy_standardized_data_cache')
+def lazy_standardized_data_cache(days, roll, stdz_depth, standardized_train_file, standardized_test_file, top_ob_train_file, top_ob_test_file,
+                                 storage=None, workers=1, test_start=None):
+    '''
+    Out of core version of standardized_data_cache, for date ranges larger than memory. Same split and output files:
+    1) timesteps are counted day by day, reading only the Datetime column, to find the first test timestamp
+    2) days are read once, in date order, split between the train and test sets and standardized carrying the
+       rolling state of each set from one day to the next (see LazyStandardizedSet)
+    3) days are appended to the output files in date order
+
+    Arguments:
+    days -- list of day files (see lazy_input_days)
+    roll, stdz_depth, files, storage -- as standardized_data_cache
+    workers -- integer, threads reading the next days while a day is standardized. Memory is about workers + 1 days
+               plus the raw rows of the rolling window
+    test_start -- pandas Timestamp, first test timestep, None to split as train_test_timestamps
+
+    Returns: first test timestamp, number of rows of the standardized and top of the order book test files
+    '''
+
+    if storage is None:
+        storage = get_storage()
+    workers = max(workers, 1)
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # Train test split, as train_test_timestamps
+        rows = list(executor.map(lambda files: timestep_rows(files, storage), days))
+        timestamps = np.concatenate([day_rows.index.values for day_rows in rows])
+        if test_start is not None:
+            train_test_split = np.searchsorted(timestamps, np.datetime64(pd.Timestamp(test_start)))
+        else:
+            train_test_split = int((sum(day_rows.sum() for day_rows in rows) / stdz_depth) * 0.7)
+        assert train_test_split < timestamps.shape[0], 'Not enough timesteps for a test set'
+        test_start = pd.Timestamp(timestamps[train_test_split])
+        log(f'All data timesteps: {timestamps.shape[0]} - Train timesteps: {train_test_split} - Test timesteps: {timestamps.shape[0] - train_test_split}')
+
+        train_set = LazyStandardizedSet(roll, stdz_depth, standardized_train_file, top_ob_train_file, storage)
+        test_set = LazyStandardizedSet(roll, stdz_depth, standardized_test_file, top_ob_test_file, storage)
+        for file_name in (standardized_train_file, top_ob_train_file, standardized_test_file, top_ob_test_file):
+            log(f'Saving {storage.path(file_name)}')
+
+        # each day is read once, the next workers days are read in the background
+        reads = {}
+        for i in range(len(days)):
+            for j in range(i, min(i + workers + 1, len(days))):
+                if j not in reads:
+                    reads[j] = executor.submit(read_input_day, days[j], storage)
+            day_data = reads.pop(i).result().set_index(['Datetime', 'Level'])
+            day_name = datetime.strftime(pd.Timestamp(rows[i].index[0]), '%Y-%m-%d')
+
+            in_train = day_data.index.get_level_values(0) < test_start
+            train_set.add_day(day_data[in_train], day_name)
+            test_set.add_day(day_data[~in_train], day_name)
+
+    train_set.close()
+    test_set.close()
+
+    return test_start, test_set.dyn_rows, test_set.top_ob_rows
+
+def read_px_cache_lazy(file_name, storage, normalized=False):
+    ''' Standardized (normalized) or top of the order book cache file as a Dask dataframe, cleaned as in import_px_data '''
+
+    return apply_schema(storage.read_dask([file_name], dtype=csv_dtypes(normalized)), normalized)
+
 # Model training - data preparation
+@timed('standardize')
 def standardize(ts, stdz_depth, norm_type='z_score', roll=0):
     '''
     Function to standardize (mean of zero and unit variance) timeseries
@@ -209,21 +781,48 @@ def standardize(ts, stdz_depth, norm_type='z_score', roll=0):
         ts_shape = ts.shape[1]
 
         if ts_shape > 1:
-            ts_stacked = ts.stack()
 
-            print(f'rolling window = {roll * stdz_depth * ts_shape}, calculate as roll: {roll} * levels: {stdz_depth} * shape[1]: {ts_shape}')
+            log(f'rolling window = {roll * stdz_depth * ts_shape}, calculate as roll: {roll} * levels: {stdz_depth} * shape[1]: {ts_shape}', logging.DEBUG)
+
+            if regular_levels(ts, stdz_depth):
+                # every timestep has stdz_depth levels: numpy kernel on the (timesteps, levels, cols) block
+                norm_df = dyn_z_score_frame(ts, stdz_depth, DynamicZScore(roll, stdz_depth, ts_shape))
 
-            ts_dyn_z = (ts_stacked - ts_stacked.rolling(roll * stdz_depth * ts_shape).mean().shift((stdz_depth * ts_shape) + 1) 
-              ) / ts_stacked.rolling(roll * stdz_depth * ts_shape).std(ddof=0).shift((stdz_depth * ts_shape) + 1)
-            
-            norm_df = ts_dyn_z.reset_index().pivot_table(index=['Datetime', 'Level'], columns='level_2', values=0)#, dropna=True)
-            print('done')
+            else:
+                ts_stacked = ts.stack()
+
+                ts_dyn_z = (ts_stacked - ts_stacked.rolling(roll * stdz_depth * ts_shape).mean().shift((stdz_depth * ts_shape) + 1) 
+                  ) / ts_stacked.rolling(roll * stdz_depth * ts_shape).std(ddof=0).shift((stdz_depth * ts_shape) + 1)
+                
+                norm_df = ts_dyn_z.reset_index().pivot_table(index=['Datetime', 'Level'], columns='level_2', values=0)#, dropna=True)
+            count('rows', ts.shape[0], layer='standardized')
             #Q.put(norm_df)
             return norm_df
     else:
-        print('Normalization not perfmed, please check your code')
+        log('Normalization not perfmed, please check your code', logging.WARNING)
+
+def regular_levels(ts, stdz_depth):
+    ''' True if every timestep of ts has the same stdz_depth levels and there are no NaNs, as required by DynamicZScore '''
+
+    levels = ts.index.get_level_values(1).values
+    return (levels.shape[0] % stdz_depth == 0 and (levels.reshape(-1, stdz_depth) == levels[:stdz_depth]).all()
+            and not ts.isna().values.any())
+
+def dyn_z_score_frame(ts, stdz_depth, engine):
+    '''
+    Dynamic z score of ts computed by a DynamicZScore engine, which can carry the rolling state of previous
+    timesteps (see extend_px_cache). Same layout as standardize(): rows without a complete window are dropped
+    '''
+
+    z = engine.update(ts.values.reshape(-1, stdz_depth, ts.shape[1]))
 
-def get_lob_data(pair, date_start, date_end, frequency = timedelta(seconds=10), lob_depth=10):
+    norm_df = pd.DataFrame(z.reshape(-1, ts.shape[1]), index=ts.index, columns=ts.columns)
+    norm_df = norm_df.dropna(how='all').dropna(axis=1, how='all').sort_index(axis=1) # as pivot_table
+    norm_df.columns.name = 'level_2'
+    return norm_df
+
+@timed('get_lob_data')
+def get_lob_data(pair, date_start, date_end, frequency = timedelta(seconds=10), lob_depth=10, workers=1, worker_memory_limit=None, executor=None):
     '''
     Function to get limit orde book snapshots time series
 
@@ -233,18 +832,21 @@ def get_lob_data(pair, date_start, date_end, frequency = timedelta(seconds=10),
     date_end -- string, timeseries end
     frequency -- timedelta, the minimum time granularity (e.g. timedelta(seconds=10))
     lob_depth -- number of ob levels analyzed
+    workers -- integer, number of processes generating days in parallel. 1 processes days sequentially
+    worker_memory_limit -- float, memory cap in GB for each worker process (parallel mode only)
+    executor -- shared process pool, see map_days
 
     Returns: Dask data frame
     '''
 
-    print(f'Checking for cached LOB data from {date_start} to {date_end}')
+    log(f'Checking for cached LOB data from {date_start} to {date_end}')
 
     #TODO assert if date_end is yesterday or earlier
 
     assert frequency >= timedelta(seconds=1), 'Frequency must be equal to or greater than 1 second'
 
     configuration = config()
-    raw_data_folder = configuration['folders']['raw_lob_data']
+    storage = get_storage()
     resampled_data_folder = configuration['folders']['resampled_data']
 
     date_start = datetime.strptime(date_start, '%Y-%m-%d')
@@ -254,206 +856,406 @@ def get_lob_data(pair, date_start, date_end, frequency = timedelta(seconds=10),
     os.makedirs(f'{resampled_data_folder}/{pair}/{lob_depth}_levels/original_frequency', exist_ok=True)
     os.makedirs(f'{resampled_data_folder}/{pair}/{lob_depth}_levels/{freq}', exist_ok=True)
 
-    data = []
-
     # Loop through day folders
-    date_to_process = date_start
-    while date_to_process <= date_end:
-        day_folder = datetime.strftime(date_to_process, '%Y/%m/%d')
-        day_cache_file_name = f'{datetime.strftime(date_to_process, "%Y-%m-%d")}.csv.gz'
-        resampled_file_path = f'{resampled_data_folder}/{pair}/{lob_depth}_levels/{freq}/{day_cache_file_name}'
-        if os.path.isfile(resampled_file_path):
-            print(f'Found {resampled_file_path}')
-        else:
-            print(f'Generating {resampled_file_path}')
-            original_file_name = f'{resampled_data_folder}/{pair}/{lob_depth}_levels/original_frequency/{day_cache_file_name}'
-            if os.path.isfile(original_file_name):
-                day_data = pd.read_csv(original_file_name, parse_dates=['Datetime'])
-            else:
-                # empty json and nested list every new day processed
-                raw_data = {} # empty dict to update with incoming json
-                processed_data = []
-
-                if not os.path.isdir(f'{raw_data_folder}/{pair}/{day_folder}'):
-                    s3_resource = get_s3_resource()
-                    lob_data_bucket = s3_resource.Bucket(configuration['buckets']['lob_data'])
-                    os.makedirs(f'{raw_data_folder}/tmp/{pair}/{day_folder}', exist_ok=True)
-
-                    keys = []
-                    for obj in lob_data_bucket.objects.filter(Prefix=f'{pair}/{day_folder}'):
-                        keys.append(obj.key)
-
-                    download_s3_folder(lob_data_bucket, day_folder, keys)
-                    shutil.move(f'{raw_data_folder}/tmp/{pair}/{day_folder}', f'{raw_data_folder}/{pair}/{day_folder}')
-
-                # Load all files in to a dictionary
-                for file_name in os.listdir(f'{raw_data_folder}/{pair}/{day_folder}'):
-
-                    try:
-                        with gzip.open(f'{raw_data_folder}/{pair}/{day_folder}/{file_name}', 'r') as f:
-                            json_string = f.read().decode('utf-8')
-                            frozen = json_string.count('"isFrozen": "1"')
-                            if frozen > 0:
-                                print(f'Frozen {frozen} snapshots')
-                        raw_data_temp = load_lob_json(json_string)
-
-                    except Exception as e:
-                        print(e.errno)
-                        print(e)
-
-                    raw_data.update(raw_data_temp)
-
-                # number of seconds in a day / frequencey in seconds
-                snapshot_count_day = int(24 * 60 * 60 / frequency.total_seconds())
-                if len(raw_data) != snapshot_count_day:
-                    diff = snapshot_count_day - len(raw_data)
-                    if diff > 0:
-                        print(f'{diff} gaps in {original_file_name}')
-                    else:
-                        print(f'{diff * -1} additional data points in {original_file_name}')
-
-                #del(raw_data['BTC_XRP-20200404_000000'])
-
-                #TODO fix sequence order
-
-                raw_data_frame = pd.DataFrame.from_dict(raw_data, orient='index')
-                raw_data_frame.reset_index(inplace=True)
-                raw_data_frame['index'] = raw_data_frame['index'].str[-15:]
-                raw_data_frame['index'] = pd.to_datetime(raw_data_frame['index'], format='%Y%m%d_%H%M%S')
-                raw_data_frame.set_index('index',drop=True,inplace=True)
-                raw_data_frame.sort_index(inplace=True)
-                idx_start = date_to_process
-                idx_end = date_to_process + timedelta(days=1) - timedelta(seconds=1)
-                idx = pd.date_range(idx_start, idx_end, freq='1s')
-                raw_data_frame = raw_data_frame.reindex(idx).ffill().fillna(method='bfill') # forward fill gaps and back fill first item if missing
-
-                # Convert hierarchical json data in to tabular format
-                levels = list(range(lob_depth))
-                for row in raw_data_frame.itertuples():
-
-                    ask_price, ask_volume = zip(* row.asks[0:lob_depth])
-                    bid_price, bid_volume = zip(* row.bids[0:lob_depth])
-                    sequences = [row.seq] * lob_depth
-                    datetimes = [row.Index] * lob_depth
-
-                    processed_data.append(list(zip(
-                        ask_price,
-                        ask_volume,
-                        bid_price,
-                        bid_volume,
-                        levels,
-                        sequences,
-                        datetimes
-                    )))
-
-                # unravel nested structure and force data types
-                day_data = pd.DataFrame([y for x in processed_data for y in x], #flatten the list of lists structure
-                                columns = ['Ask_Price', 'Ask_Size', 'Bid_Price', 'Bid_Size','Level', 'Sequence','Datetime'])
-
-                day_data['Ask_Price'] = day_data['Ask_Price'].astype('float64')
-                day_data['Bid_Price'] = day_data['Bid_Price'].astype('float64')
-                day_data['Sequence'] = day_data['Sequence'].astype('int64')
-
-                day_data.to_csv(original_file_name, compression='gzip')
-
-            # resample dataframe to the wanted frequency
-            resampled_day_data = day_data.groupby([pd.Grouper(key='Datetime', freq=freq), pd.Grouper(key='Level')]).last().reset_index()
-            resampled_day_data.to_csv(resampled_file_path, compression='gzip')
-
-        date_to_process += timedelta(days=1) # the most nested folder is a day of the month 
-        data.append(resampled_file_path)
+    days = [date_start + timedelta(days=i) for i in range((date_end - date_start).days + 1)]
+    processed_days = map_days(process_lob_day, days, workers, worker_memory_limit, executor, pair=pair, frequency=frequency, lob_depth=lob_depth)
+    data = [resampled_file_path for _, resampled_file_path in processed_days]
 
     # computed = df.compute()
     # df = df.repartition(npartitions=1)
     # df.to_csv(f'{root_caching_folder}/{pair}/{output_file_name}', compression='gzip', single_file = True)
     # df.to_parquet(f'/tmp/10-seconds.parquet', compression='gzip', engine='pyarrow', write_index=False)
 
-    return dd.read_csv(data, compression='gzip')
+    return apply_schema(storage.read_dask(data, dtype=csv_dtypes()))
 
-def download_S3_object(lob_data_bucket, key, temp_folder):
-    path = f'{temp_folder}/{key}'
-    try:
-        lob_data_bucket.download_file(key, path)
-        print(f'Downloaded {path}')
-    except Exception as e:
-        print(e)
+@timed('process_lob_day')
+def process_lob_day(date_to_process, pair, frequency, lob_depth):
+    '''
+    Function to generate (if not cached yet) the resampled LOB data of one day.
+    Days are independent from each other, so this can run in a worker process (see map_days)
+
+    Arguments:
+    date_to_process -- datetime, day to process
+    pair -- string, curency pair to return (e.g.'USDT_BTC')
+    frequency -- timedelta, the minimum time granularity (e.g. timedelta(seconds=10))
+    lob_depth -- number of ob levels analyzed
+
+    Day files are regenerated if their manifest entry doesn't match the raw files of the day (see cache_manifest)
+
+    Returns: string, resampled file path (without storage extension)
+    '''
 
-def download_s3_folder(lob_data_bucket, day_folder, keys):
     configuration = config()
+    storage = get_storage()
     raw_data_folder = configuration['folders']['raw_lob_data']
+    resampled_data_folder = configuration['folders']['resampled_data']
+    freq = f'{int(frequency.total_seconds())}s'
+
+    day_folder = datetime.strftime(date_to_process, '%Y/%m/%d')
+    day_cache_file_name = datetime.strftime(date_to_process, "%Y-%m-%d")
+    resampled_file_path = f'{resampled_data_folder}/{pair}/{lob_depth}_levels/{freq}/{day_cache_file_name}'
+
+    original_parameters = {'pair': pair, 'lob_depth': lob_depth, 'day': day_cache_file_name}
+    resampled_parameters = {**original_parameters, 'frequency': freq}
+    raw_files = raw_day_files(f'{raw_data_folder}/{pair}/{day_folder}')
 
-    with futures.ThreadPoolExecutor(max_workers=100) as executor:
-        future_to_key = {executor.submit(download_S3_object, lob_data_bucket, key, f'{raw_data_folder}/tmp'): key for key in keys}
-        for future in futures.as_completed(future_to_key):
-            future_to_key[future]
+    if manifest.is_valid(storage.path(resampled_file_path), resampled_parameters, raw_files):
+        log(f'Found {storage.path(resampled_file_path)}')
+        count('cache_hits', layer='lob_day')
+    else:
+        log(f'Generating {storage.path(resampled_file_path)}')
+        count('cache_misses', layer='lob_day')
+        original_file_name = f'{resampled_data_folder}/{pair}/{lob_depth}_levels/original_frequency/{day_cache_file_name}'
+        if manifest.is_valid(storage.path(original_file_name), original_parameters, raw_files):
+            day_data = apply_schema(storage.read(original_file_name, parse_dates=['Datetime'], dtype=csv_dtypes()))
+        else:
+            # empty json every new day processed
+            raw_data = {} # empty dict to update with incoming json
 
-def load_lob_json(json_string):
+            if raw_files is None:
+                s3_resource = get_s3_resource()
+                lob_data_bucket = s3_resource.Bucket(configuration['buckets']['lob_data'])
+                os.makedirs(f'{raw_data_folder}/tmp/{pair}/{day_folder}', exist_ok=True)
+
+                objects = list(lob_data_bucket.objects.filter(Prefix=f'{pair}/{day_folder}'))
+
+                # raises if any file is missing, the day is only moved to the raw folder once complete.
+                # Files already in the tmp folder (interrupted run) are not downloaded again
+                download_s3_folder(lob_data_bucket, day_folder, objects)
+                os.makedirs(os.path.dirname(f'{raw_data_folder}/{pair}/{day_folder}'), exist_ok=True)
+                shutil.move(f'{raw_data_folder}/tmp/{pair}/{day_folder}', f'{raw_data_folder}/{pair}/{day_folder}')
+                raw_files = raw_day_files(f'{raw_data_folder}/{pair}/{day_folder}')
+
+            # Load all files in to a dictionary
+            for file_name in os.listdir(f'{raw_data_folder}/{pair}/{day_folder}'):
+
+                try:
+                    with gzip.open(f'{raw_data_folder}/{pair}/{day_folder}/{file_name}', 'r') as f:
+                        json_string = f.read().decode('utf-8')
+                        count('bytes_read', len(json_string), layer='raw_lob')
+                        frozen = json_string.count('"isFrozen": "1"')
+                        if frozen > 0:
+                            log(f'Frozen {frozen} snapshots', file=file_name)
+                            count('frozen_snapshots', frozen, pair=pair)
+                    repairs = Counter()
+                    raw_data_temp = load_lob_json(json_string, repairs)
+                    if repairs:
+                        log(f'Repaired {file_name}: {dict(repairs)}')
+                        for repair, repair_count in repairs.items():
+                            count('json_repairs', repair_count, type=repair)
+
+                except Exception as e:
+                    log(f'Failed reading {file_name}: {e!r}', logging.ERROR)
+                    count('raw_file_errors', pair=pair)
+
+                raw_data.update(raw_data_temp)
+
+            # number of seconds in a day / frequencey in seconds
+            snapshot_count_day = int(24 * 60 * 60 / frequency.total_seconds())
+            if len(raw_data) != snapshot_count_day:
+                diff = snapshot_count_day - len(raw_data)
+                if diff > 0:
+                    log(f'{diff} gaps in {original_file_name}')
+                    count('lob_gaps', diff, pair=pair)
+                else:
+                    log(f'{diff * -1} additional data points in {original_file_name}')
+                    count('lob_additional_points', diff * -1, pair=pair)
+
+            #del(raw_data['BTC_XRP-20200404_000000'])
+
+            #TODO fix sequence order
+
+            # Convert hierarchical json data in to tabular format
+            book, sequences, datetimes = lob_snapshots_to_array(raw_data, date_to_process, lob_depth)
+            day_data = lob_array_to_frame(book, sequences, datetimes)
+            count('rows', day_data.shape[0], layer='lob_original')
+            memory_report(day_data, 'lob_day')
+
+            storage.write(day_data, original_file_name)
+            manifest.record(storage.path(original_file_name), original_parameters, raw_files)
+
+        # resample dataframe to the wanted frequency
+        resampled_day_data = day_data.groupby([pd.Grouper(key='Datetime', freq=freq), pd.Grouper(key='Level')]).last().reset_index()
+        count('rows', resampled_day_data.shape[0], layer='lob_resampled')
+        storage.write(resampled_day_data, resampled_file_path)
+        if raw_files is None: # raw files not available locally, same inputs as the original frequency file
+            raw_files = manifest.read_entry(storage.path(original_file_name))['inputs']
+        manifest.record(storage.path(resampled_file_path), resampled_parameters, raw_files)
+
+    return resampled_file_path
+
+def raw_day_files(raw_day_folder):
+    ''' Sorted raw files of a day folder, None if the folder is not available locally '''
+
+    if not os.path.isdir(raw_day_folder):
+        return None
+    return sorted(f'{raw_day_folder}/{file_name}' for file_name in os.listdir(raw_day_folder))
+
+def map_days(day_function, days, workers=1, worker_memory_limit=None, executor=None, **kwargs):
+    '''
+    Function to apply day_function(day, **kwargs) to a list of days, sequentially or on a process pool.
+    In parallel mode a failing day is reported and skipped, the other days are still processed
+
+    Arguments:
+    day_function -- module level function taking a datetime as first argument
+    days -- list of datetimes
+    workers -- integer, number of worker processes. 1 runs sequentially in the current process
+    worker_memory_limit -- float, memory cap in GB for each worker process. A worker exceeding it
+                           raises MemoryError for the day being processed
+    executor -- process pool shared with other calls (see import_px_panel), used instead of a pool of workers processes
+    kwargs -- other day_function arguments
+
+    Returns: list of (day, result) tuples in date order
+    '''
+
+    if workers <= 1 and executor is None:
+        return [(day, day_function(day, **kwargs)) for day in days]
+
+    def collect(executor):
+        # metrics recorded in the workers are sent back with the results (see instrumentation.with_metrics)
+        future_to_day = {executor.submit(with_metrics, day_function, day, **kwargs): day for day in days}
+        for future in futures.as_completed(future_to_day):
+            day = future_to_day[future]
+            try:
+                results[day], worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+            except Exception as e:
+                log(f'Failed processing {datetime.strftime(day, "%Y-%m-%d")}: {e!r}', logging.ERROR)
+
+    results = {}
+    if executor is None:
+        with futures.ProcessPoolExecutor(max_workers=workers, initializer=limit_worker_memory, initargs=(worker_memory_limit,)) as executor:
+            collect(executor)
+    else:
+        collect(executor)
+
+    failed_days = len(days) - len(results)
+    if failed_days > 0:
+        log(f'{failed_days} days failed out of {len(days)}, excluded from the output', logging.WARNING)
+        count('failed_days', failed_days)
+
+    return [(day, results[day]) for day in days if day in results]
+
+def limit_worker_memory(worker_memory_limit):
+    ''' Process pool initializer, caps the address space of the worker process (GB) '''
+
+    if worker_memory_limit is not None:
+        import resource # unix only
+        limit = int(worker_memory_limit * 1024 ** 3)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def lob_snapshots_to_array(raw_data, day, lob_depth=10):
+    '''
+    Function to convert one day of decoded snapshots straight into a preallocated array,
+    without building intermediate dataframes or nested lists row by row.
+    Snapshots are aligned to a 1 second grid for the day: gaps are forward filled and
+    missing snapshots at the start of the day are back filled with the first available one
+
+    Arguments:
+    raw_data -- dictionary, decoded snapshots keyed as 'PAIR-%Y%m%d_%H%M%S' (see load_lob_json)
+    day -- datetime, day being processed (00:00:00)
+    lob_depth -- number of ob levels analyzed
+
+    Returns: float array (n_snapshots, lob_depth, 4) with Ask_Price, Ask_Size, Bid_Price, Bid_Size
+             on the last axis (NaN where a snapshot has less than lob_depth levels),
+             int64 array of sequences and datetime64 array of snapshot times
+    '''
+
+    seconds_day = 24 * 60 * 60
+    day_string = datetime.strftime(day, '%Y%m%d')
+
+    # only keep snapshots of the day, position on the grid is the second of the day
+    keys = [key for key in raw_data.keys() if key[-15:-7] == day_string]
+    assert len(keys) > 0, f'No snapshots found for {day_string}'
+    clock = np.array([key[-6:] for key in keys]).astype(np.int64) # HHMMSS
+    seconds = clock // 10000 * 3600 + clock // 100 % 100 * 60 + clock % 100
+
+    # index of the last available snapshot for each second (forward fill), first snapshot for leading gaps (back fill)
+    snapshot_at = np.full(seconds_day, -1, dtype=np.int64)
+    snapshot_at[seconds] = np.arange(len(keys))
+    last_available = np.maximum.accumulate(np.where(snapshot_at >= 0, np.arange(seconds_day), -1))
+    last_available[last_available < 0] = seconds.min()
+    grid_position = snapshot_at[last_available]
+
+    snapshots = [raw_data[key] for key in keys]
+    asks = [snapshot['asks'][:lob_depth] for snapshot in snapshots]
+    bids = [snapshot['bids'][:lob_depth] for snapshot in snapshots]
+    depth = np.minimum(np.fromiter(map(len, asks), dtype=np.int64, count=len(asks)),
+                       np.fromiter(map(len, bids), dtype=np.int64, count=len(bids)))
+
+    snapshot_book = np.full((len(snapshots), lob_depth, 4), np.nan)
+    full = np.flatnonzero(depth == lob_depth)
+    if full.shape[0] > 0:
+        # flatten [[px, size], ...] lists and convert in bulk, prices are strings in the raw json
+        for side, quotes in ((slice(0, 2), asks), (slice(2, 4), bids)):
+            flat_quotes = chain.from_iterable(chain.from_iterable(quotes[i] for i in full))
+            snapshot_book[full, :, side] = np.fromiter(map(float, flat_quotes), dtype=np.float64,
+                                                       count=full.shape[0] * lob_depth * 2).reshape(-1, lob_depth, 2)
+    for i in np.flatnonzero(depth < lob_depth): # rare shallow snapshots
+        if depth[i] > 0:
+            snapshot_book[i, :depth[i], 0:2] = np.array(asks[i][:depth[i]], dtype=np.float64)
+            snapshot_book[i, :depth[i], 2:4] = np.array(bids[i][:depth[i]], dtype=np.float64)
+
+    snapshot_seq = np.fromiter((snapshot['seq'] for snapshot in snapshots), dtype=np.int64, count=len(snapshots))
+    datetimes = np.datetime64(day, 's') + np.arange(seconds_day).astype('timedelta64[s]')
+
+    return snapshot_book[grid_position], snapshot_seq[grid_position], datetimes.astype('datetime64[ns]')
+
+def lob_array_to_frame(book, sequences, datetimes):
+    '''
+    Function to flatten the output of lob_snapshots_to_array into the tabular format cached
+    in the original_frequency folder (one row per snapshot and level)
+
+    Arguments:
+    book -- float array (n_snapshots, lob_depth, 4)
+    sequences -- int array (n_snapshots, )
+    datetimes -- datetime64 array (n_snapshots, )
+
+    Returns: pandas dataframe
+    '''
+
+    n_snapshots, lob_depth, _ = book.shape
+    flat_book = book.reshape(n_snapshots * lob_depth, 4)
+
+    day_data = pd.DataFrame({
+        'Ask_Price': flat_book[:, 0],
+        'Ask_Size': flat_book[:, 1].astype(np.float32),
+        'Bid_Price': flat_book[:, 2],
+        'Bid_Size': flat_book[:, 3].astype(np.float32),
+        'Level': np.tile(np.arange(lob_depth, dtype=np.int8), n_snapshots),
+        'Sequence': np.repeat(np.asarray(sequences, dtype=np.int64), lob_depth),
+        'Datetime': np.repeat(datetimes, lob_depth)
+    })
+
+    # drop levels missing from shallow snapshots
+    valid = ~np.isnan(flat_book).any(axis=1)
+    if not valid.all():
+        day_data = day_data[valid].reset_index(drop=True)
+
+    return day_data
+
+def download_s3_folder(lob_data_bucket, day_folder, objects, concurrency=32):
+    '''
+    Function to download the raw files of a day in to the tmp folder (see s3_download.download_objects)
+
+    Arguments:
+    lob_data_bucket -- boto3 Bucket
+    day_folder -- string, day folder (e.g. '2021/05/10')
+    objects -- list of object summaries of the day, as returned by lob_data_bucket.objects.filter
+    concurrency -- integer, maximum number of downloads in flight
+
+    Returns: DownloadStats, raises DownloadError if some files failed
+    '''
+
+    configuration = config()
+    raw_data_folder = configuration['folders']['raw_lob_data']
+
+    log(f'Downloading {len(objects)} files for {day_folder}')
+    return download_objects(lob_data_bucket, objects, f'{raw_data_folder}/tmp', concurrency)
+
+# snapshot keys, e.g. "USDT_BTC-20200903_095550":
+SNAPSHOT_KEY = re.compile(r'"([^"{}\[\],]+-\d{8}_\d{6})"\s*:')
+
+@timed('load_lob_json')
+def load_lob_json(json_string, repairs=None):
     '''
     Function decode json and fix malformed data issues.
-    Calls itself recursvely on exceptions until all issues are fixed. 
+    Clean files are decoded in one go. Malformed files are split in to snapshots on the snapshot keys
+    in a single forward pass, and each snapshot is decoded and repaired on its own. Known issues:
+    "}0254}", missing "," delimiter, empty snapshot value, extra "}}", doubled "seq" and other trailing
+    data after a snapshot. Snapshots that can't be repaired are dropped.
 
     Arguments:
     json_string -- string, json to decode and fix
+    repairs -- dictionary (e.g. collections.Counter), if passed it is updated with the number of repairs by type
 
     Returns: dictionary from decoded json string
     '''
+
+    if repairs is None:
+        repairs = Counter()
+
     try:
         json_dict = json.loads(json_string)
 
     except json.JSONDecodeError as e:
-        print(f'Malformed JSON in file at position {e.pos}')
+        log(f'Malformed JSON in file at position {e.pos}')
+        count('malformed_json_files')
+
+        json_dict = {}
+        keys = list(SNAPSHOT_KEY.finditer(json_string))
+        for i, key in enumerate(keys):
+            # snapshot value runs until the next key, last one until the end of the top level object
+            value_end = keys[i + 1].start() if i + 1 < len(keys) else json_string.rindex('}')
+            snapshot = load_snapshot_json(json_string[key.end():value_end], repairs, last=(i + 1 == len(keys)))
+            if snapshot is not None:
+                json_dict[key.group(1)] = snapshot
 
-        if '}0254}' in json_string:
-            fixed_json_string = json_string.replace('}0254}', '}')
-            return load_lob_json(fixed_json_string)
+    for key, value in list(json_dict.items()):
+        if not value['bids'] or not value['asks']:
+            del json_dict[key]
 
-        if e.msg == "Expecting ',' delimiter":
-            fixed_json_string = json_string[:e.pos] + ', ' + json_string[e.pos:]
-            return load_lob_json(fixed_json_string)
+    return json_dict
 
-        if e.msg == 'Expecting value':
-            prev_snapshot_start = json_string.rindex('{', 0, e.pos)
+def load_snapshot_json(snapshot_string, repairs, last=False, max_repairs=10):
+    '''
+    Function to decode and repair the value of a single snapshot, as split by load_lob_json
 
-            if prev_snapshot_start == 0:
-                # {"BTC_ETH-20201008_030000": ,"BTC_ETH-20201008_030010": {"asks
-                fixed_json_string = json_string[:1] + json_string[e.pos+1:]
+    Arguments:
+    snapshot_string -- string, snapshot value followed by its separator (e.g. '{"asks": ...}, ')
+    repairs -- dictionary, updated with the number of repairs by type
+    last -- boolean, last snapshot of the file (not followed by a separator)
+    max_repairs -- integer, attempts before the snapshot is dropped
 
-            else:
-                # 5634},"BTC_ETH-20200903_095550": ,"BTC_ETH-20200903_095600": {"as
-                prev_snapshot_end = json_string.rindex('}', 0, e.pos) + 1
-                #prev_snapshot = json_string[prev_snapshot_start:prev_snapshot_end]
-                fixed_json_string = json_string[:prev_snapshot_end] + json_string[e.pos:]
+    Returns: dictionary, None if the snapshot is empty or can't be repaired
+    '''
 
-        elif e.msg == 'Extra data':
-            if json_string[e.pos-2:e.pos] == '}}':
+    snapshot_string = snapshot_string.strip()
+    if snapshot_string.endswith(','):
+        snapshot_string = snapshot_string[:-1].rstrip()
+    elif not last:
+        repairs['missing_delimiter'] += 1 # between this and the next snapshot
 
-                print(json_string[e.pos-12:e.pos+12])
+    # "BTC_ETH-20201008_030000": ,"BTC_ETH-20201008_030010": {"asks
+    if not snapshot_string:
+        repairs['empty_value'] += 1
+        return None
 
-                # 922}},"BTC_
-                #fixed_json_string = json_string[:e.pos-1] + json_string[e.pos:]
-                fixed_json_string = json_string.replace('}}', '}') + '}' # at the end should be }}
-                #print(fixed_json_string[e.pos-13112:e.pos+13112])
+    for _ in range(max_repairs):
+        try:
+            snapshot, end = json.JSONDecoder().raw_decode(snapshot_string)
 
-            else:
-                # en": "0", "seq": 945674867}, "seq": 945674845},"BTC_ETH-20
-                previous_comma = json_string.rindex(',', 0, e.pos)
-                fixed_json_string = json_string[:previous_comma] + json_string[e.pos:]
+        except json.JSONDecodeError as e:
+            if e.msg == "Expecting ',' delimiter":
+                snapshot_string = snapshot_string[:e.pos] + ', ' + snapshot_string[e.pos:]
+                repairs['missing_delimiter'] += 1
+                continue
 
-        else:
-            # "seq": 933840511}": 933840515},"BTC_ET
-            # "seq": 934014002}4001},"BTC_
-            next_comma = json_string.index(',', e.pos)
-            fixed_json_string = json_string[:e.pos] + json_string[next_comma:]
-        return load_lob_json(fixed_json_string)
+            repairs['dropped_snapshot'] += 1
+            return None
 
-    for key, value in list(json_dict.items()):
-        if not value['bids'] or not value['asks']:
-            del json_dict[key]
+        if not isinstance(snapshot, dict) or 'bids' not in snapshot or 'asks' not in snapshot:
+            repairs['dropped_snapshot'] += 1
+            return None
 
-    return json_dict
+        trailing_data = snapshot_string[end:].strip()
+        if trailing_data == '}':
+            repairs['extra_brace'] += 1 # 922}},"BTC_
+        elif trailing_data == '0254}':
+            repairs['0254'] += 1
+        elif trailing_data.startswith(', "seq"') or trailing_data.startswith(',"seq"'):
+            repairs['doubled_seq'] += 1 # "seq": 945674867}, "seq": 945674845},"BTC_ETH-20
+        elif trailing_data:
+            repairs['trailing_data'] += 1 # "seq": 934014002}4001},"BTC_
+
+        return snapshot
+
+    repairs['dropped_snapshot'] += 1
+    return None
 
 
-def get_trade_data(pair, date_start, date_end, frequency = timedelta(seconds=10)):
+@timed('get_trade_data')
+def get_trade_data(pair, date_start, date_end, frequency = timedelta(seconds=10), workers=1, worker_memory_limit=None, executor=None):
     '''
     Function that returns a dataframe of resampled trade data and ready
     to be concatenated to a quotes dataframe with depth (Level = -1)
@@ -463,12 +1265,15 @@ def get_trade_data(pair, date_start, date_end, frequency = timedelta(seconds=10)
     date_start -- string, timeseries start
     date_end -- string, timeseries end
     frequency -- timedelta, the minimum time granularity (e.g. timedelta(seconds=10))
+    workers -- integer, number of processes resampling days in parallel. 1 processes days sequentially
+    worker_memory_limit -- float, memory cap in GB for each worker process (parallel mode only)
+    executor -- shared process pool, see map_days
     '''
 
-    print(f'Checking for cached trade data from {date_start} to {date_end}')
+    log(f'Checking for cached trade data from {date_start} to {date_end}')
 
     configuration = config()
-    raw_data_folder = configuration['folders']['raw_trade_data']
+    storage = get_storage()
     resampled_data_folder = configuration['folders']['resampled_data']
 
     date_start = datetime.strptime(date_start, '%Y-%m-%d')
@@ -478,53 +1283,35 @@ def get_trade_data(pair, date_start, date_end, frequency = timedelta(seconds=10)
 
     data = []
 
-    # Loop through day folders
-    date_to_process = date_start
-    while date_to_process <= date_end:
-        resampled_file_path = f'{resampled_data_folder}/{pair}/trades/{freq}/{datetime.strftime(date_to_process, "%Y-%m-%d")}.csv.gz'
-        if os.path.isfile(resampled_file_path):
-            print(f'Found {resampled_file_path}')
-        else:
-            print(f'Generating {resampled_file_path}')
-            raw_file_name = f'{pair}-{datetime.strftime(date_to_process, "%Y%m%d")}.csv.gz'
-            raw_file_path = f'{raw_data_folder}/{pair}/{raw_file_name}'
-
-            if not os.path.isfile(raw_file_path):
-                s3_resource = get_s3_resource()
-                trade_data_bucket = s3_resource.Bucket(configuration['buckets']['trade_data'])
-                trade_data_bucket.download_file(f'{pair}/{raw_file_name}', f'{raw_file_path}')
-                print(f'Downloaded {raw_file_name} from S3')
-
-            day_data = pd.read_csv(raw_file_path, parse_dates=['date'])
-
-            df_trades_grp = day_data.groupby([pd.Grouper(key='date', freq=freq), 'type']).agg({'amount':'sum', 'rate':'mean'}).reset_index()
-            df_trades_piv = df_trades_grp.pivot(values=['amount', 'rate'], columns='type',index='date').reset_index()
+    # Resample day files (in parallel if workers > 1), then impute first rows and save in date order,
+    # as each day depends on the last prices of the previous one
+    days = [date_start + timedelta(days=i) for i in range((date_end - date_start).days + 1)]
+    resampled_days = map_days(resample_trade_day, days, workers, worker_memory_limit, executor, pair=pair, frequency=frequency)
 
-            df_trades_piv.columns = list(map("_".join, df_trades_piv.columns)) # "flatten" column names
-            df_trades_piv.rename(columns={'date_':'Datetime', 'amount_buy':'Ask_Size', 'amount_sell':'Bid_Size', 'rate_buy':'Ask_Price', 'rate_sell':'Bid_Price'}, inplace=True)
+    prev_day_generated = False
+    for date_to_process, df_trades_piv in resampled_days:
+        resampled_file_path = f'{resampled_data_folder}/{pair}/trades/{freq}/{datetime.strftime(date_to_process, "%Y-%m-%d")}'
 
-            # fill gaps with no trades - MAYBE we need something similar for quotes as a data integrity check
-            start_dt = datetime(date_to_process.year, date_to_process.month, date_to_process.day, 0, 0, 0)
-            end_dt = datetime(date_to_process.year, date_to_process.month, date_to_process.day, 23, 59, 59) # to ensure each timestep is covered
-            date_range_reindex = pd.DataFrame(pd.date_range(start_dt, end_dt, freq=freq), columns=['Datetime'])
-            df_trades_piv = pd.merge(df_trades_piv, date_range_reindex, right_on='Datetime', left_on='Datetime', how='right').sort_values('Datetime')
-
-            # impute NAs - zero for size and last px for price
-            df_trades_piv.loc[:,['Ask_Size', 'Bid_Size']] = df_trades_piv.loc[:,['Ask_Size', 'Bid_Size']].fillna(0)
-            df_trades_piv.loc[:,['Ask_Price', 'Bid_Price']] = df_trades_piv.loc[:,['Ask_Price', 'Bid_Price']].fillna(method='ffill')
+        if df_trades_piv is None and prev_day_generated:
+            # the previous day changed after this day was checked, check it again
+            df_trades_piv = resample_trade_day(date_to_process, pair, frequency)
+        prev_day_generated = df_trades_piv is not None
 
+        if df_trades_piv is not None:
             # impute NAs for the first rows of the dataframes
             try:
                 # check if previous day exists and assign last value of previous day df          
                 prev_day = date_to_process + timedelta(days=-1)
-                prev_day_data = pd.read_csv(f'{resampled_data_folder}/{pair}/trades/{freq}/{datetime.strftime(prev_day, "%Y-%m-%d")}.csv.gz')
+                prev_day_data = storage.read(f'{resampled_data_folder}/{pair}/trades/{freq}/{datetime.strftime(prev_day, "%Y-%m-%d")}',
+                                             columns=['Ask_Price', 'Bid_Price'])
                 prev_file_ask_px = prev_day_data.iloc[-1]['Ask_Price']
                 prev_file_bid_px = prev_day_data.iloc[-1]['Bid_Price']
 
             except Exception as e:
                 # if previous day not in the database, use first avaialble future value - not ideal
-                print(e)
-                print(f'Non-continuous data being processed. imputing avg values for bid or ask prices at the beginning of {date_to_process}')
+                log(f'{e}', logging.WARNING)
+                log(f'Non-continuous data being processed. imputing avg values for bid or ask prices at the beginning of {date_to_process}', logging.WARNING)
+                count('trade_imputations', pair=pair)
                 # NOT ideal cause we are leaking information
                 prev_file_ask_px = df_trades_piv['Ask_Price'].dropna().iloc[0]
                 prev_file_bid_px = df_trades_piv['Bid_Price'].dropna().iloc[0]
@@ -534,12 +1321,105 @@ def get_trade_data(pair, date_start, date_end, frequency = timedelta(seconds=10)
                     
             # level -1 to keep it separate from order book depth
             df_trades_piv['Level'] = -1
-            df_trades_piv.to_csv(resampled_file_path, compression='gzip')
+            df_trades_piv = apply_schema(df_trades_piv)
+            storage.write(df_trades_piv, resampled_file_path)
+            manifest.record(storage.path(resampled_file_path), *trade_day_manifest(date_to_process, pair, frequency, storage))
 
-        date_to_process += timedelta(days=1) # the most nested folder is a day of the month 
         data.append(resampled_file_path)
 
-    return dd.read_csv(data, compression='gzip')
+    return apply_schema(storage.read_dask(data, dtype=csv_dtypes()))
+
+@timed('resample_trade_day')
+def resample_trade_day(date_to_process, pair, frequency):
+    '''
+    Function to resample the raw trades of one day, before prices of the first rows are imputed
+    from the previous day. Can run in a worker process (see map_days)
+
+    Arguments:
+    date_to_process -- datetime, day to process
+    pair -- string, curency pair to return (e.g.'USDT_BTC')
+    frequency -- timedelta, the minimum time granularity (e.g. timedelta(seconds=10))
+
+    Returns: pandas dataframe, None if the day is already cached (and matches its manifest entry, see trade_day_manifest)
+    '''
+
+    configuration = config()
+    storage = get_storage()
+    resampled_data_folder = configuration['folders']['resampled_data']
+    freq = f'{int(frequency.total_seconds())}s'
+
+    resampled_file_path = f'{resampled_data_folder}/{pair}/trades/{freq}/{datetime.strftime(date_to_process, "%Y-%m-%d")}'
+    if manifest.is_valid(storage.path(resampled_file_path), *trade_day_manifest(date_to_process, pair, frequency, storage)):
+        log(f'Found {storage.path(resampled_file_path)}')
+        count('cache_hits', layer='trade_day')
+        return None
+
+    log(f'Generating {storage.path(resampled_file_path)}')
+    count('cache_misses', layer='trade_day')
+    raw_file_path = raw_trade_file(date_to_process, pair)
+
+    day_data = pd.read_csv(raw_file_path, parse_dates=['date'])
+    count('rows', day_data.shape[0], layer='raw_trades')
+
+    df_trades_grp = day_data.groupby([pd.Grouper(key='date', freq=freq), 'type']).agg({'amount':'sum', 'rate':'mean'}).reset_index()
+    df_trades_piv = df_trades_grp.pivot(values=['amount', 'rate'], columns='type',index='date').reset_index()
+
+    df_trades_piv.columns = list(map("_".join, df_trades_piv.columns)) # "flatten" column names
+    df_trades_piv.rename(columns={'date_':'Datetime', 'amount_buy':'Ask_Size', 'amount_sell':'Bid_Size', 'rate_buy':'Ask_Price', 'rate_sell':'Bid_Price'}, inplace=True)
+
+    # fill gaps with no trades - MAYBE we need something similar for quotes as a data integrity check
+    start_dt = datetime(date_to_process.year, date_to_process.month, date_to_process.day, 0, 0, 0)
+    end_dt = datetime(date_to_process.year, date_to_process.month, date_to_process.day, 23, 59, 59) # to ensure each timestep is covered
+    date_range_reindex = pd.DataFrame(pd.date_range(start_dt, end_dt, freq=freq), columns=['Datetime'])
+    df_trades_piv = pd.merge(df_trades_piv, date_range_reindex, right_on='Datetime', left_on='Datetime', how='right').sort_values('Datetime')
+
+    # impute NAs - zero for size and last px for price
+    df_trades_piv.loc[:,['Ask_Size', 'Bid_Size']] = df_trades_piv.loc[:,['Ask_Size', 'Bid_Size']].fillna(0)
+    df_trades_piv.loc[:,['Ask_Price', 'Bid_Price']] = df_trades_piv.loc[:,['Ask_Price', 'Bid_Price']].fillna(method='ffill')
+
+    return df_trades_piv
+
+def raw_trade_file(date_to_process, pair):
+    '''
+    Path of the raw trade file of a day, downloaded from S3 if not available locally
+
+    Returns: string
+    '''
+
+    configuration = config()
+    raw_data_folder = configuration['folders']['raw_trade_data']
+    raw_file_name = f'{pair}-{datetime.strftime(date_to_process, "%Y%m%d")}.csv.gz'
+    raw_file_path = f'{raw_data_folder}/{pair}/{raw_file_name}'
+
+    if not os.path.isfile(raw_file_path):
+        s3_resource = get_s3_resource()
+        trade_data_bucket = s3_resource.Bucket(configuration['buckets']['trade_data'])
+        objects = [obj for obj in trade_data_bucket.objects.filter(Prefix=f'{pair}/{raw_file_name}') if obj.key == f'{pair}/{raw_file_name}']
+        assert len(objects) > 0, f'{pair}/{raw_file_name} not found in S3'
+        download_objects(trade_data_bucket, objects, raw_data_folder)
+        log(f'Downloaded {raw_file_name} from S3')
+
+    return raw_file_path
+
+def trade_day_manifest(date_to_process, pair, frequency, storage):
+    '''
+    Manifest parameters and inputs of a resampled trade day: the raw trade file and, if cached,
+    the previous day used to impute the first prices
+
+    Returns: (parameters, inputs)
+    '''
+
+    configuration = config()
+    freq = f'{int(frequency.total_seconds())}s'
+    prev_day = date_to_process + timedelta(days=-1)
+    prev_day_file = storage.path(f'{configuration["folders"]["resampled_data"]}/{pair}/trades/{freq}/{datetime.strftime(prev_day, "%Y-%m-%d")}')
+
+    parameters = {'pair': pair, 'frequency': freq, 'day': datetime.strftime(date_to_process, '%Y-%m-%d')}
+    inputs = [f'{configuration["folders"]["raw_trade_data"]}/{pair}/{pair}-{datetime.strftime(date_to_process, "%Y%m%d")}.csv.gz']
+    if os.path.exists(prev_day_file):
+        inputs.append(prev_day_file)
+
+    return parameters, inputs
 
 def get_s3_resource():
     """
@@ -547,14 +1427,22 @@ def get_s3_resource():
     The credentials can be in environment variables or in a configuration file and will be discovered automatically by the boto3.client() function.
     For more information, see the Python SDK documentation: http://boto3.readthedocs.io/en/latest/reference/services/sts.html#client
 
+    If s3_stand_in is set in the [other] section of project.conf, a filesystem stand-in is returned instead
+    (see s3_download.LocalS3Resource), so the download path can run offline
+
     Output: S3 resource object
     """
 
     if not hasattr(get_s3_resource, 's3_resource'):
 
+        configuration = config()
+        s3_stand_in = configuration['other'].get('s3_stand_in', '')
+        if s3_stand_in:
+            get_s3_resource.s3_resource = LocalS3Resource(s3_stand_in)
+            return get_s3_resource.s3_resource
+
         get_s3_resource.s3_resource = boto3.resource('s3')
 
-        configuration = config()
         if configuration['other'].getboolean('cross_account_access'):
             sts_client = boto3.client('sts')
             response = sts_client.assume_role(RoleArn=configuration['other']['cross_account_access_role'], RoleSessionName="AssumeRoleSession")
@@ -567,36 +1455,287 @@ def get_s3_resource():
 
     return get_s3_resource.s3_resource
 
-def cnn_data_reshaping(X, Y, T):
+@timed('cnn_data_reshaping')
+def cnn_data_reshaping(X, Y, T, output_type='array'):
     '''
     Reshape/augment data for 1D convolutions
     Inputs: X -> np.array with shape (lentgh_timeseries, # entries * order book depth for each timestamp)
             Y -> np.array with shape (length timeseries, 1)
             T -> int: # past timesteps to augment each timestamp
+            output_type -> 'array' copies every window in to a new array (N - T + 1, T, D, 1),
+                           'view' returns a read only strided view with the same shape and no copy:
+                           memory stays O(N * D) instead of O(N * T * D). See also cnn_batches
 
     Output: reshaped X and Y
 
     To do: accomodate for 2D convs
     '''
     [N, D] = X.shape
-    df = np.array(X)
+    df = np.asarray(X)
 
     dY = np.array(Y)
 
     dataY = dY[T - 1:N]
 
-    dataX = np.zeros((N - T + 1, T, D))
+    if output_type == 'view':
+        # window i is df[i:i + T], rows of the view share memory with X
+        dataX = np.lib.stride_tricks.sliding_window_view(df, (T, D))[:, 0]
+
+    elif output_type == 'array':
+        dataX = np.zeros((N - T + 1, T, D))
 
-    for i in range(T, N + 1):
-        dataX[i - T] = df[i - T:i, :]
+        for i in range(T, N + 1):
+            dataX[i - T] = df[i - T:i, :]
+
+    else:
+        raise ValueError(f'Output type {output_type} not recognized')
 
     dataX = dataX.reshape(dataX.shape + (1,)) # no need to add the extra dimension for 1d conv
 
-    print(f'shape X:{dataX.shape}, shape Y:{dataY.shape}')
+    log(f'shape X:{dataX.shape}, shape Y:{dataY.shape}')
 
     return dataX, dataY
 
+def cnn_batches(X, Y, T, batch_size=256, shuffle=False, seed=None):
+    '''
+    Generator of mini-batches for 1D convolutions, same windows as cnn_data_reshaping.
+    Only one batch of windows is materialized at a time
+
+    Arguments:
+    X -- np.array (or memmap) with shape (lentgh_timeseries, # entries * order book depth for each timestamp)
+    Y -- np.array with shape (length timeseries, ...)
+    T -- int: # past timesteps to augment each timestamp
+    batch_size -- int, windows per batch
+    shuffle -- boolean, shuffle windows order
+    seed -- int, random generator seed when shuffling
+
+    Yields: X batch (batch_size, T, D, 1) and Y batch (batch_size, ...)
+    '''
+
+    windows = np.lib.stride_tricks.sliding_window_view(np.asarray(X), (T, X.shape[1]))[:, 0]
+    dataY = np.asarray(Y)[T - 1:]
+
+    order = np.arange(windows.shape[0])
+    if shuffle:
+        np.random.default_rng(seed).shuffle(order)
+
+    for start in range(0, order.shape[0], batch_size):
+        batch = order[start:start + batch_size]
+        yield windows[batch][..., np.newaxis], dataY[batch]
+
+
+class ShardBatchGenerator:
+    '''
+    Streaming replacement of Keras TimeseriesGenerator over data on disk (e.g. a memory-mapped TensorStore): same
+    windows (data[i - length:i] for target i) and number of batches, but the series is read one day shard at a time.
+    Windows are shuffled with a bounded buffer (shard order and windows within shards are shuffled too) and batches
+    are assembled by background threads, prefetch batches ahead of the training loop. The shuffled stream is iterated
+    forever across epochs:
+        train_store, test_store = import_px_tensors(...)
+        generator_train = ShardBatchGenerator(train_store, labels_train.values, length, batch_size, shuffle=True, num_classes=3)
+        model.fit(generator_train, steps_per_epoch=len(generator_train), epochs=200, ...)
+    Without shuffling, batches can also be read by index in the TimeseriesGenerator order (see batch), e.g. for predict:
+        generator_test = ShardBatchGenerator(test_store, labels_test.values, length, batch_size, num_classes=3)
+        model.predict(generator_test.keras_sequence())
+
+    Arguments:
+    data -- TensorStore, or array like (timesteps, features), np.memmap to keep it on disk
+    targets -- array like (timesteps, ...), targets[i] is the target of the window ending before row i
+    length -- integer, timesteps of each window
+    batch_size -- integer, windows per batch
+    shuffle -- boolean, shuffle windows (False keeps the TimeseriesGenerator order, e.g. for evaluation)
+    dt_index -- datetime index of data rows, shards are days. Defaults to the TensorStore dt_index
+    shard_rows -- integer, rows per shard if there is no dt_index
+    buffer_size -- integer, windows in the shuffle buffer
+    prefetch -- integer, batches assembled ahead
+    workers -- integer, threads assembling batches
+    num_classes -- integer, one hot encode targets per batch (as to_categorical), None to return targets as they are
+    seed -- integer, random generator seed
+    '''
+
+    def __init__(self, data, targets, length, batch_size=128, shuffle=False, dt_index=None, shard_rows=8640, buffer_size=10000,
+                 prefetch=4, workers=2, num_classes=None, seed=None):
+        if isinstance(data, TensorStore):
+            dt_index = data.dt_index if dt_index is None else dt_index
+            data = data.depth
+
+        self.data = data
+        self.targets = targets if isinstance(targets, np.ndarray) else np.asarray(targets) # memmaps stay on disk
+        self.length = length
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.prefetch = prefetch
+        self.workers = workers
+        self.num_classes = num_classes
+        self.rng = np.random.default_rng(seed)
+        self.stream = None
+        self.lock = threading.Lock() # Keras can ask batches from several threads
+
+        n = data.shape[0]
+        if dt_index is not None:
+            days = pd.DatetimeIndex(dt_index).normalize().values
+            starts = np.concatenate(([0], np.flatnonzero(days[1:] != days[:-1]) + 1))
+        else:
+            starts = np.arange(0, n, shard_rows)
+        self.shards = [(start, end) for start, end in zip(starts, np.append(starts[1:], n)) if end > length]
+
+    def __len__(self):
+        return int(np.ceil((self.data.shape[0] - self.length) / self.batch_size))
+
+    def windows(self):
+        '''
+        Windows of an epoch as (shard block, position of the target in the block, target index). Each shard is read
+        with the length rows before it, so windows crossing day boundaries are the same as on the whole series
+        '''
+
+        order = self.rng.permutation(len(self.shards)) if self.shuffle else range(len(self.shards))
+        for shard in order:
+            start, end = self.shards[shard]
+            read_start = max(0, start - self.length)
+            block = np.asarray(self.data[read_start:end])
+            target_indices = np.arange(max(start, self.length), end)
+            if self.shuffle:
+                self.rng.shuffle(target_indices)
+            for target_index in target_indices:
+                yield block, target_index - read_start, target_index
+
+    def batch_windows(self):
+        ''' Windows of each batch of an epoch, drawn at random from a buffer of buffer_size windows if shuffling '''
+
+        buffer_size = self.buffer_size if self.shuffle else 1
+        buffer, batch = [], []
+        for window in self.windows():
+            buffer.append(window)
+            if len(buffer) >= buffer_size:
+                i = self.rng.integers(len(buffer)) if self.shuffle else 0
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                batch.append(buffer.pop())
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+
+        if self.shuffle:
+            self.rng.shuffle(buffer)
+        for window in buffer:
+            batch.append(window)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def assemble(self, batch):
+        ''' X (batch, length, features) and targets of a batch, windows of the same block are gathered at once '''
+
+        x = np.empty((len(batch), self.length) + tuple(batch[0][0].shape[1:]), dtype=batch[0][0].dtype)
+        blocks = {}
+        for i, (block, position, _) in enumerate(batch):
+            blocks.setdefault(id(block), (block, [], []))
+            blocks[id(block)][1].append(i)
+            blocks[id(block)][2].append(position)
+        for block, rows, positions in blocks.values():
+            block_windows = np.lib.stride_tricks.sliding_window_view(block, self.length, axis=0)
+            x[rows] = np.moveaxis(block_windows[np.asarray(positions) - self.length], -1, 1)
+
+        y = np.asarray(self.targets[np.array([target_index for _, _, target_index in batch])])
+        if self.num_classes is not None:
+            y = np.eye(self.num_classes, dtype=np.float32)[y.astype(np.int64).ravel()]
+        return x, y
+
+    def __iter__(self):
+        ''' Batches of one epoch, assembled in background threads '''
+
+        pending = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # gives up if the consumer stopped, so the producer never blocks on a full queue
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce(executor):
+            try:
+                for batch in self.batch_windows():
+                    if not put(executor.submit(self.assemble, batch)):
+                        return
+            except Exception as e:
+                put(e)
+            put(None)
+
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            producer = threading.Thread(target=produce, args=(executor,), daemon=True)
+            producer.start()
+            try:
+                while True:
+                    future = pending.get()
+                    if future is None:
+                        break
+                    if isinstance(future, Exception):
+                        raise future
+                    yield future.result()
+            finally:
+                stop.set()
+                producer.join()
+
+    def __next__(self):
+        ''' Next batch, epochs follow each other forever '''
+
+        with self.lock:
+            if self.stream is None:
+                self.stream = iter(self)
+            try:
+                return next(self.stream)
+            except StopIteration:
+                self.stream = iter(self)
+                return next(self.stream)
+
+    def batch(self, index):
+        '''
+        Batch index in the TimeseriesGenerator order (no shuffling): the windows of targets length + index * batch_size
+        onwards, read from data at once. Batches don't depend on each other, so they can be asked in any order and
+        from several threads
+
+        Returns: X (batch, length, features) and targets of the batch
+        '''
+
+        start = self.length + index * self.batch_size
+        end = min(start + self.batch_size, self.data.shape[0])
+        if index < 0 or start >= end:
+            raise IndexError(f'Batch {index} out of range, {len(self)} batches')
+
+        block = np.asarray(self.data[start - self.length:end])
+        return self.assemble([(block, target_index - start + self.length, target_index) for target_index in range(start, end)])
+
+    def keras_sequence(self):
+        '''
+        Keras Sequence serving batch index for the index asked by Keras (see batch), for model.predict / evaluate
+        without steps arguments. Only for generators without shuffling: shuffled batches are a stream, iterate the
+        generator with steps_per_epoch instead
+        '''
+
+        if self.shuffle:
+            raise ValueError('Shuffled batches are streamed, use model.fit(generator, steps_per_epoch=len(generator))')
+
+        from tensorflow.keras.utils import Sequence
+        generator = self
+
+        class BatchSequence(Sequence):
+            def __len__(self):
+                return len(generator)
+
+            def __getitem__(self, index):
+                return generator.batch(index)
+
+        return BatchSequence()
+
 
+@timed('reshape_lob_levels')
 def reshape_lob_levels(z_df, output_type='array'):
     '''
     Reshape data in a format consistent with deep LOB paper
@@ -610,8 +1749,8 @@ def reshape_lob_levels(z_df, output_type='array'):
 
     dt_index = reshaped_z_df.index
 
-    print(f'Depth Values shape: {reshaped_z_df.shape}')
-    print(f'Datetime Index shape: {dt_index.shape}')
+    log(f'Depth Values shape: {reshaped_z_df.shape}')
+    log(f'Datetime Index shape: {dt_index.shape}')
 
     if output_type == 'dataframe':
 
@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+
+# Shape preserving downsampling of timeseries before they are sent to a chart. Taking every nth point drops spikes,
+# these methods keep the extremes of each bucket:
+#   lttb   -- Largest Triangle Three Buckets: one point per bucket, the one forming the largest triangle with the
+#             point selected in the previous bucket and the average of the next bucket. Best visual match for lines
+#   minmax -- min and max of each bucket, exact envelope of the series (e.g. labels, spreads, depth)
+# The number of points follows the chart width (points_per_pixel points per pixel), so the payload is bounded
+# whatever the date range:
+#   sampled_ts = downsample_series(ts, chart_points(width))
+#   fig.add_trace(go.Scatter(x=sampled_ts.index, y=sampled_ts.values))
+# zoomable_figure re-runs the downsampling on the visible range when a notebook chart is zoomed.
+
+def chart_points(width, points_per_pixel=2):
+    ''' Number of points to plot on a chart width pixels wide '''
+
+    return int(width * points_per_pixel)
+
+
+def as_float(x):
+    ''' x values as float64, datetimes as nanoseconds '''
+
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    return x.astype(np.float64)
+
+
+def minmax_indices(y, n_out):
+    '''
+    Indices of the min and max of n_out / 2 buckets of equal size (plus first and last point), sorted.
+    Fully vectorized on a (buckets, bucket size) array, NaNs are ignored
+
+    Returns: int array
+    '''
+
+    y = np.asarray(y, dtype=np.float64)
+    n = y.shape[0]
+    if n <= n_out or n_out < 4:
+        return np.arange(n)
+
+    bucket_size = int(np.ceil(n / (n_out // 2)))
+    n_buckets = int(np.ceil(n / bucket_size))
+    buckets = np.full(n_buckets * bucket_size, np.nan)
+    buckets[:n] = y
+    buckets = buckets.reshape(n_buckets, bucket_size)
+
+    nan = np.isnan(buckets)
+    offsets = np.arange(n_buckets) * bucket_size
+    lows = offsets + np.argmin(np.where(nan, np.inf, buckets), axis=1)
+    highs = offsets + np.argmax(np.where(nan, -np.inf, buckets), axis=1)
+
+    indices = np.unique(np.concatenate([[0, n - 1], lows, highs]))
+    return indices[indices < n]
+
+
+def lttb_indices(x, y, n_out):
+    '''
+    Indices selected by Largest Triangle Three Buckets: first and last point plus one point for each of n_out - 2
+    buckets of equal size. Bucket averages are computed for all buckets at once from cumulative sums, the triangle
+    areas of each bucket are vectorized. Only the chain of selected points is sequential (one step per bucket)
+
+    Returns: int array
+    '''
+
+    x = as_float(x)
+    y = np.asarray(y, dtype=np.float64)
+    n = y.shape[0]
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64) # n_out - 2 buckets between first and last point
+
+    # average point of each bucket (NaNs ignored), the bucket after the last one is the last point
+    valid = ~np.isnan(y)
+    sum_x = np.concatenate([[0.0], np.cumsum(np.where(valid, x, 0.0))])
+    sum_y = np.concatenate([[0.0], np.cumsum(np.where(valid, y, 0.0))])
+    count = np.concatenate([[0], np.cumsum(valid)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bucket_count = count[edges[1:]] - count[edges[:-1]]
+        avg_x = np.append((sum_x[edges[1:]] - sum_x[edges[:-1]]) / bucket_count, x[-1])
+        avg_y = np.append((sum_y[edges[1:]] - sum_y[edges[:-1]]) / bucket_count, y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        area = np.abs((x[a] - avg_x[bucket + 1]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y[bucket + 1] - y[a]))
+        area = np.where(np.isnan(area), -1, area)
+        a = start + int(np.argmax(area))
+        selected[bucket + 1] = a
+
+    return selected
+
+
+def downsample_indices(x, y, n_out, method='lttb'):
+    ''' Indices kept by method ('lttb' or 'minmax') to plot about n_out points '''
+
+    if method == 'lttb':
+        return lttb_indices(x, y, n_out)
+    elif method == 'minmax':
+        return minmax_indices(y, n_out)
+    else:
+        raise ValueError(f'Downsampling method {method} not recognized')
+
+
+def downsample(x, y, n_out, method='lttb', x_range=None):
+    '''
+    Function to downsample a series given as x and y arrays, optionally restricted to the visible x_range
+
+    Arguments:
+    x -- array, sorted x values (e.g. datetimes)
+    y -- array, y values
+    n_out -- integer, number of points to keep (see chart_points)
+    method -- string, 'lttb' or 'minmax'
+    x_range -- (start, end), only points in the range are considered (found by binary search). None for all
+
+    Returns: x and y arrays
+    '''
+
+    x, y = np.asarray(x), np.asarray(y)
+    if x_range is not None:
+        start, end = x_range
+        if np.issubdtype(x.dtype, np.datetime64):
+            start, end = np.datetime64(pd.Timestamp(start)), np.datetime64(pd.Timestamp(end))
+        x_slice = slice(np.searchsorted(x, start, side='left'), np.searchsorted(x, end, side='right'))
+        x, y = x[x_slice], y[x_slice]
+
+    indices = downsample_indices(x, y, n_out, method)
+    return x[indices], y[indices]
+
+
+def downsample_series(ts, n_out, method='lttb', x_range=None):
+    ''' downsample() for a pandas series with a sorted index '''
+
+    if x_range is not None:
+        ts = ts.loc[x_range[0]:x_range[1]]
+    return ts.iloc[downsample_indices(ts.index.values, ts.values, n_out, method)]
+
+
+def zoomable_figure(fig, series, n_out, method='lttb'):
+    '''
+    Function to turn a figure in to a FigureWidget (Jupyter, requires ipywidgets) whose traces are downsampled
+    again from the full series on the visible range every time the x axis is zoomed or panned
+
+    Arguments:
+    fig -- plotly figure, traces plotted from downsampled series
+    series -- list of full pandas series, one for each trace of fig (same order)
+    n_out -- integer, number of points of each trace
+    method -- string, 'lttb' or 'minmax', or list with the method of each trace
+
+    Returns: plotly FigureWidget
+    '''
+
+    import plotly.graph_objects as go
+
+    widget = go.FigureWidget(fig)
+    methods = method if isinstance(method, list) else [method] * len(series)
+
+    def on_range(layout, x_range):
+        with widget.batch_update():
+            for trace, ts, trace_method in zip(widget.data, series, methods):
+                sampled_ts = downsample_series(ts, n_out, trace_method, x_range)
+                trace.x, trace.y = sampled_ts.index, sampled_ts.values
+
+    widget.layout.on_change(on_range, 'xaxis.range')
+    return widget
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+from configuration import config
+from instrumentation import log, count
+
+# Compact dtypes of the LOB and trade frames, applied by every loader and writer of data_preprocessing:
+#   Datetime          -- datetime64[ns] (int64 nanoseconds), never strings after a CSV round trip
+#   Ask/Bid_Price     -- float64, prices need the precision (float32 has ~7 significant digits)
+#   Ask/Bid_Size      -- float32
+#   Level             -- int8 (-1 for trades, 0 to lob_depth - 1 for the order book)
+#   Sequence          -- int64
+# Index columns written by to_csv ('Unnamed: 0', ...) are dropped. Standardized features can be stored as float32
+# as well, setting float32_features = yes in the [cache] section of project.conf:
+#   day_data = apply_schema(storage.read(file_name, dtype=csv_dtypes(), parse_dates=['Datetime']))
+#   memory_report(day_data, 'lob_day')
+
+SCHEMA = {
+    'Ask_Price': 'float64',
+    'Bid_Price': 'float64',
+    'Mid_Price': 'float64',
+    'Ask_Size': 'float32',
+    'Bid_Size': 'float32',
+    'Spread': 'float32',
+    'Level': 'int8',
+    'Sequence': 'int64',
+    'merge_index': 'int64',
+    'Datetime': 'datetime64[ns]',
+}
+
+FEATURE_COLUMNS = ['Ask_Price', 'Bid_Price', 'Ask_Size', 'Bid_Size'] # standardized (normalized) columns
+
+
+def float32_features():
+    ''' True if standardized features are stored as float32, from the [cache] section of project.conf '''
+
+    configuration = config()
+    return configuration.has_section('cache') and configuration['cache'].get('float32_features', 'no') in ('yes', 'true', '1')
+
+
+def frame_dtypes(normalized=False):
+    ''' Column dtypes of a frame, normalized for the standardized train/test files '''
+
+    dtypes = dict(SCHEMA)
+    if normalized:
+        feature_dtype = 'float32' if float32_features() else 'float64'
+        dtypes.update({column: feature_dtype for column in FEATURE_COLUMNS})
+    return dtypes
+
+
+def csv_dtypes(normalized=False):
+    ''' frame_dtypes to pass to read_csv, so columns are parsed directly into compact arrays (Datetime is parsed with parse_dates) '''
+
+    return {column: dtype for column, dtype in frame_dtypes(normalized).items() if column != 'Datetime'}
+
+
+def apply_schema(df, normalized=False):
+    '''
+    Function to cast the known columns of a frame to the compact dtypes and drop the unnamed index columns.
+    Integer columns with missing values (e.g. Sequence of trade rows) are left as they are.
+    Works on pandas and Dask dataframes (partition by partition)
+
+    Arguments:
+    df -- pandas or Dask dataframe
+    normalized -- boolean, df holds standardized features (see float32_features)
+
+    Returns: dataframe
+    '''
+
+    if not isinstance(df, pd.DataFrame):
+        # meta is the empty Dask meta frame with the schema applied: left to infer it, Dask would run
+        # apply_schema on placeholder values (e.g. strings in the Datetime column of a CSV read)
+        return df.map_partitions(apply_schema, normalized, meta=apply_schema(df._meta, normalized))
+
+    unnamed = [column for column in df.columns if str(column).startswith('Unnamed: ')]
+    if unnamed:
+        df = df.drop(columns=unnamed)
+
+    dtypes = {}
+    for column, dtype in frame_dtypes(normalized).items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        if np.issubdtype(np.dtype(dtype), np.integer) and df[column].isna().any():
+            continue
+        dtypes[column] = dtype
+
+    if 'Datetime' in dtypes:
+        df = df.assign(Datetime=pd.to_datetime(df['Datetime']))
+        del dtypes['Datetime']
+
+    return df.astype(dtypes) if dtypes else df
+
+
+def memory_report(df, name):
+    '''
+    Log the in memory size of a frame (deep, strings included) and count it in frame_bytes
+
+    Returns: integer, bytes
+    '''
+
+    frame_bytes = int(df.memory_usage(deep=True).sum())
+    count('frame_bytes', frame_bytes, frame=name)
+    log(f'{name} frame', rows=df.shape[0], mb=round(frame_bytes / 1024 ** 2, 2),
+        bytes_per_row=round(frame_bytes / max(df.shape[0], 1), 1))
+    return frame_bytes
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# Lightweight instrumentation of the pipeline stages, in place of print():
+#   log('Found cached file', path=path)                  -- structured log event
+#   count('json_repairs', 3, type='missing_delimiter')  -- counter (rows, bytes, gaps, repairs, cache hits...)
+#   with stage('standardize', columns='prices'): ...   -- timer, also records the peak RSS of the process
+#   @timed('get_lob_data')                              -- same as stage() around a function
+# Events go to the 'rl_trader' logger, printed to stdout by default (text or one JSON object per line, see
+# configure). Metrics are kept in memory and can be exported in the Prometheus text format:
+#   configure(json_logs=True, prometheus_file='metrics.prom')   # written at exit
+#   export_prometheus('metrics.prom')                           # or on demand
+# Timers cost two perf_counter calls and a getrusage call, cheap enough to be always on.
+
+logger = logging.getLogger('rl_trader')
+
+
+class Metrics:
+    ''' Thread safe registry of counters, stage timings and gauges, keyed on (name, sorted labels) '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {} # key: [count, total seconds, max seconds]
+        self.gauges = {}
+
+    def count(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timing = self.timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def gauge(self, name, value, labels, keep_max=False):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = max(value, self.gauges.get(key, value)) if keep_max else value
+
+    def snapshot(self):
+        ''' Picklable copy of the metrics (e.g. to send them from a worker process) '''
+        with self.lock:
+            return {'counters': dict(self.counters), 'timings': {key: list(value) for key, value in self.timings.items()},
+                    'gauges': dict(self.gauges)}
+
+    def merge(self, snapshot):
+        ''' Add the metrics of a snapshot, e.g. from a worker process. Gauges keep the maximum '''
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (n, total, maximum) in snapshot['timings'].items():
+                timing = self.timings.setdefault(key, [0, 0.0, 0.0])
+                timing[0] += n
+                timing[1] += total
+                timing[2] = max(timing[2], maximum)
+            for key, value in snapshot['gauges'].items():
+                self.gauges[key] = max(value, self.gauges.get(key, value))
+
+
+metrics = Metrics()
+
+
+class StructuredFormatter(logging.Formatter):
+    ''' Message followed by key=value fields, or one JSON object per line '''
+
+    def __init__(self, json_logs=False):
+        super().__init__()
+        self.json_logs = json_logs
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        if self.json_logs:
+            return json.dumps({'time': record.created, 'level': record.levelname, 'message': record.getMessage(), **fields}, default=str)
+        if not fields or record.levelno < logging.INFO:
+            return record.getMessage()
+        return f'{record.getMessage()} ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+
+
+def configure(level=logging.INFO, json_logs=False, stream=sys.stdout, prometheus_file=None):
+    '''
+    Function to set up the pipeline logger
+
+    Arguments:
+    level -- logging level, DEBUG also shows the dataframe previews
+    json_logs -- boolean, one JSON object per event instead of text
+    stream -- stream the events are written to
+    prometheus_file -- string, path the metrics are exported to at exit (see export_prometheus)
+    '''
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(StructuredFormatter(json_logs))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    if prometheus_file is not None:
+        atexit.register(export_prometheus, prometheus_file)
+
+
+def log(message, level=logging.INFO, **fields):
+    ''' Log an event with structured fields '''
+
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={'fields': fields})
+
+
+def count(name, value=1, **labels):
+    ''' Increase a counter '''
+
+    metrics.count(name, value, labels)
+
+
+def peak_rss():
+    ''' Peak resident set size of the process in bytes, None if not available (e.g. Windows) '''
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # bytes on macOS, KB on linux
+
+
+def current_rss():
+    ''' Current resident set size of the process in bytes, None if not available '''
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+@contextmanager
+def stage(name, **labels):
+    '''
+    Context manager timing a pipeline stage: duration is recorded in stage_seconds, the peak RSS of the process
+    in peak_rss_bytes. Stages failing with an exception are counted in stage_errors
+    '''
+
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count('stage_errors', stage=name, **labels)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe('stage_seconds', seconds, {'stage': name, **labels})
+        rss = peak_rss()
+        if rss is not None:
+            metrics.gauge('peak_rss_bytes', rss, {}, keep_max=True)
+        log(f'{name} done', logging.DEBUG, seconds=round(seconds, 4), peak_rss_mb=None if rss is None else round(rss / 1024 ** 2, 1), **labels)
+
+
+def timed(name):
+    ''' Decorator, runs the function inside stage(name) '''
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def with_metrics(func, *args, **kwargs):
+    '''
+    Run func in a worker process and return (output, metrics snapshot), to be merged in the parent process
+    with metrics.merge (see data_preprocessing.map_days). Metrics of the worker start empty
+    '''
+
+    metrics.reset()
+    output = func(*args, **kwargs)
+    return output, metrics.snapshot()
+
+
+def prometheus_labels(labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}' if labels else ''
+
+
+def prometheus_text(prefix='rl_trader'):
+    ''' Metrics in the Prometheus text exposition format '''
+
+    snapshot = metrics.snapshot()
+    lines = []
+
+    for name in sorted({name for name, _ in snapshot['counters']}):
+        lines.append(f'# TYPE {prefix}_{name}_total counter')
+        for (key_name, labels), value in sorted(snapshot['counters'].items()):
+            if key_name == name:
+                lines.append(f'{prefix}_{name}_total{prometheus_labels(labels)} {value}')
+
+    for name in sorted({name for name, _ in snapshot['timings']}):
+        lines.append(f'# TYPE {prefix}_{name} summary')
+        for (key_name, labels), (n, total, maximum) in sorted(snapshot['timings'].items()):
+            if key_name == name:
+                lines.append(f'{prefix}_{name}_count{prometheus_labels(labels)} {n}')
+                lines.append(f'{prefix}_{name}_sum{prometheus_labels(labels)} {total:.6f}')
+                lines.append(f'{prefix}_{name}_max{prometheus_labels(labels)} {maximum:.6f}')
+
+    for name in sorted({name for name, _ in snapshot['gauges']}):
+        lines.append(f'# TYPE {prefix}_{name} gauge')
+        for (key_name, labels), value in sorted(snapshot['gauges'].items()):
+            if key_name == name:
+                lines.append(f'{prefix}_{name}{prometheus_labels(labels)} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def export_prometheus(path):
+    ''' Write the metrics to a Prometheus text file (e.g. for the node exporter textfile collector), atomically '''
+
+    with open(f'{path}.tmp', 'w') as f:
+        f.write(prometheus_text())
+    os.replace(f'{path}.tmp', path)
+
+
+if not logger.handlers:
+    configure() # events are printed as before unless configured otherwise
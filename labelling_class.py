@@ -3,11 +3,32 @@ import pandas as pd
 import scipy.signal
 from sklearn.preprocessing import MinMaxScaler
 
+from instrumentation import log, count, stage
+
 
 class Labels_Generator:
 
     def __init__(self, mid_px):
         self.mid_px = mid_px
+        self._labels = None
+        self.segments = None # run-length representation of the cleaned labels, see label_segments
+        self.segments_px = None # prices the segments were built from, inner joined with the labels on the index (see aligned_series)
+
+
+    @property
+    def labels(self):
+        ''' Labels timeseries, None before get_raw_labels. After cleaning, labels are kept as segments and only expanded when accessed '''
+
+        if self._labels is None and self.segments is not None:
+            self._labels = pd.Series(expand_segments(self.segments, self.segments_px.shape[0], leading=0), index=self.segments_px.index,
+                                     name='cleaned_labels')
+        return self._labels
+
+
+    @labels.setter
+    def labels(self, labels):
+        self._labels = labels
+        self.segments = None
 
 
     def get_smooth_px(self):
@@ -50,69 +71,142 @@ class Labels_Generator:
         **kwargs: trades dataframe columns name with relative threshold to filter for (<=). Example: gross_returns=0.002
         '''
 
-        # recap dataframe
+        assert self.labels is not None, 'No labels to clean, call get_raw_labels first'
+        if self.segments is None:
+            # positions of prices and labels match after the inner join on the index, as the legacy merge
+            self.segments_px, labels = aligned_series(self.mid_px, self.labels)
+            self.segments = label_segments(self.segments_px.values, labels.values)
+        print_pnl_summary(self.segments)
+
+        # recap dataframe - one row per trade
         df_trades_columns = ['trade_grouper', 'labels', 'trade_len', 'gross_returns']
-        df_trades = get_strategy_pnl(self.mid_px, self.labels)[df_trades_columns].dropna(subset=['gross_returns'])
+        df_trades = self.segments[df_trades_columns].copy()
 
         # locate short unprofitable labels, replace them with NAs and fill them with prev label values
         df_trades['cleaned_labels'] = df_trades['labels']
         # build df query with keyward passed to locate index of unprofitable labels
         query = ' & '.join([f'`{k}`<={v}' for k, v in kwargs.items()])
-        print(f'Criteria {query}')
+        log(f'Criteria {query}')
         df_trades.loc[df_trades.query(query).index, 'cleaned_labels'] = pd.NA
         # fillna methodology depends on the args passed to the function
         df_trades['cleaned_labels'].fillna(value=fillna_value, method=fillna_method, inplace=True)
 
-        # expand table trades - one row per trade -  back into a full labels timeseries
-        cleaned_labels = np.empty(self.labels.shape[0])
-        cleaned_labels[:] = np.nan
-        cleaned_labels = pd.Series(cleaned_labels, name='cleaned_labels')
-        cleaned_labels.loc[df_trades['trade_grouper']] = df_trades['cleaned_labels']
-        # ffill the 'exploded' timeseries with prev values
-        self.labels = cleaned_labels.fillna(method='ffill')
+        # cleaned trades back into segments of the new labels, the labels timeseries is expanded only if accessed
+        cleaned_segments = self.segments.assign(labels=df_trades['cleaned_labels'].astype('float64'))
+        cleaned_labels = expand_segments(cleaned_segments, self.segments_px.shape[0])
+        self.labels = None
+        self.segments = label_segments(self.segments_px.values, cleaned_labels)
 
         return df_trades
 
-def get_strategy_pnl(px_ts, labels):
-    
+
+def aligned_series(px_ts, labels):
+    ''' Prices and labels, inner join on the index if not already aligned '''
+
+    if px_ts.index.equals(labels.index):
+        return px_ts, labels
+
     df = pd.merge(px_ts, labels, left_index=True, right_index=True) # default how is inner
-    df.index = np.arange(0,df.shape[0])
-    df.columns = ['px', 'labels']
+    return df.iloc[:, 0], df.iloc[:, 1]
+
+
+def aligned_values(px_ts, labels):
+    ''' Prices and labels as arrays, see aligned_series '''
 
-    labels_ext = np.concatenate(( [0], labels.values, [0])) # extend array for comparison
-    idx = np.flatnonzero(labels_ext[1:] != labels_ext[:-1]) # verify if alignement is correct
+    px, labels = aligned_series(px_ts, labels)
+    return px.values, labels.values
+
+
+def label_segments(px, labels):
+    '''
+    Run-length representation of a labels timeseries, built from the label changes in one pass.
+    A trade is a run of equal labels starting at a label change, timesteps before the first change are not a trade.
+    As label changes are found with !=, each NaN label is a trade on its own
+
+    px -- np.array of prices
+    labels -- np.array of labels, same length as px
+
+    Returns: dataframe with one row per trade, indexed by the trade start (float, as get_strategy_pnl rows)
+    trade_grouper -- trade start timestep
+    labels -- label of the trade
+    trade_len -- number of prices in the trade, NaN if the label is NaN
+    gross_returns -- sum of log returns times the label, including the log return into the first timestep
+    end -- timestep after the last one of the trade
+    '''
+
+    n = labels.shape[0]
+    labels_ext = np.concatenate(( [0], labels, [0])) # extend array for comparison
+    idx = np.flatnonzero(labels_ext[1:] != labels_ext[:-1])
     # non zero indices - remove last. Avoid errors when transaction occurs on last label
-    if idx[-1] >= df.shape[0]:
-        idx = idx[:-1] 
+    if idx.shape[0] > 0 and idx[-1] >= n:
+        idx = idx[:-1]
+    ends = np.append(idx[1:], n).astype('int64')
+
+    log_ret = np.log(px[1:]) - np.log(px[:-1])
+    individual_return = np.concatenate(([np.nan], log_ret)) * labels
+    gross_returns = np.add.reduceat(np.nan_to_num(individual_return, nan=0.0), idx) if idx.shape[0] > 0 else np.empty(0)
+
+    valid_px = np.concatenate(([0], np.cumsum(~np.isnan(px))))
+    trade_len = (valid_px[ends] - valid_px[idx]).astype('float64')
+    trade_len[np.isnan(labels[idx].astype('float64'))] = np.nan # NaN labels are not grouped
+    # integer lengths if every timestep belongs to a trade with a label (no NaN when expanded)
+    if (idx.shape[0] == 0 or idx[0] == 0) and not np.isnan(trade_len).any():
+        trade_len = trade_len.astype('int64')
+
+    return pd.DataFrame({
+        'trade_grouper': idx.astype('float64'),
+        'labels': labels[idx],
+        'trade_len': trade_len,
+        'gross_returns': gross_returns,
+        'end': ends
+    }, index=pd.Index(idx.astype('float64')))
+
+
+def expand_segments(segments, n, column='labels', leading=np.nan):
+    '''
+    Segment column back to a timeseries of length n. Timesteps before the first trade are filled with leading,
+    for labels of segments built by label_segments they are 0
+    '''
+
+    values = np.full(n, leading, dtype='float64')
+    if segments.shape[0] > 0:
+        start = int(segments['trade_grouper'].iloc[0])
+        values[start:] = np.repeat(segments[column].values.astype('float64'), segments['end'].values - segments['trade_grouper'].values.astype('int64'))
+    return values
 
-    df['log_ret'] = np.log(df['px']) - np.log(df['px'].shift(1))#df['px'].pct_change()#np.log(df['px']) - np.log(df['px'].shift(1))
-    df['individual_return'] = df['log_ret'] * df['labels']# need to add +1 to multiply with tr feee
 
-    # auxiliary column to perform groupby and get rough profit estimate
-    df['trade_grouper'] = np.nan
-    df['trade_grouper'].loc[idx] = idx
-    df['trade_grouper'] = df['trade_grouper'].fillna(method='ffill')
+def print_pnl_summary(segments):
+    ''' Rough profit estimate of non zero trades '''
 
-    # series with trade length filled across the df
-    df['trade_len'] = df.groupby(['labels', 'trade_grouper'])['px'].transform('count')
+    trades = segments[segments['labels']!=0]
+    n_trades = trades['gross_returns'].count()
+    tot_return = trades['gross_returns'].sum()
+    avg_return = trades['gross_returns'].mean()
 
-    # calculate profits
-    trade_gross_profit = pd.Series(df.groupby('trade_grouper')['individual_return'].sum(), name='gross_returns') # each grouper represents a trade
-    # add gross returns at the beginning of each trade in df
-    df = pd.merge(df, trade_gross_profit, left_index=True, right_index=True, how='outer')
+    log('Pnl summary', trades=n_trades, sum_returns=round(tot_return, 2), average_return=round(avg_return, 6))
+
+
+def get_strategy_pnl(px_ts, labels):
+    '''
+    Per timestep strategy returns, with trade_grouper (trade start), trade_len and gross_returns (on the first timestep of
+    each trade) from the label segments
+    '''
 
-    #average profit
-    trades_df = df[df['labels']!=0]
-    n_trades = trades_df['gross_returns'].count()
-    tot_return = trades_df['gross_returns'].sum()
-    avg_return = trades_df['gross_returns'].mean()
+    px, label_values = aligned_values(px_ts, labels)
+    segments = label_segments(px, label_values)
+    print_pnl_summary(segments)
 
-    print(f'''Total non zero trades: {n_trades}, sum of returns: {tot_return:.2f}, average return: {avg_return:.6f}''')
+    df = pd.DataFrame({'px': px, 'labels': label_values}, index=pd.Index(np.arange(0, px.shape[0], dtype='float64')))
+    df['log_ret'] = np.log(df['px']) - np.log(df['px'].shift(1))
+    df['individual_return'] = df['log_ret'] * df['labels']
 
+    # expand trade level columns across the df
+    df['trade_grouper'] = expand_segments(segments, df.shape[0], 'trade_grouper')
+    trade_len = expand_segments(segments, df.shape[0], 'trade_len')
+    df['trade_len'] = trade_len.astype('int64') if segments['trade_len'].dtype == 'int64' else trade_len
+    # gross returns at the beginning of each trade
+    df['gross_returns'] = segments['gross_returns']
 
-    # df['cleaned_labels'] = 0 # create column with all 0 labels
-    # df['cleaned_labels'].loc[positive_df_idx] = df['labels'].loc[positive_df_idx] # replace 0s with labels of positive trades
-    
     return df
 
 def label_insights(labels):
@@ -128,9 +222,8 @@ def label_insights(labels):
     a_ext = np.concatenate(( [0], labels.values, [0])) # extend array for comparison
     idx = np.flatnonzero(a_ext[1:] != a_ext[:-1]) # non zero indices - transactions
 
-    print(f'Labels shape: {labels.shape}')
-    print(f'Labels: {unique_labels} \nCount: {counts_labels} \nPctg: {percent_labels}')
-    print(f'Number of trades: {idx.shape[0]}')
+    log('Label insights', shape=labels.shape, labels=unique_labels.tolist(), count=counts_labels.tolist(),
+        pctg=np.round(percent_labels, 4).tolist(), trades=idx.shape[0])
 
     return idx.shape[0]
 
@@ -145,22 +238,27 @@ def cleaned_labels(target_timeseries, method='three_steps', print_details=True):
     if method == 'three_steps':
 
         #step 1
-        labels_gen.get_raw_labels()
+        with stage('labels', step='raw'):
+            labels_gen.get_raw_labels()
         if print_details:
-            print('\n##### Step 1 #####')
+            log('##### Step 1 #####')
             label_insights(labels_gen.labels)
 
         # step 2 - first cleaning
-        _ = labels_gen.get_cleaned_labels(fillna_method='ffill', gross_returns=0.005, trade_len=20)
+        with stage('labels', step='first_cleaning'):
+            _ = labels_gen.get_cleaned_labels(fillna_method='ffill', gross_returns=0.005, trade_len=20)
         if print_details:
-            print('\n##### Step 2 #####')
+            log('##### Step 2 #####')
             label_insights(labels_gen.labels)
 
         # step 3 - second cleaning
-        df_trades = labels_gen.get_cleaned_labels(fillna_value=0, gross_returns=0.005, trade_len=30)#, gross_returns=0.002)
+        with stage('labels', step='second_cleaning'):
+            df_trades = labels_gen.get_cleaned_labels(fillna_value=0, gross_returns=0.005, trade_len=30)#, gross_returns=0.002)
         if print_details:    
-            print('\n##### Step 3 #####')
+            log('##### Step 3 #####')
             label_insights(labels_gen.labels)
+        count('rows', target_timeseries.shape[0], layer='labels')
+        count('trades', df_trades.shape[0], layer='labels')
 
         labels = labels_gen.labels
 
@@ -171,54 +269,70 @@ def cleaned_labels(target_timeseries, method='three_steps', print_details=True):
 
 
 
-def three_barrier_labelling(mix_px, h=700, factor=[1.0020, 0.9980]):
+def three_barrier_labelling(mix_px, h=700, factor=[1.0020, 0.9980], volatility=None):
     '''
     Alternative labelling technique inspired to "three barriers method" on Advances in Financial Machine Learning book
     explanation: https://mlfinlab.readthedocs.io/en/latest/labeling/tb_meta_labeling.html
     Compared to the method above it tends to lag. The current implementation can cut positive running labels at any point.
-    barriers depending on volatility still to be implmeneted. Also vertical barrier should depend on volatility
+    Vertical barrier should depend on volatility
+
+    Starting from the first price, path returns are compared with the horizontal barriers for h steps: prices until
+    the first touch are labelled 1 (take profit) or -1 (stop loss) and the next path starts from the touch. If no barrier
+    is touched, the h prices are labelled 0 and the next path starts at the vertical barrier. Paths depend on the previous
+    touch, so they are walked one at a time, the first touch of each path is searched with numpy.
+
+    mix_px -- pandas series of prices
+    h -- int, vertical barrier in number of timesteps
+    factor -- list, [take profit, stop loss] barriers as price ratios
+    volatility -- array-like with one value per timestep, optional. Barriers of a path starting at t are scaled by
+                  volatility[t]: take profit = (factor[0] - 1) * volatility[t]. None for fixed barriers
     '''
 
+    px = mix_px.values.astype('float64')
+    scale = np.ones(px.shape[0]) if volatility is None else np.asarray(volatility, dtype='float64')
+    assert scale.shape == px.shape, 'volatility must have one value per timestep'
+
+    labels = np.zeros(px.shape[0], dtype='int64')
     counter = 0
-    output =  mix_px.copy(deep=True) ## can use smoothed verison here
-    output = pd.DataFrame(output)
-    output['labels'] = 12345 # placeholder
 
-    while counter <= mix_px.shape[0]: ##
-        print(f'start {counter} and end {counter+h}')
-        slice_df = mix_px[counter:counter+h] # path prices ##
-        ut = pd.Series(np.full((slice_df.shape[0], ), 1, dtype=float), index=slice_df.index) # upper threshold, to do: function of volatility
-        lt = pd.Series(np.full((slice_df.shape[0], ), 1, dtype=float), index=slice_df.index) # lower threshold, to do: function of volatility
+    while counter < px.shape[0]:
+        end = min(counter + h, px.shape[0])
+        take_profit = (factor[0] - 1) * scale[counter] # upper barrier
+        stop_loss = (factor[1] - 1) * scale[counter] # lower barrier
+
+        touch, label = first_barrier_touch(px, counter, end, take_profit, stop_loss)
+
+        if label == 0:
+            labels[counter:end] = 0 # if no touch, assign 0 till vertical barrier
+            counter += h
+        else:
+            labels[counter:touch + 1] = label # assign +1 or -1 until the barrier touched first
+            counter = touch
 
-        take_profit = (ut*factor[0])-1 # upper barrier
-        stop_loss = (lt*factor[1])-1  # lower barrier
+    output = pd.DataFrame(mix_px.copy(deep=True))
+    output['labels'] = labels
 
-        slice_df = (slice_df/slice_df[0]-1) # path returns
+    return output
 
-        take_profit_touch = slice_df[slice_df>take_profit].index.min() # find upper touch time
-        stop_loss_touch = slice_df[slice_df<stop_loss].index.min() # find lower touch time
 
-        if pd.isna(take_profit_touch) and pd.isna(stop_loss_touch):
-            output.loc[slice_df.index[0]: slice_df.index[-1],'labels'] = 0 # if no touch, assign 0 till vertical barrier
-            counter+=h
+def first_barrier_touch(px, start, end, take_profit, stop_loss, block=64):
+    '''
+    First passage of the path returns px[start:end] / px[start] - 1 through the barriers.
+    The path is scanned in blocks of growing size, so early touches don't compute the whole path
 
-        elif not pd.isna(take_profit_touch) and pd.isna(stop_loss_touch):
-            output.loc[slice_df.index[0]: take_profit_touch,'labels'] = 1 # assign 1 until take profit is touched
-            counter+=slice_df.index.get_loc(take_profit_touch)
+    Returns: (position of the touch, 1 for take profit or -1 for stop loss), (end, 0) if no barrier is touched
+    '''
 
-        elif pd.isna(take_profit_touch) and not pd.isna(stop_loss_touch):
-            output.loc[slice_df.index[0]: stop_loss_touch,'labels'] = -1 # assign -1 until stop loss is touched
-            counter+=slice_df.index.get_loc(stop_loss_touch)
+    lower = start + 1 # the path return at start is 0
+    while lower < end:
+        upper = min(lower + block, end)
+        path = px[lower:upper] / px[start] - 1 # path returns
 
-        elif not pd.isna(take_profit_touch) and not pd.isna(stop_loss_touch): # assign +1 or -1 to what is touched first
-            if take_profit_touch<stop_loss_touch:
-                output.loc[slice_df.index[0]: take_profit_touch,'labels'] = 1
-                counter+=slice_df.index.get_loc(take_profit_touch)
+        touch = np.flatnonzero((path > take_profit) | (path < stop_loss))
+        if touch.size > 0:
+            return lower + touch[0], 1 if path[touch[0]] > take_profit else -1
 
-            elif stop_loss_touch<take_profit_touch:
-                output.loc[slice_df.index[0]: take_profit_touch,'labels'] = -1
-                counter+=slice_df.index.get_loc(stop_loss_touch)
-        else:
-            print(f'Occurrence not capture between {counter} and {counter+h}')
+        lower = upper
+        block *= 2
 
-    return output
\ No newline at end of file
+    return end, 0
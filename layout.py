@@ -254,6 +254,8 @@ user_interface = dbc.Container(
                 align="start",
         ),
 
+        dcc.Store(id="chart_width"), # price_chart width in pixels, measured in the browser
+
         # dbc.Row(
         #     [
         #         dbc.Col(dcc.Graph(id="depth_chart"), md=12),
@@ -57,3 +57,76 @@ class DataNormalization:
         while self.roll_window+self.start <= self.ts_stacked.shape[0]:
             self.dyn_ts = pd.concat([self.dyn_ts, self.get_one_dyn_z()])
         return self.dyn_ts
+
+
+class DynamicZScore:
+    '''
+    O(n) dynamic z score on (timesteps, levels, cols) blocks, same windows as standardize(norm_type='dyn_z_score'):
+    elements are taken in stack order (timestep, level, col) and each element is standardized with mean and
+    std (ddof=0) of the roll * levels * cols elements ending levels * cols + 1 elements before it.
+
+    Window sums are built from running sums over whole timesteps plus prefix sums within a timestep,
+    instead of rolling over the stacked series. The last roll + 1 timesteps are kept as state, so
+    update() extends the normalized series with new timesteps without recomputing history.
+    '''
+
+    def __init__(self, roll, levels, cols):
+        ''' 
+            roll: int, rolling window in timesteps
+
+            levels: int, orderbook levels per timestep
+
+            cols: int, number of columns normalized together (e.g. 2 for Ask_Price and Bid_Price)
+        '''
+        self.roll = roll
+        self.levels = levels
+        self.cols = cols
+        self.step = levels * cols
+        self.history = np.empty((0, self.step))
+        self.reference = None # values are shifted by a constant to limit floating point cancellation
+
+    def update(self, new_block):
+        ''' Normalize new timesteps, new_block has shape (timesteps, levels, cols). Returns an array with the same shape '''
+        new_block = np.asarray(new_block, dtype='float64').reshape(-1, self.step)
+        if self.reference is None:
+            self.reference = np.nanmean(new_block) if new_block.size > 0 else 0.0
+
+        values = np.concatenate([self.history, new_block - self.reference])
+        z = self.dyn_z(values)[self.history.shape[0]:]
+
+        self.history = values[-(self.roll + 1):]
+        return z.reshape(-1, self.levels, self.cols)
+
+    def dyn_z(self, values):
+        ''' Kernel on a (timesteps, levels * cols) array, NaN where the window is not complete '''
+        timesteps = values.shape[0]
+        z = np.full(values.shape, np.nan)
+        if timesteps <= self.roll + 1:
+            return z
+
+        window_size = self.roll * self.step
+        window_sum = self.window_sums(values)
+        window_sum_sq = self.window_sums(values ** 2)
+
+        mean = window_sum / window_size
+        std = np.sqrt(np.maximum(window_sum_sq / window_size - mean ** 2, 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z[self.roll + 1:] = (values[self.roll + 1:] - mean) / std
+        return z
+
+    def window_sums(self, values):
+        '''
+        Sum of the window of each element of timesteps roll + 1 onwards. For element p of timestep t
+        the window covers elements p to step - 1 of timestep t - 1 - roll, the whole timesteps in between
+        and elements 0 to p - 1 of timestep t - 1
+        '''
+        # prefix sums within each timestep, element p excluded
+        prefix = np.zeros(values.shape)
+        np.cumsum(values[:, :-1], axis=1, out=prefix[:, 1:])
+        # running sum of whole timesteps, timestep t excluded
+        running = np.zeros(values.shape[0] + 1)
+        np.cumsum(values.sum(axis=1), out=running[1:])
+
+        t_end = np.arange(self.roll, values.shape[0] - 1) # timestep t - 1
+        t_start = t_end - self.roll # timestep t - 1 - roll
+        return ((running[t_end] - running[t_start])[:, None] + prefix[t_end] - prefix[t_start])
@@ -17,19 +17,39 @@ from datetime import datetime, timedelta
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 import plotly.express as px
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 
 from layout import user_interface
+from visual_data_cache import VisualDataCache
+from downsampling import chart_points, downsample, downsample_series
 
 import func_tools as ft
 
 root_caching_folder = "Processed_Data"#"RL_Trader/Processed_Data" # processed cached data folder
+data_cache = VisualDataCache(root_caching_folder) # files are read once per process, see visual_data_cache.py
+default_chart_width = 1800 # pixels, until the browser reports the chart width. Traces are downsampled to about 2 points per pixel (see downsampling.py)
 
 # Define app and app layout
 app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
 security = 'USDT_BTC'
 app.layout = user_interface
 
+# width of the price chart from the browser, on the first render and when the chart is resized (autosize relayout)
+app.clientside_callback(
+    '''
+    function(relayout_data, width) {
+        var chart = document.getElementById('price_chart');
+        if (chart && chart.offsetWidth > 0 && chart.offsetWidth !== width) {
+            return chart.offsetWidth;
+        }
+        return window.dash_clientside.no_update;
+    }
+    ''',
+    Output("chart_width", "data"),
+    [Input("price_chart", "relayoutData")],
+    [State("chart_width", "data")]
+)
+
 @app.callback(
     [Output("price_chart", "figure"),
     Output("print_k_plus_window", "children"),
@@ -52,21 +72,28 @@ app.layout = user_interface
         Input("k_minus", "value"),
         Input("alpha_threshold", "value"),
         Input("tr_fee_bps", "value"),
-        Input("long_only_pnl", "value")
+        Input("long_only_pnl", "value"),
+        Input("price_chart", "relayoutData"),
+        Input("chart_width", "data")
     ],
 )
 def make_price_graph(security, start_date, end_date, ob_levels, norm_window, switch, 
-                        k_plus, k_minus, alpha, tr_fee_bps, long_only):
+                        k_plus, k_minus, alpha, tr_fee_bps, long_only, relayout_data=None, chart_width=None):
 
     # initiate values to print out under dash components
     k_plus_window_text = ''
     k_minus_window_text = ''
     alpha_thresh_text = ''
     tr_fee_text = ''
+
+    # visible range if the chart is zoomed, traces are downsampled again on it. relayoutData keeps the last zoom
+    # until the next one, so it is only used when it triggered the callback: other inputs reset the range
+    triggers = [trigger['prop_id'] for trigger in dash.callback_context.triggered]
+    x_range = relayout_x_range(relayout_data) if 'price_chart.relayoutData' in triggers else None
+    n_out = chart_points(chart_width if chart_width else default_chart_width)
     
     # data reading
-    data = pd.read_csv(f'{root_caching_folder}/{security}/data-cache-1m.csv', index_col=0)
-    data = data[(data.Datetime >= start_date) & (data.Datetime <= end_date)]
+    data = data_cache.slice(security, start_date, end_date)
 
     data_top = data[data.Level  == 0]#.reset_index() #fix double index issue. Do it the func tool way, cause that's the one that changes
     data_top['Mid_Price'] = (data_top['Ask_Price'] + data_top['Bid_Price']) / 2
@@ -92,18 +119,22 @@ def make_price_graph(security, start_date, end_date, ob_levels, norm_window, swi
     sec_axis_check = False
 
     # add depth and spread to main chart
-    px_chart.add_trace(go.Scatter(x=data_grouped.index.values, y=data_grouped['Bid_Size'].values,  name='Bid depth - 10 levels',
+    x, y = downsample(data_grouped.index.values, data_grouped['Bid_Size'].values, n_out, 'minmax', x_range)
+    px_chart.add_trace(go.Scatter(x=x, y=y,  name='Bid depth - 10 levels',
                                 marker=dict(color='#81C342')), row=2, col=1, secondary_y=False) # fill down to xaxis
 
-    px_chart.add_trace(go.Scatter(x=data_grouped.index.values, y=-data_grouped['Ask_Size'].values,  name='Ask depth - 10 levels',
+    x, y = downsample(data_grouped.index.values, -data_grouped['Ask_Size'].values, n_out, 'minmax', x_range)
+    px_chart.add_trace(go.Scatter(x=x, y=y,  name='Ask depth - 10 levels',
                                 marker=dict(color='#EB2030')), row=2, col=1, secondary_y=False) # fill down to xaxis
 
-    px_chart.add_trace(go.Scatter(x=data_grouped.index.values, y=data_grouped['Spread'].values,  name='Best bid-offer spread',
+    x, y = downsample(data_grouped.index.values, data_grouped['Spread'].values, n_out, 'minmax', x_range)
+    px_chart.add_trace(go.Scatter(x=x, y=y,  name='Best bid-offer spread',
                                 marker=dict(color='#335eff')), row=2, col=1, secondary_y=True) # fill down to xaxis
 
 
 
-    px_chart.add_trace(go.Scatter(x=data_top['Datetime'], y=data_top['Mid_Price'], name='price', marker=dict(color='#000000')), 
+    x, y = downsample(data_top['Datetime'].values, data_top['Mid_Price'].values, n_out, 'lttb', x_range)
+    px_chart.add_trace(go.Scatter(x=x, y=y, name='price', marker=dict(color='#000000')), 
                         row=1, col=1, secondary_y=False)
     px_chart.update_yaxes(title_text="$ price", secondary_y=sec_axis_check, row=1, col=1)
     sec_axis_check = True
@@ -117,14 +148,14 @@ def make_price_graph(security, start_date, end_date, ob_levels, norm_window, swi
     #     px_chart.update_yaxes(title_text="normalized price", secondary_y=sec_axis_check, row=1, col=1)
 
     #if 'dyn_z_score' in norm_type:
-    data_ft = data.set_index(['Datetime', 'Level'])
-    norm_ts_px = ft.normalize(data_ft[['Ask_Price', 'Bid_Price']], ob_levels=ob_levels, norm_type='dyn_z_score', roll=norm_window)
-    norm_ts_vol = ft.normalize(data_ft[['Ask_Size', 'Bid_Size']], ob_levels=ob_levels, norm_type='dyn_z_score', roll=norm_window) # get norm volumes
+    norm_ts_px = data_cache.normalized(security, start_date, end_date, ['Ask_Price', 'Bid_Price'], ob_levels, norm_window, ft.normalize)
+    norm_ts_vol = data_cache.normalized(security, start_date, end_date, ['Ask_Size', 'Bid_Size'], ob_levels, norm_window, ft.normalize) # get norm volumes
     test_dyn_df = pd.concat([norm_ts_px, norm_ts_vol], axis=1).reset_index() # concat along row index
     depth_dyn, dt_index_dyn = ft.reshape_lob_levels(test_dyn_df, output_type='array') # 1 train dataset
     mid_px_train_dyn = pd.Series((depth_dyn[:,2] + depth_dyn[:,0]) / 2) # 2
 
-    px_chart.add_trace(go.Scatter(x=dt_index_dyn, y=mid_px_train_dyn, name='dynamic z-score',  marker=dict(color='#FFA15A')), 
+    x, y = downsample(dt_index_dyn.values, mid_px_train_dyn.values, n_out, 'lttb', x_range)
+    px_chart.add_trace(go.Scatter(x=x, y=y, name='dynamic z-score',  marker=dict(color='#FFA15A')), 
                         row=1, col=1, secondary_y=sec_axis_check)
     px_chart.update_yaxes(title_text="normalized price", secondary_y=sec_axis_check, row=1, col=1)
 
@@ -137,19 +168,21 @@ def make_price_graph(security, start_date, end_date, ob_levels, norm_window, swi
             print(labels.shape)
             
             pnl, _ = ft.get_pnl(data['Mid_Price'], labels, tr_fee_bps/10000)
+            pnl = downsample_series(pnl, n_out, 'minmax')
             pnl_chart.add_trace(go.Scatter(x=pnl.index, y=pnl, name='PnL'))
 
         elif long_only == 'long_short':
             labels = ft.get_labels(data['Mid_Price'], k_plus, k_minus,  alpha, long_only=False) #getting labels from real px
             
             pnl, _ = ft.get_pnl(data['Mid_Price'], labels, tr_fee_bps/10000)
+            pnl = downsample_series(pnl, n_out, 'minmax')
             pnl_chart.add_trace(go.Scatter(x=pnl.index, y=pnl, name='PnL'))
 
         background_color = ft.plot_labels(labels)
         px_chart.update_layout(shapes=background_color) # plot labels background
     else:
         # add flat line
-        pnl_chart.add_trace(go.Scatter(x=data.index, y=np.zeros(data.index.shape[0]), name='PnL'))
+        pnl_chart.add_trace(go.Scatter(x=data.index[[0, -1]] if data.shape[0] > 0 else [], y=np.zeros(min(2, data.shape[0])), name='PnL'))
 
     # print out labelling paramenters
     k_plus_text = f'k Plus Window: {k_plus} steps'
@@ -172,12 +205,27 @@ def make_price_graph(security, start_date, end_date, ob_levels, norm_window, swi
                             x=0
                 ),
                 xaxis_showticklabels=True, 
-                xaxis2_showticklabels=True
+                xaxis2_showticklabels=True,
+                uirevision=f'{security}--{start_date}--{end_date}' # keep zoom when the figure is rebuilt for the same series
             )
+    if x_range is not None:
+        px_chart.update_xaxes(range=x_range)
     #px_chart.update_xaxes(rangeslider_visible=True)
 
     return px_chart, k_plus_text, k_minus_text, alpha_thresh_text, tr_fee_text, pnl_chart
 
+def relayout_x_range(relayout_data):
+    ''' x axis range of a zoomed chart from its relayoutData, None if not zoomed (or zoom reset) '''
+
+    if not relayout_data:
+        return None
+    for axis in ['xaxis', 'xaxis2']: # subplots share the x axis
+        if f'{axis}.range[0]' in relayout_data:
+            return relayout_data[f'{axis}.range[0]'], relayout_data[f'{axis}.range[1]']
+        if f'{axis}.range' in relayout_data:
+            return tuple(relayout_data[f'{axis}.range'])
+    return None
+
 # # Deactivate normalization slider when dyn_z_score is not selected
 # @app.callback(Output('normalization_window', 'disabled'),
 #              [Input('normalization_type', 'value')])
@@ -6,24 +6,120 @@
 
 import gzip
 import json
+import logging
 import glob, os
+from concurrent import futures
 
 from datetime import datetime, timedelta, time
 
 import pandas as pd
 import numpy as np
 
+from cache_storage import CsvStorage
+from instrumentation import log, count, timed
+from frame_schema import apply_schema, memory_report
+
 
 # In[2]:
 
 
+DEPTH_THRESHOLDS = {'tight': 25, 'medium': 50, 'wide': 100} # bps from the mid price
+
+
+def depth_thresholds(thresholds):
+    ''' Thresholds as an ordered dictionary {name: bps}, a list of bps is named '{bps}bps' '''
+
+    if not isinstance(thresholds, dict):
+        thresholds = {f'{bps:g}bps': bps for bps in thresholds}
+    return dict(sorted(thresholds.items(), key=lambda item: item[1]))
+
+
+def depth_columns(thresholds):
+    ''' Depth bar columns: bid depth for each threshold, then ask depth '''
+
+    return ([f'bid_{name}_depth' for name in depth_thresholds(thresholds)] +
+            [f'ask_{name}_depth' for name in depth_thresholds(thresholds)])
+
+
+def depth_by_threshold(snapshot_codes, n_snapshots, spread, notional, thresholds_bps):
+    '''
+    Cumulative notional of each snapshot within each threshold, in a single pass over the levels:
+    each level falls in the bucket of the tightest threshold it is within, notionals are summed per
+    (snapshot, bucket) with one bincount and accumulated over the buckets
+
+    Arguments:
+    snapshot_codes -- int array, snapshot of each level (0 to n_snapshots - 1)
+    n_snapshots -- integer
+    spread -- float array, distance of each level from the mid price as a fraction of it (NaN are never within)
+    notional -- float array, notional of each level
+    thresholds_bps -- list of thresholds in bps, sorted
+
+    Returns: float array (n_snapshots, thresholds), NaN where no level of the snapshot is within the threshold
+    '''
+
+    k = len(thresholds_bps)
+    bucket = np.searchsorted(np.asarray(thresholds_bps, dtype=np.float64) / 10000, spread, side='left') # NaN go to bucket k
+    index = snapshot_codes * (k + 1) + bucket
+
+    depth = np.bincount(index, weights=notional, minlength=n_snapshots * (k + 1)).reshape(n_snapshots, k + 1)
+    levels = np.bincount(index, minlength=n_snapshots * (k + 1)).reshape(n_snapshots, k + 1)
+
+    depth = np.cumsum(depth[:, :k], axis=1)
+    depth[np.cumsum(levels[:, :k], axis=1) == 0] = np.nan
+    return depth
+
+
+def snapshots_to_book(json_files):
+    '''
+    Columnar order book from decoded snapshot files (dictionaries {key: snapshot}, see Preprocessing.load_json):
+    one row per snapshot and level, levels beyond the shallower side of a snapshot are dropped.
+    Arrays are built once for all files, without intermediate rows
+
+    Returns: pandas dataframe sorted by Datetime and Level, with bid and ask notionals. Seq is a nullable integer
+             (<NA> for snapshots without seq) and isFrozen the raw flag of the snapshot ('0' or '1')
+    '''
+
+    snapshots = [(key, snapshot) for json_file in json_files for key, snapshot in json_file.items()]
+    if not snapshots:
+        return pd.DataFrame([], columns=['Ask_Price', 'Ask_Size', 'Bid_Price', 'Bid_Size', 'Level', 'Seq', 'isFrozen', 'Datetime',
+                                         'Bid_Notional', 'Ask_Notional'])
+
+    depth = np.array([min(len(snapshot['asks']), len(snapshot['bids'])) for _, snapshot in snapshots], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(depth)[:-1]))
+
+    # prices are strings in the snapshots, converted with the sizes in one array per side
+    asks = np.array([quote for (_, snapshot), d in zip(snapshots, depth) for quote in snapshot['asks'][:d]], dtype=np.float64).reshape(-1, 2)
+    bids = np.array([quote for (_, snapshot), d in zip(snapshots, depth) for quote in snapshot['bids'][:d]], dtype=np.float64).reshape(-1, 2)
+    datetimes = pd.to_datetime([key[-15:] for key, _ in snapshots], format='%Y%m%d_%H%M%S').values
+
+    df = pd.DataFrame({
+        'Ask_Price': asks[:, 0],
+        'Ask_Size': asks[:, 1],
+        'Bid_Price': bids[:, 0],
+        'Bid_Size': bids[:, 1],
+        'Level': np.arange(depth.sum()) - np.repeat(offsets, depth),
+        'Seq': pd.array([snapshot.get('seq') for _, snapshot in snapshots], dtype='Int64').take(np.repeat(np.arange(len(snapshots)), depth)),
+        'isFrozen': np.repeat(np.array([snapshot.get('isFrozen') for _, snapshot in snapshots], dtype=object), depth),
+        'Datetime': np.repeat(datetimes, depth)
+    }).sort_values(by=['Datetime', 'Level'], kind='mergesort').reset_index(drop=True)
+
+    df = apply_schema(df) # compact dtypes, see frame_schema
+    df['Bid_Notional'] = df['Bid_Size'] * df['Bid_Price']
+    df['Ask_Notional'] = df['Ask_Size'] * df['Ask_Price']
+    return df
+
+
 class Preprocessing:
 
     # initialize class attributes: root_path is the root folder, security is the currency pair to unpack
-    def __init__(self, root_path, security, root_caching_folder):
+    # storage is the cache backend for bbo and depth bars (see cache_storage), defaults to plain csv files
+    # depth_thresholds are the spread thresholds of the depth bars, {name: bps} or list of bps (see get_depth_bars)
+    def __init__(self, root_path, security, root_caching_folder, storage=None, depth_thresholds=DEPTH_THRESHOLDS):
         self.root_path = root_path
         self.security = security
         self.root_caching_folder = root_caching_folder
+        self.storage = storage if storage is not None else CsvStorage(compression=None)
+        self.depth_thresholds = depth_thresholds
 
     # method that generates file path
     def file_path(self, date, time):
@@ -42,45 +138,45 @@ class Preprocessing:
         return json.loads(json_str)                      # to python object
 
 
-    # method that unravels the nested json structure into a more manageable list of lists
-    def unravel_json(self, date, time):
-        json_file = self.load_json(date, time)
-        
-        list_quotes = [list(zip(
-                                    [i[0] for i in json_file.get(key).get('asks')], # ask px
-                                    [i[1] for i in json_file.get(key).get('asks')], # ask size
-                                    [i[0] for i in json_file.get(key).get('bids')], # bid px
-                                    [i[1] for i in json_file.get(key).get('bids')], # bid size
-                                    list(range(len(json_file.get(key).get('bids')))), # ob level - assuming same for both
-                                    [json_file.get(key).get('seq')]*100, # seq
-                                    [json_file.get(key).get('isFrozen')]*100, # frozen flag
-                                    [datetime.strptime(key[-15:], '%Y%m%d_%H%M%S')]*100  #datetime 
-                                ) ) for key in json_file.keys()]
-        return list_quotes
-
-
-    # method that converts list of lists into a df
+    # method that converts an hourly file into a df (see snapshots_to_book)
+    @timed('get_data_df')
     def get_data_df(self, date, time):
-        global df
-        list_quotes = self.unravel_json(date, time)
+        df = snapshots_to_book([self.load_json(date, time)])
+        count('rows', df.shape[0], layer='order_book')
+        memory_report(df, 'order_book')
 
-        df =  pd.DataFrame([y for x in list_quotes for y in x], #flatten the list of lists structure
-                          columns = ['Ask_Price', 'Ask_Size', 'Bid_Price', 'Bid_Size',
-                                        'Level', 'Seq', 'isFrozen', 'Datetime']).sort_values(by = ['Datetime', 'Level'])
+        return df
 
-        df[['Ask_Price','Bid_Price']] = pd.to_numeric(df[['Ask_Price','Bid_Price']])
-        
-        df['Bid_Notional'] = df['Bid_Size'] * df['Bid_Price']
-        df['Ask_Notional'] = df['Ask_Size'] * df['Ask_Price']
+
+    # method that reads the hourly files of a day in parallel (decompression and decoding run in threads) into one df
+    @timed('get_day_df')
+    def get_day_df(self, date, hours=None, workers=8):
+        hours = hours if hours is not None else [f'{hour:02d}' for hour in range(24)]
+
+        def load_hour(time):
+            try:
+                return self.load_json(date, time)
+            except (IOError, ValueError) as e:
+                log(f'Failed reading {self.file_path(date, time)}: {e!r}', logging.ERROR)
+                count('raw_file_errors', security=self.security)
+                return {}
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            json_files = list(executor.map(load_hour, hours))
+
+        df = snapshots_to_book(json_files)
+        count('rows', df.shape[0], layer='order_book')
+        memory_report(df, 'order_book_day')
 
         return df
 
 
+    @timed('get_bbo')
     def get_bbo(self, df = None, **kwargs):
 
         # For this to work you need either a df or date and time to be specified
         if df is None and 'date' in kwargs and 'time' in kwargs:
-            df = self.get_data_df(date, time)
+            df = self.get_data_df(kwargs['date'], kwargs['time'])
 
         # First level orderbook (bbo - best bid offer)
         df_bbo = df[df.Level == 0].copy()
@@ -91,6 +187,7 @@ class Preprocessing:
 
         return df_bbo
     
+    @timed('get_bbo_bars')
     def get_bbo_bars(self, date, time, df_bbo = None,agg_freq = '1H', caching=True):
         
         '''
@@ -117,117 +214,145 @@ class Preprocessing:
         #                'mid_std', 'mean_spread']
         
         if caching:
-            df_bbo_bars.to_csv(f'{root_caching_folder}/{security}/bbo.csv', mode='a', header=False)
+            self.storage.append(df_bbo_bars, f'{self.root_caching_folder}/{self.security}/bbo', partition=self.partition(date, time))
         
         return df_bbo_bars
 
     
-    def get_depth_bars(self, date, time, df_bbo = None,agg_freq = '1H', spread_threshold_tight=0.0025, 
-                           spread_threshold_medium=0.0050, spread_threshold_wide=0.0100,
-                            caching=True):
-        
-        #df = self.get_data_df(date, time)
-        #print(self.df)
+    @timed('get_depth_bars')
+    def get_depth_bars(self, date, time, df = None, df_bbo = None, agg_freq = '1H', thresholds = None, caching=True):
+
+        '''
+        Method that returns the notional depth of each side within spread thresholds from the mid price,
+        averaged over bars of agg_freq (e.g. '30s', '1min', '1H').
+        Depth is computed in one pass over the level arrays (see depth_by_threshold), without merging the book
+        with the bbo. A snapshot with no level within a threshold is left out of the bar average
+
+        thresholds -- dictionary {name: bps} or list of bps (named '{bps}bps'), defaults to the depth_thresholds of
+                      the class. Columns are bid_{name}_depth for each threshold, then ask_{name}_depth
+        '''
+
+        thresholds = depth_thresholds(thresholds if thresholds is not None else self.depth_thresholds)
+
+        if df is None:
+            df = self.get_data_df(date, time)
         if df_bbo is None:
-            df_bbo = self.get_bbo(date=date, time=time)
-        
-        bid_df = pd.merge(df[['Datetime', 'Bid_Price', 'Bid_Size', 'Bid_Notional']], 
-                  df_bbo[['Mid_Price', 'spread','Datetime']], 
-                  how = 'left', left_on = 'Datetime', right_on = 'Datetime')
-        
-        bid_df['Bid_Spread'] = (bid_df['Mid_Price'] - bid_df['Bid_Price']) / bid_df['Mid_Price'] # check the math
-        
-        # Filter by spread threshold, only keeping tightest part of the order book
-        bid_tight_depth = bid_df[bid_df['Bid_Spread'] <= spread_threshold_tight].groupby('Datetime')['Bid_Notional'].sum()
-        bid_medium_depth = bid_df[bid_df['Bid_Spread'] <= spread_threshold_medium].groupby('Datetime')['Bid_Notional'].sum()
-        bid_wide_depth = bid_df[bid_df['Bid_Spread'] <= spread_threshold_wide].groupby('Datetime')['Bid_Notional'].sum()
-        
-        # spread to ask - merge with bbo mid px, calculate respective spreads
-        ask_df = pd.merge(df[['Datetime', 'Ask_Price', 'Ask_Size', 'Ask_Notional']], 
-                  df_bbo[['Mid_Price', 'spread','Datetime']], 
-                  how = 'left', left_on = 'Datetime', right_on = 'Datetime')
-
-        ask_df['Ask_Spread'] = np.abs((ask_df['Mid_Price'] - ask_df['Ask_Price']) / ask_df['Mid_Price']) # check the math
-                       
-        ask_tight_depth = ask_df[ask_df['Ask_Spread'] <= spread_threshold_tight].groupby('Datetime')['Ask_Notional'].sum()
-        ask_medium_depth = ask_df[ask_df['Ask_Spread'] <= spread_threshold_medium].groupby('Datetime')['Ask_Notional'].sum()
-        ask_wide_depth = ask_df[ask_df['Ask_Spread'] <= spread_threshold_wide].groupby('Datetime')['Ask_Notional'].sum()
-        
-        bid_ask_depth_df = (pd.concat([bid_tight_depth, bid_medium_depth, bid_wide_depth,
-                                     ask_tight_depth, ask_medium_depth, ask_wide_depth], axis=1)
-                                     .set_axis(['bid_tight_depth', 'bid_medium_depth', 'bid_wide_depth',
-                              'ask_tight_depth', 'ask_medium_depth', 'ask_wide_depth'],axis=1))
-        # bid_ask_depth_df.columns = ['bid_tight_depth', 'bid_medium_depth', 'bid_wide_depth',
-        #                       'ask_tight_depth', 'ask_medium_depth', 'ask_wide_depth']
-        
+            df_bbo = self.get_bbo(df=df)
+
+        # snapshot of each row (rows are sorted by Datetime) and mid price of each snapshot
+        datetimes = df['Datetime'].values
+        snapshot_codes = np.concatenate(([0], np.cumsum(datetimes[1:] != datetimes[:-1])))
+        snapshot_datetimes = datetimes[np.flatnonzero(np.concatenate(([True], datetimes[1:] != datetimes[:-1])))]
+
+        bbo_datetimes = df_bbo['Datetime'].values
+        position = np.minimum(np.searchsorted(bbo_datetimes, snapshot_datetimes), max(bbo_datetimes.shape[0] - 1, 0))
+        mid = np.where(bbo_datetimes[position] == snapshot_datetimes, df_bbo['Mid_Price'].values[position], np.nan)
+        row_mid = mid[snapshot_codes]
+
+        bid_spread = (row_mid - df['Bid_Price'].values) / row_mid
+        ask_spread = np.abs((row_mid - df['Ask_Price'].values) / row_mid)
+
+        bid_depth = depth_by_threshold(snapshot_codes, snapshot_datetimes.shape[0], bid_spread, df['Bid_Notional'].values, list(thresholds.values()))
+        ask_depth = depth_by_threshold(snapshot_codes, snapshot_datetimes.shape[0], ask_spread, df['Ask_Notional'].values, list(thresholds.values()))
+
+        bid_ask_depth_df = pd.DataFrame(np.concatenate([bid_depth, ask_depth], axis=1), columns=depth_columns(thresholds),
+                                        index=pd.Index(snapshot_datetimes, name='Datetime'))
+
         ba_depth_bars = bid_ask_depth_df.reset_index().groupby(pd.Grouper(key='Datetime', freq=agg_freq)).mean()
-        
+
         if caching:
 
-            ba_depth_bars.to_csv(f'{root_caching_folder}/{security}/depth.csv', mode='a', header=False)
-            
+            self.storage.append(ba_depth_bars, f'{self.root_caching_folder}/{self.security}/depth', partition=self.partition(date, time))
+
         return ba_depth_bars
-    
-    
+
+
+    # cache partition of an hour, or of a whole day if time is None (see process_days)
+    def partition(self, date, time=None):
+        return date.replace("/", "") if time is None else f'{date.replace("/", "")}_{time}'
+
+
+    @timed('process_days')
+    def process_days(self, date_start, date_end, agg_freq = '1H', thresholds = None, workers=8, caching=True):
+
+        '''
+        Batch version of the hourly loop: for each day from date_start to date_end (included, '%Y/%m/%d') the hourly
+        files are read in parallel into one book (see get_day_df), bbo and depth bars are computed on the whole day
+        and written once per day. State is kept on the instance only, so several securities can be processed side by
+        side (e.g. one Preprocessing object per security, each in its own thread)
+
+        Returns: list of the days processed
+        '''
+
+        start = datetime.strptime(date_start, '%Y/%m/%d')
+        days = [datetime.strftime(start + timedelta(days=i), '%Y/%m/%d')
+                for i in range((datetime.strptime(date_end, '%Y/%m/%d') - start).days + 1)]
+
+        processed_days = []
+        for date in days:
+            df = self.get_day_df(date, workers=workers)
+            if df.shape[0] == 0:
+                log(f'EMPTY DAY!: {self.security} {date}', logging.WARNING)
+                count('empty_files', security=self.security)
+                continue
+
+            df_bbo = self.get_bbo(df=df)
+            self.get_bbo_bars(date, None, df_bbo=df_bbo, agg_freq=agg_freq, caching=caching)
+            self.get_depth_bars(date, None, df=df, df_bbo=df_bbo, agg_freq=agg_freq, thresholds=thresholds, caching=caching)
+            log(f'Processed {self.security} {date}', rows=df.shape[0])
+            processed_days.append(date)
+
+        return processed_days
+
+
     def caching_checks(self):
     
         # Create main caching folder - if it does not exist
         try:
-            os.makedirs(root_caching_folder)
-            print(f'created {root_caching_folder} folder')
+            os.makedirs(self.root_caching_folder)
+            log(f'created {self.root_caching_folder} folder')
         except FileExistsError:
             # directory already exists
             pass
     
         # Create subfolder for security of interest - if it does not exist
         try:
-            os.makedirs(f'{root_caching_folder}/{security}')
-            print(f'created {root_caching_folder}/{security} subfolder')
+            os.makedirs(f'{self.root_caching_folder}/{self.security}')
+            log(f'created {self.root_caching_folder}/{self.security} subfolder')
         except FileExistsError:
             # directory already exists
             pass
         
         # If the file does not exist, create depth with headers
-        if os.path.exists(f'{root_caching_folder}/{security}/depth.csv'):
+        if self.storage.exists(f'{self.root_caching_folder}/{self.security}/depth'):
             self.cached_date_ranges('depth')
         else:
-            pd.DataFrame([],columns=['bid_tight_depth','bid_medium_depth', 'bid_wide_depth', 'ask_tight_depth', 
-                                    'ask_medium_depth', 'ask_wide_depth']
-                                    ).to_csv(f'{root_caching_folder}/{security}/depth.csv', mode='w', header=True)
-            print(f'Created {root_caching_folder}/{security}/depth.csv')
+            self.storage.create_appendable(f'{self.root_caching_folder}/{self.security}/depth', columns=depth_columns(self.depth_thresholds))
+            log(f'Created {self.storage.path(f"{self.root_caching_folder}/{self.security}/depth")}')
 
         # If the file does not exist, create bbo with headers
-        if os.path.exists(f'{root_caching_folder}/{security}/bbo.csv'):
+        if self.storage.exists(f'{self.root_caching_folder}/{self.security}/bbo'):
             #check daterange of data already cached
             self.cached_date_ranges('bbo')
         else:
-            pd.DataFrame([], columns=['mid_mean' , 'mid_high', 'mid_low', 'mid_open', 'mid_close', 'mid_#_obs', 
-                                      'mid_std', 'mean_spread']
-                                    ).to_csv(f'{root_caching_folder}/{security}/bbo.csv', mode='w', header=True)
-            print(f'Created {root_caching_folder}/{security}/bbo.csv')
+            self.storage.create_appendable(f'{self.root_caching_folder}/{self.security}/bbo', 
+                                           columns=['mid_mean' , 'mid_high', 'mid_low', 'mid_open', 'mid_close', 'mid_#_obs', 
+                                                    'mid_std', 'mean_spread'])
+            log(f'Created {self.storage.path(f"{self.root_caching_folder}/{self.security}/bbo")}')
 
 
     
     def cached_date_ranges(self, df_type):
         if df_type == 'depth':
-            date_range_depth = pd.read_csv(f'{root_caching_folder}/{security}/depth.csv', header=0, index_col=0).index
+            date_range_depth = self.storage.read(f'{self.root_caching_folder}/{self.security}/depth', index_col=0).index
             #return date_range_depth
-            print(f'''Depth data already cached:
-                    Dataframe size: {date_range_depth.shape},
-                    Start date range: {date_range_depth.min()}, 
-                    End date range: {date_range_depth.max()},
-                    {date_range_depth.duplicated().sum()} duplicated entries...
-                    {date_range_depth[date_range_depth.duplicated()]}''')
+            log('Depth data already cached', rows=date_range_depth.shape[0], start=date_range_depth.min(),
+                end=date_range_depth.max(), duplicated=date_range_depth.duplicated().sum())
         
         elif df_type == 'bbo':
-            date_range_bbo = pd.read_csv(f'{root_caching_folder}/{security}/bbo.csv', header=0, index_col=0).index
-            print(f'''Bbo data already cached:
-                    Dataframe size: {date_range_bbo.shape},
-                    Start date range: {date_range_bbo.min()}, 
-                    End date range: {date_range_bbo.max()},
-                    {date_range_bbo.duplicated().sum()} duplicated entries...
-                    
-                    {date_range_bbo[date_range_bbo.duplicated()]}''')
+            date_range_bbo = self.storage.read(f'{self.root_caching_folder}/{self.security}/bbo', index_col=0).index
+            log('Bbo data already cached', rows=date_range_bbo.shape[0], start=date_range_bbo.min(),
+                end=date_range_bbo.max(), duplicated=date_range_bbo.duplicated().sum())
                 
 
 
@@ -263,37 +388,16 @@ data_processing.caching_checks()
 # In[ ]:
 
 
-# write to csv
-counter = 1
-for date in string_dates: #test on a small portion of files
-    for time in string_hours:
-
-        print(f'{counter}, {data_processing.file_path(date, time)}')
-
-        try:
-            df_bbo = data_processing.get_bbo(date=date, time=time)
-
-            if df_bbo.shape[0] > 0:
-
-                data_processing.get_bbo_bars(df_bbo=df_bbo, agg_freq=agg_freq ,date=date, time=time)
-
-                data_processing.get_depth_bars(date, time, df_bbo=df_bbo, agg_freq=agg_freq)
-
-            else:
-                print(f'EMPTY FILE!: {data_processing.file_path(date, time)}')
-            counter+=1
-
-        except IOError as e:
-            print(e.errno)
-            print(e)
+# write to csv - one read of the hourly files and one write per day
+data_processing.process_days(string_dates[0], string_dates[-1], agg_freq=agg_freq)
 
 
 # In[6]:
 
 
 #read csv
-depth_df = pd.read_csv(f'{root_caching_folder}/{security}/depth.csv', header=0, index_col=0)
-bbo_df = pd.read_csv(f'{root_caching_folder}/{security}/bbo.csv', header=0, index_col=0)
+depth_df = data_processing.storage.read(f'{root_caching_folder}/{security}/depth', index_col=0)
+bbo_df = data_processing.storage.read(f'{root_caching_folder}/{security}/bbo', index_col=0)
 
 
 # In[66]:
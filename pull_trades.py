@@ -1,58 +1,256 @@
-import pandas as pd
+import os
+import sys
+import json
 import time
+import random
+import asyncio
+import argparse
 import calendar
+import threading
 from datetime import datetime
-from requests import get
-from json import loads
-import sys, os
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 
-start_date = '2021-01-01'
-end_date = '2021-03-01'
+import pandas as pd
+from requests import Session
+from requests.adapters import HTTPAdapter
 
-response = get(f'https://poloniex.com/public?command=returnTicker')
-if response.status_code == 200:
-    pairs = loads(response.text)
-else:
-    raise Exception(response.content)
+# Backfill of Poloniex trade history, one file per pair and day: {output_folder}/{pair}/{pair}-%Y%m%d.csv.gz
+# (the raw trade files read by data_preprocessing.get_trade_data).
+#   python pull_trades.py 2021-01-01 2021-03-01 --pairs USDT_BTC BTC_ETH
+# Pairs and days are fetched concurrently, all requests go through one pooled session and one global rate limiter.
+# returnTradeHistory returns at most 1000 trades per call: windows hitting the cap are split in half until they
+# fit, so a busy day costs more requests instead of failing. Day files are written atomically once the whole day
+# is fetched and act as checkpoints, an interrupted backfill resumes from the missing days.
+# base_url can point to a MockPoloniexServer to run offline.
 
-for pair in pairs.keys():
+BASE_URL = 'https://poloniex.com/public'
+TRADE_LIMIT = 1000 # maximum trades returned by returnTradeHistory
+DAY_SECONDS = 60 * 60 * 24
 
-    start = calendar.timegm(datetime.strptime(start_date, "%Y-%m-%d").timetuple())
-    end = calendar.timegm(datetime.strptime(end_date, "%Y-%m-%d").timetuple())
 
-    trades_folder = os.path.realpath(os.path.join(os.getcwd(), f'trades/{pair}'))
+class RateLimiter:
+    ''' Token bucket shared by all requests: rate requests per second, with bursts up to burst requests '''
 
-    if not os.path.exists(trades_folder):
-        os.makedirs(trades_folder)
+    def __init__(self, rate=6, burst=6):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
 
-    interval = 60 * 60 * 24 # 24 hours default
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-    if pair in ['BTC_XMR', 'BTC_LTC', 'BTC_DOGE', 'BTC_DASH', 'USDT_XFLR', 'USDT_FARM', 'USDT_TRX', 'USDT_ETH', 'BTC_ETH']:
-        interval = 60 * 3 # 3 minutes
-    elif pair in ['USDT_BTC']:
-        interval = 60 * 1 # 1 minute
 
-    for day in range(start, end, 60*60*24): #loop through daysstr
-        trades_day = []
-        trades_day_file_name = os.path.join(trades_folder, f"{pair}-{datetime.utcfromtimestamp(day).strftime('%Y%m%d')}.csv.gz")
-        if not os.path.exists(trades_day_file_name):
+class TradeBackfill:
+    '''
+    Concurrent trade history backfill
 
-            for minute in range(day, day + 60*60*24, interval):# assuming no more than 1000 trades (poliniex api restriction) in 1 interval window
-                response = get(f'https://poloniex.com/public?command=returnTradeHistory&currencyPair={pair}&start={minute}&end={minute+interval-1}')
-                if response.status_code == 200:
-                    trades = loads(response.text)
-                    trades_day += trades
-                    print(datetime.utcfromtimestamp(minute).strftime(f'Fetched {len(trades)} trades for {pair} %Y-%m-%d  %H:%M:%S'))
-                    if len(trades) == 1000:
-                        raise Exception(f'1000 trades')
+    Arguments:
+    output_folder -- string, folder of the pair folders
+    base_url -- string, Poloniex public API (or mock server) url
+    rate -- float, requests per second across all pairs
+    concurrency -- integer, pair days fetched at the same time (also the size of the connection pool)
+    retries -- integer, attempts after a failed request (connection errors, non 200 responses)
+    backoff -- float, seconds before the first retry, doubled at each attempt
+    initial_window -- integer, seconds of the first window of each day, split when it hits TRADE_LIMIT
+    '''
 
-                else:
-                    raise Exception(response.content)
-            df = pd.DataFrame(trades_day)
-            if not trades_day:
-                print(f'No trades in {trades_day_file_name}')
-            else:
-                df.sort_values(by=['date'])
-            df.to_csv(trades_day_file_name, index=False, compression='gzip')
+    def __init__(self, output_folder, base_url=BASE_URL, rate=6, concurrency=8, retries=5, backoff=1.0, initial_window=60 * 60):
+        self.output_folder = output_folder
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.initial_window = initial_window
+        self.rate = rate
+
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.requests = 0
+        self.splits = 0
+        self.failed = {} # (pair, day): error
+
+    def day_file(self, pair, day):
+        return os.path.join(self.output_folder, pair, f"{pair}-{datetime.utcfromtimestamp(day).strftime('%Y%m%d')}.csv.gz")
+
+    def get(self, params):
+        ''' Blocking request, returns decoded json or raises '''
+
+        response = self.session.get(self.base_url, params=params, timeout=30)
+        if response.status_code != 200:
+            raise IOError(f'{response.status_code} {response.text[:200]}')
+        return json.loads(response.text)
+
+    async def request(self, params):
+        ''' Rate limited request with retries and exponential backoff '''
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire()
+            self.requests += 1
+            try:
+                result = await loop.run_in_executor(self.executor, self.get, params)
+                if isinstance(result, dict) and 'error' in result:
+                    raise IOError(result['error'])
+                return result
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print(f'Retrying {params}: {e!r}')
+                await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    async def fetch_window(self, pair, start, end):
+        ''' Trades in [start, end] (unix seconds), windows returning TRADE_LIMIT trades are split in half '''
+
+        trades = await self.request({'command': 'returnTradeHistory', 'currencyPair': pair, 'start': start, 'end': end})
+        if len(trades) < TRADE_LIMIT:
+            return trades
+
+        if end <= start:
+            raise ValueError(f'More than {TRADE_LIMIT} trades in one second for {pair} at {start}')
+        self.splits += 1
+        middle = (start + end) // 2
+        first, second = await asyncio.gather(self.fetch_window(pair, start, middle), self.fetch_window(pair, middle + 1, end))
+        return first + second
+
+    async def fetch_day(self, pair, day):
+        ''' Fetch and save one day of trades, skipped if the day file exists '''
+
+        file_name = self.day_file(pair, day)
+        if os.path.exists(file_name):
+            print(f'Found {file_name}')
+            return
+
+        async with self.semaphore:
+            try:
+                windows = range(day, day + DAY_SECONDS, self.initial_window)
+                trades = await asyncio.gather(*[self.fetch_window(pair, start, min(start + self.initial_window, day + DAY_SECONDS) - 1) for start in windows])
+            except Exception as e:
+                self.failed[(pair, day)] = repr(e)
+                print(f'Failed fetching {file_name}: {e!r}')
+                return
+
+        df = pd.DataFrame([trade for window in trades for trade in window])
+        if df.empty:
+            print(f'No trades in {file_name}')
         else:
-            print(f'Found {trades_day_file_name}')
+            df = df.drop_duplicates(subset='tradeID').sort_values(by=['date', 'tradeID'])
+
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        df.to_csv(f'{file_name}.tmp', index=False, compression='gzip')
+        os.replace(f'{file_name}.tmp', file_name)
+        print(f'Saved {df.shape[0]} trades in {file_name}')
+
+    async def run_async(self, pairs, start_date, end_date):
+        self.limiter = RateLimiter(self.rate, max(1, int(self.rate)))
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        start = calendar.timegm(datetime.strptime(start_date, '%Y-%m-%d').timetuple())
+        end = calendar.timegm(datetime.strptime(end_date, '%Y-%m-%d').timetuple())
+
+        with futures.ThreadPoolExecutor(max_workers=self.concurrency) as self.executor:
+            if pairs is None:
+                pairs = list(await self.request({'command': 'returnTicker'}))
+            await asyncio.gather(*[self.fetch_day(pair, day) for pair in pairs for day in range(start, end, DAY_SECONDS)])
+
+    def run(self, pairs, start_date, end_date):
+        '''
+        Function to backfill trades of pairs from start_date (included) to end_date (excluded)
+
+        Arguments:
+        pairs -- list of strings, None for all pairs of returnTicker
+        start_date, end_date -- strings, '%Y-%m-%d'
+
+        Returns: dictionary {(pair, day): error} of days that failed, to be fetched again by a later run
+        '''
+
+        started = time.perf_counter()
+        asyncio.run(self.run_async(pairs, start_date, end_date))
+        print(f'{self.requests} requests ({self.splits} split windows) in {time.perf_counter() - started:.1f}s - {len(self.failed)} days failed')
+        return self.failed
+
+
+class MockPoloniexServer:
+    '''
+    Local stand-in for the Poloniex public API (returnTicker, returnTradeHistory), serving the trades passed to it
+    with the same TRADE_LIMIT cap (most recent trades first), so the backfill can be tested offline:
+        with MockPoloniexServer({'USDT_BTC': trades}) as server:
+            TradeBackfill(folder, base_url=server.url, rate=1000).run(None, '2021-01-01', '2021-01-02')
+
+    trades -- dictionary {pair: list of trade dictionaries with 'date' ('%Y-%m-%d %H:%M:%S') and 'tradeID'}
+    fail_every -- integer, every fail_every-th request returns a 500 error (to test retries), 0 to disable
+    '''
+
+    def __init__(self, trades, fail_every=0):
+        self.trades = {pair: sorted(pair_trades, key=lambda trade: trade['date'], reverse=True) for pair, pair_trades in trades.items()}
+        self.fail_every = fail_every
+        self.requests = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/public'
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                mock.requests += 1
+                params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                if mock.fail_every and mock.requests % mock.fail_every == 0:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+
+                if params.get('command') == 'returnTicker':
+                    body = {pair: {} for pair in mock.trades}
+                else:
+                    start = datetime.utcfromtimestamp(int(params['start'])).strftime('%Y-%m-%d %H:%M:%S')
+                    end = datetime.utcfromtimestamp(int(params['end'])).strftime('%Y-%m-%d %H:%M:%S')
+                    body = [trade for trade in mock.trades.get(params['currencyPair'], []) if start <= trade['date'] <= end][:TRADE_LIMIT]
+
+                content = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill Poloniex trade history')
+    parser.add_argument('start_date', help='first day, %%Y-%%m-%%d')
+    parser.add_argument('end_date', help='last day (excluded), %%Y-%%m-%%d')
+    parser.add_argument('--pairs', nargs='*', default=None, help='pairs to fetch, all pairs of returnTicker if not set')
+    parser.add_argument('--output', default=os.path.join(os.getcwd(), 'trades'), help='output folder')
+    parser.add_argument('--rate', type=float, default=6, help='requests per second')
+    parser.add_argument('--concurrency', type=int, default=8, help='pair days fetched at the same time')
+    parser.add_argument('--base-url', default=BASE_URL)
+    args = parser.parse_args()
+
+    failed = TradeBackfill(args.output, args.base_url, args.rate, args.concurrency).run(args.pairs, args.start_date, args.end_date)
+    sys.exit(1 if failed else 0)
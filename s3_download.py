@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+from concurrent import futures
+
+# Downloads of raw S3 objects (LOB snapshot files, trade files) with bounded concurrency, retries and verification:
+#   objects = list(bucket.objects.filter(Prefix=f'{pair}/{day_folder}'))
+#   stats = download_objects(bucket, objects, f'{raw_data_folder}/tmp')
+#   print(stats.summary())
+# Each object is downloaded to {destination}/{key}.part, checked against the size and ETag of the listing and moved
+# in place, so an existing file is always complete. Files already downloaded are skipped: re-running an interrupted
+# day only fetches the missing files. DownloadError is raised if any object still fails after the retries.
+#
+# LocalS3Resource is a filesystem stand-in for the boto3 S3 resource (see get_s3_resource), buckets are folders:
+#   [other]
+#   s3_stand_in = /path/to/folder   ->   /path/to/folder/{bucket}/{key}
+
+
+class DownloadError(Exception):
+    ''' Raised when some objects could not be downloaded, after retries '''
+
+    def __init__(self, failed):
+        self.failed = failed
+        super().__init__(f'{len(failed)} objects failed: {", ".join(sorted(failed)[:5])}{"..." if len(failed) > 5 else ""}')
+
+
+class DownloadStats:
+    ''' Counters of a download run '''
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.retries = 0
+        self.failed = {} # key: last error
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def throughput(self):
+        ''' Downloaded MB per second '''
+        return self.bytes / 1024 ** 2 / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        return (f'Downloaded {self.files} files ({self.bytes / 1024 ** 2:.1f} MB, {self.throughput():.1f} MB/s) in {self.elapsed:.1f}s - '
+                f'{self.skipped} already downloaded, {self.retries} retries, {len(self.failed)} failed')
+
+
+def object_etag(obj):
+    ''' ETag of a listed object without quotes, None if not available '''
+
+    e_tag = getattr(obj, 'e_tag', None)
+    return e_tag.strip('"') if e_tag else None
+
+
+def file_md5(path, chunk_size=1024 ** 2):
+    file_hash = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def is_complete(path, size, e_tag):
+    '''
+    True if path has the size of the object and, for single part uploads, the md5 of its ETag.
+    Multipart ETags ("<hash>-<parts>") are not a content md5, only the size is checked
+    '''
+
+    if not os.path.isfile(path) or os.path.getsize(path) != size:
+        return False
+    if e_tag and '-' not in e_tag:
+        return file_md5(path) == e_tag
+    return True
+
+
+def fetch_object(bucket, key, size, e_tag, path):
+    ''' Blocking download of one object to a temporary file, verified and moved to path '''
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.part'
+    bucket.download_file(key, tmp_path)
+
+    if not is_complete(tmp_path, size, e_tag):
+        os.remove(tmp_path)
+        raise IOError(f'Size or ETag mismatch for {key}')
+    os.replace(tmp_path, path)
+
+
+async def download_object(bucket, obj, destination, semaphore, executor, stats, retries, backoff):
+    ''' Download one object with retries and exponential backoff (with jitter). Failures are recorded in stats '''
+
+    path = os.path.join(destination, obj.key)
+    e_tag = object_etag(obj)
+    loop = asyncio.get_running_loop()
+
+    async with semaphore:
+        if await loop.run_in_executor(executor, is_complete, path, obj.size, e_tag):
+            stats.skipped += 1
+            return
+
+        for attempt in range(retries + 1):
+            try:
+                await loop.run_in_executor(executor, fetch_object, bucket, obj.key, obj.size, e_tag, path)
+                stats.files += 1
+                stats.bytes += obj.size
+                return
+            except Exception as e:
+                if attempt == retries:
+                    stats.failed[obj.key] = repr(e)
+                    print(f'Failed downloading {obj.key}: {e!r}')
+                    return
+                stats.retries += 1
+                await asyncio.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+async def download_objects_async(bucket, objects, destination, concurrency=32, retries=3, backoff=0.5):
+    ''' Coroutine version of download_objects '''
+
+    stats = DownloadStats()
+    semaphore = asyncio.Semaphore(concurrency)
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*[download_object(bucket, obj, destination, semaphore, executor, stats, retries, backoff) for obj in objects])
+    stats.elapsed = time.perf_counter() - stats.started
+    return stats
+
+
+def download_objects(bucket, objects, destination, concurrency=32, retries=3, backoff=0.5):
+    '''
+    Function to download a list of S3 objects to destination/{key}, skipping the ones already downloaded
+
+    Arguments:
+    bucket -- boto3 Bucket (or LocalBucket)
+    objects -- list of object summaries, as returned by bucket.objects.filter (key, size and e_tag attributes)
+    destination -- string, local folder
+    concurrency -- integer, maximum number of downloads in flight
+    retries -- integer, attempts after the first failure of each object
+    backoff -- float, seconds before the first retry, doubled at each attempt
+
+    Returns: DownloadStats, raises DownloadError if some objects failed
+    '''
+
+    coroutine = download_objects_async(bucket, objects, destination, concurrency, retries, backoff)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        stats = asyncio.run(coroutine)
+    else: # called from a running event loop (e.g. a notebook), run in a separate thread
+        with futures.ThreadPoolExecutor(max_workers=1) as executor:
+            stats = executor.submit(asyncio.run, coroutine).result()
+
+    print(stats.summary())
+    if stats.failed:
+        raise DownloadError(stats.failed)
+    return stats
+
+
+class LocalObjectSummary:
+    ''' Stand-in for a boto3 ObjectSummary '''
+
+    def __init__(self, bucket_name, key, size, e_tag):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = size
+        self.e_tag = e_tag
+
+
+class LocalObjects:
+    ''' Stand-in for the objects collection of a boto3 Bucket '''
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def filter(self, Prefix=''):
+        for root, _, file_names in os.walk(self.bucket.path):
+            for file_name in sorted(file_names):
+                key = os.path.relpath(os.path.join(root, file_name), self.bucket.path).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    path = os.path.join(self.bucket.path, key)
+                    yield LocalObjectSummary(self.bucket.name, key, os.path.getsize(path), f'"{file_md5(path)}"')
+
+    def all(self):
+        return self.filter()
+
+
+class LocalBucket:
+    '''
+    Stand-in for a boto3 Bucket backed by a folder.
+    transient_failures -- dictionary {key: n}, download_file raises for the first n attempts of key (to test retries)
+    '''
+
+    def __init__(self, path, name, transient_failures=None):
+        self.path = path
+        self.name = name
+        self.objects = LocalObjects(self)
+        self.transient_failures = dict(transient_failures or {})
+
+    def download_file(self, key, filename):
+        if self.transient_failures.get(key, 0) > 0:
+            self.transient_failures[key] -= 1
+            raise ConnectionError(f'Simulated failure for {key}')
+        shutil.copyfile(os.path.join(self.path, key), filename)
+
+
+class LocalS3Resource:
+    ''' Stand-in for the boto3 S3 resource, buckets are subfolders of root '''
+
+    def __init__(self, root, transient_failures=None):
+        self.root = root
+        self.transient_failures = transient_failures
+
+    def Bucket(self, name):
+        return LocalBucket(os.path.join(self.root, name), name, self.transient_failures)
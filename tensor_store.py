@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import log
+
+# Memory-mapped store for model-ready LOB arrays. A store is a folder with a small JSON header
+# and one .npy file per array:
+#   header.json       -- shapes, dtypes, column names and the parameters used to build the arrays
+#   depth.npy         -- (timesteps, levels * 4) standardized depth, as returned by reshape_lob_levels: one block of
+#                        4 columns per Level in ascending order, the trade rows (Level -1) first
+#   datetime.npy      -- (timesteps, ) int64 nanoseconds, depth datetime index
+#   top_ob.npy        -- (top_ob timesteps, n columns) top of the order book, not standardized
+#   top_ob_datetime.npy
+
+TOP_OB_COLUMNS = ['Ask_Price', 'Ask_Size', 'Bid_Price', 'Bid_Size', 'Mid_Price', 'Spread']
+
+class TensorStore:
+    '''
+    Read only view of a tensor store. Arrays are memory-mapped, so opening a store is instantaneous
+    and only the slices accessed (e.g. by a batch generator) are paged in from disk
+
+    Attributes:
+    depth -- np.memmap (timesteps, levels * 4)
+    dt_index -- pandas DatetimeIndex of depth rows
+    top_ob -- pandas dataframe with a datetime index, columns in TOP_OB_COLUMNS (memory-mapped values)
+    header -- dictionary, content of header.json
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+
+        with open(f'{folder}/header.json', 'r') as f:
+            self.header = json.load(f)
+
+        self.depth = np.load(f'{folder}/{self.header["depth"]["file"]}', mmap_mode='r')
+        self.dt_index = pd.DatetimeIndex(np.load(f'{folder}/{self.header["datetime"]["file"]}'))
+        self.top_ob = pd.DataFrame(np.load(f'{folder}/{self.header["top_ob"]["file"]}', mmap_mode='r'),
+                                   columns=self.header['top_ob']['columns'],
+                                   index=pd.DatetimeIndex(np.load(f'{folder}/{self.header["top_ob_datetime"]["file"]}'), name='Datetime'),
+                                   copy=False)
+
+    @property
+    def levels(self):
+        ''' Level of each 4 column block of depth. Stores written without it hold the trade level followed by the book levels '''
+        return self.header['depth'].get('levels', [-1] + list(range(self.depth.shape[1] // 4 - 1)))
+
+    @property
+    def mid_px(self):
+        ''' Standardized mid price, (ask + bid) / 2 of the top of the book (Level 0 block) '''
+        first = 4 * self.levels.index(0)
+        return pd.Series((self.depth[:, first] + self.depth[:, first + 2]) / 2, index=self.dt_index)
+
+
+def tensor_store_exists(folder):
+    ''' The header is written last, a store without header is incomplete '''
+    return os.path.isfile(f'{folder}/header.json')
+
+
+def write_tensor_store(folder, depth_values, dt_index, top_ob, parameters=None, levels=None):
+    '''
+    Function to save model-ready arrays to a tensor store. Files are written to a temporary folder
+    first and moved in place at the end, so an interrupted write never leaves a partial store
+
+    Arguments:
+    folder -- string, store folder
+    depth_values -- np.array (timesteps, levels * 4), as returned by reshape_lob_levels(output_type='array')
+    dt_index -- datetime index of depth_values
+    top_ob -- pandas dataframe with Datetime and TOP_OB_COLUMNS columns (e.g. top_ob_train from import_px_data)
+    parameters -- dictionary, saved in the header for reference (pair, frequency, roll...)
+    levels -- list of integers, Level of each 4 column block of depth_values (e.g. [-1, 0, 1, ...])
+
+    Returns: TensorStore
+    '''
+
+    tmp_folder = f'{folder}.tmp'
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+
+    depth_values = np.ascontiguousarray(depth_values)
+    np.save(f'{tmp_folder}/depth.npy', depth_values)
+    np.save(f'{tmp_folder}/datetime.npy', pd.DatetimeIndex(dt_index).values.astype('datetime64[ns]'))
+
+    top_ob_values = np.ascontiguousarray(top_ob[TOP_OB_COLUMNS].values, dtype='float64')
+    np.save(f'{tmp_folder}/top_ob.npy', top_ob_values)
+    np.save(f'{tmp_folder}/top_ob_datetime.npy', pd.to_datetime(top_ob['Datetime']).values.astype('datetime64[ns]'))
+
+    header = {
+        'version': 1,
+        'created': datetime.now().isoformat(),
+        'depth': {'file': 'depth.npy', 'shape': list(depth_values.shape), 'dtype': str(depth_values.dtype),
+                  'levels': [int(level) for level in levels] if levels is not None else [-1] + list(range(depth_values.shape[1] // 4 - 1))},
+        'datetime': {'file': 'datetime.npy', 'shape': [len(dt_index)], 'dtype': 'datetime64[ns]'},
+        'top_ob': {'file': 'top_ob.npy', 'shape': list(top_ob_values.shape), 'dtype': 'float64', 'columns': TOP_OB_COLUMNS},
+        'top_ob_datetime': {'file': 'top_ob_datetime.npy', 'shape': [top_ob_values.shape[0]], 'dtype': 'datetime64[ns]'},
+        'parameters': parameters if parameters is not None else {}
+    }
+
+    with open(f'{tmp_folder}/header.json', 'w') as f:
+        json.dump(header, f, indent=2, default=str)
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp_folder, folder)
+    log(f'Saved tensor store {folder} - depth shape {depth_values.shape}')
+
+    return TensorStore(folder)
+
+
+def open_tensor_store(folder):
+    '''
+    Function to open an existing tensor store
+
+    Returns: TensorStore
+    '''
+
+    assert tensor_store_exists(folder), f'No tensor store found in {folder}'
+    return TensorStore(folder)
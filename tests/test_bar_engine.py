@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+
+from bar_engine import join_lob, band_ends
+
+
+def resampled_lob(start, periods, frequency):
+    ''' Level 0 snapshots labelled with the start of their bin, as written by get_lob_data '''
+
+    times = pd.date_range(start, periods=periods, freq=frequency)
+    return pd.DataFrame({
+        'Datetime': times,
+        'Level': np.zeros(periods, dtype=np.int8),
+        'Ask_Price': np.arange(periods, dtype=np.float64) + 101,
+        'Ask_Size': np.ones(periods, dtype=np.float32),
+        'Bid_Price': np.arange(periods, dtype=np.float64) + 100,
+        'Bid_Size': np.ones(periods, dtype=np.float32),
+    })
+
+
+def test_join_lob_no_snapshot_after_bar_close():
+    frequency = timedelta(seconds=10)
+    lob = resampled_lob('2021-01-01', 30, frequency)
+    closes = pd.to_datetime('2021-01-01') + pd.to_timedelta(np.arange(0, 300, 3.7), unit='s')
+    bars = pd.DataFrame({'Datetime': closes.values})
+
+    joined = join_lob(bars, lob, 1, frequency)
+    matched = joined['LOB_Datetime'].notna()
+
+    # the bar closing inside the first bin has no snapshot known yet
+    assert not matched.iloc[0]
+    assert (joined.loc[matched, 'LOB_Datetime'] <= joined.loc[matched, 'Datetime']).all()
+    assert (joined.loc[matched, 'LOB_Age'] >= 0).all()
+    # joined to the last bin ending at or before the close
+    bin_start = joined.loc[matched, 'LOB_Datetime'] - pd.Timedelta(frequency)
+    expected = ((joined.loc[matched, 'Datetime'] - pd.Timestamp('2021-01-01')) // pd.Timedelta(frequency)) - 1
+    assert (((bin_start - pd.Timestamp('2021-01-01')) // pd.Timedelta(frequency)) == expected).all()
+    assert (joined.loc[matched, 'Bid_Price_0'].values == 100 + expected.values).all()
+
+
+def test_join_lob_original_frequency():
+    lob = resampled_lob('2021-01-01', 5, timedelta(seconds=10))
+    bars = pd.DataFrame({'Datetime': pd.to_datetime(['2021-01-01 00:00:00', '2021-01-01 00:00:15'])})
+
+    joined = join_lob(bars, lob, 1)
+
+    assert list(joined['LOB_Datetime']) == list(pd.to_datetime(['2021-01-01 00:00:00', '2021-01-01 00:00:10']))
+    assert list(joined['LOB_Age']) == [0.0, 5.0]
+
+
+def test_band_ends_oscillating_imbalance():
+    # signed volume chattering around 1, then reaching 2 and falling back to 1 and 0
+    cumulative = np.array([0.5, 1.1, 0.9, 1.2, 0.8, 1.05, 0.95, 2.0, 1.5, 1.0, 0.4, 0.0, -0.9, -1.0])
+
+    # the first crossing of 1 closes a bar, the oscillations around it don't
+    assert list(band_ends(cumulative, 1.0)) == [1, 7, 9, 11, 13]
+
+
+def test_band_ends_trade_crossing_several_multiples():
+    cumulative = np.array([0.5, 3.2, 2.5, 1.9, 4.0])
+
+    # closes at 3 (one bar), down to 2 (not reached at 2.5), then up to 4
+    assert list(band_ends(cumulative, 1.0)) == [1, 3, 4]
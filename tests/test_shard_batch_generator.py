@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_preprocessing import ShardBatchGenerator
+
+
+def series(rows=1000, features=8, seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.normal(size=(rows, features)).astype(np.float32)
+    targets = rng.integers(0, 3, size=rows)
+    dt_index = pd.date_range('2021-01-01 20:00', periods=rows, freq='1min') # shards are days, several of them
+    return data, targets, dt_index
+
+
+def test_batches_by_index_match_timeseries_windows():
+    data, targets, dt_index = series()
+    length, batch_size = 50, 64
+    generator = ShardBatchGenerator(data, targets, length, batch_size, dt_index=dt_index)
+
+    target_indices = np.arange(length, data.shape[0])
+    for index in reversed(range(len(generator))): # any order
+        x, y = generator.batch(index)
+        batch = target_indices[index * batch_size:(index + 1) * batch_size]
+        assert np.array_equal(x, np.stack([data[i - length:i] for i in batch]))
+        assert np.array_equal(y, targets[batch])
+
+    with pytest.raises(IndexError):
+        generator.batch(len(generator))
+
+    # the unshuffled stream serves the same batches
+    for index, (x, y) in enumerate(generator):
+        assert np.array_equal(x, generator.batch(index)[0]) and np.array_equal(y, generator.batch(index)[1])
+
+
+def test_predict_order_matches_timeseries_generator():
+    tf = pytest.importorskip('tensorflow')
+    sequence = pytest.importorskip('tensorflow.keras.preprocessing.sequence')
+
+    data, targets, dt_index = series()
+    length, batch_size = 50, 64
+    reference = sequence.TimeseriesGenerator(data, targets, length=length, batch_size=batch_size)
+    generator = ShardBatchGenerator(data, targets, length, batch_size, dt_index=dt_index)
+
+    model = tf.keras.Sequential([tf.keras.Input(shape=(length, data.shape[1])), tf.keras.layers.Flatten(), tf.keras.layers.Dense(3)])
+    assert len(generator.keras_sequence()) == len(reference)
+    np.testing.assert_allclose(model.predict(generator.keras_sequence(), verbose=0), model.predict(reference, verbose=0), rtol=1e-6)
+
+
+def test_shuffled_batches_are_not_a_sequence():
+    data, targets, dt_index = series()
+    generator = ShardBatchGenerator(data, targets, 50, 64, shuffle=True, dt_index=dt_index, seed=0)
+
+    with pytest.raises(ValueError):
+        generator.keras_sequence()
+    # the shuffled stream still covers every window once per epoch
+    assert sorted(np.concatenate([y for _, y in generator])) == sorted(targets[50:])
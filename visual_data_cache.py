@@ -0,0 +1,109 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from frame_schema import apply_schema, csv_dtypes
+
+# Process level data layer for the order_book_visual callbacks. Each security file is read once, typed and
+# sorted by Datetime, then kept in memory (least recently used securities are evicted). Date ranges are sliced
+# by binary search on the sorted timestamps instead of comparing strings on every row, and normalization
+# results are memoized on (security, columns, levels, window, range):
+#   cache = VisualDataCache(root_caching_folder)
+#   data = cache.slice('USDT_BTC', start_date, end_date)
+#   norm_px = cache.normalized('USDT_BTC', start_date, end_date, ['Ask_Price', 'Bid_Price'], ob_levels, window, ft.normalize)
+
+
+class SecurityData:
+    ''' One security file in memory, sorted by Datetime and Level with typed columns '''
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+
+        data = apply_schema(pd.read_csv(path, index_col=0, parse_dates=['Datetime'], dtype=csv_dtypes()))
+        self.data = data.sort_values(by=['Datetime', 'Level'], kind='mergesort').reset_index(drop=True)
+        self.datetimes = self.data['Datetime'].values
+
+    def slice(self, start_date, end_date):
+        ''' Rows with start_date <= Datetime <= end_date, found by binary search '''
+
+        start = np.searchsorted(self.datetimes, np.datetime64(pd.Timestamp(start_date)), side='left')
+        end = np.searchsorted(self.datetimes, np.datetime64(pd.Timestamp(end_date)), side='right')
+        return self.data.iloc[start:end]
+
+
+class VisualDataCache:
+    '''
+    In memory store of security files and normalization results, shared by all callbacks of the process
+
+    Arguments:
+    root_caching_folder -- string, folder with a {security}/{file_name} file per security
+    file_name -- string, security file name
+    max_securities -- integer, securities kept in memory
+    max_results -- integer, normalization results kept in memory
+    '''
+
+    def __init__(self, root_caching_folder, file_name='data-cache-1m.csv', max_securities=4, max_results=32):
+        self.root_caching_folder = root_caching_folder
+        self.file_name = file_name
+        self.max_securities = max_securities
+        self.max_results = max_results
+        self.securities = OrderedDict()
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def security(self, security):
+        ''' SecurityData of a security, read again if the file changed since it was loaded '''
+
+        path = f'{self.root_caching_folder}/{security}/{self.file_name}'
+        with self.lock:
+            security_data = self.securities.get(security)
+            if security_data is not None and security_data.mtime == os.path.getmtime(path):
+                self.securities.move_to_end(security)
+                return security_data
+
+        print(f'Loading {path}')
+        security_data = SecurityData(path)
+
+        with self.lock:
+            self.securities[security] = security_data
+            self.securities.move_to_end(security)
+            while len(self.securities) > self.max_securities:
+                evicted, _ = self.securities.popitem(last=False)
+                self.results = OrderedDict((key, value) for key, value in self.results.items() if key[0] != evicted)
+            # results of a previous version of the file are stale
+            self.results = OrderedDict((key, value) for key, value in self.results.items() if key[0] != security or key[1] == security_data.mtime)
+
+        return security_data
+
+    def slice(self, security, start_date, end_date):
+        ''' Rows of a security between start_date and end_date (included) '''
+
+        return self.security(security).slice(start_date, end_date)
+
+    def normalized(self, security, start_date, end_date, columns, ob_levels, window, normalize_function, norm_type='dyn_z_score'):
+        '''
+        Memoized normalize_function(data[columns], ob_levels=ob_levels, norm_type=norm_type, roll=window) on the
+        date range, with data indexed by Datetime and Level. The result is shared, callers must not modify it
+        '''
+
+        security_data = self.security(security)
+        key = (security, security_data.mtime, tuple(columns), ob_levels, window, norm_type, str(start_date), str(end_date))
+
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key]
+
+        data = security_data.slice(start_date, end_date).set_index(['Datetime', 'Level'])
+        result = normalize_function(data[list(columns)], ob_levels=ob_levels, norm_type=norm_type, roll=window)
+
+        with self.lock:
+            self.results[key] = result
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+
+        return result
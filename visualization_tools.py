@@ -5,12 +5,17 @@ import plotly.figure_factory as ff
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-# Px timeseries
-def plot_timeseries(ts_list=[], primary_axis=[], legend=[], sample_size=360, width=900, height=500):
-    '''Plot nth datapoints for the provided timeseries
+from downsampling import chart_points, downsample_series, zoomable_figure
 
-    sample_size: integer. If input data is at 10s intervals, 30 would results in one datapoint
-        plotted every 5 minutes, 360 every hour and 8640 every day
+# Px timeseries
+def plot_timeseries(ts_list=[], primary_axis=[], legend=[], sample_size=None, width=900, height=500, method='lttb', zoom=False):
+    '''Plot the provided timeseries, downsampled preserving their shape (see downsampling.py)
+
+    sample_size: integer, plot about one datapoint every sample_size. If input data is at 10s intervals, 30 would
+        results in one datapoint every 5 minutes, 360 every hour and 8640 every day. If not specified, the number of
+        datapoints follows the chart width
+    method: string, downsampling method, 'lttb' or 'minmax'
+    zoom: boolean, return a FigureWidget downsampling again the visible range on zoom, instead of showing the chart
     ts_list, px_test: list of pandas timeseries with a datetime index
     primary_axis: list with boolean specifying whether a timeseries will be plotted on the primary axis or not
         If not specified, all timeseries will be plotted on primary axis
@@ -35,37 +40,47 @@ def plot_timeseries(ts_list=[], primary_axis=[], legend=[], sample_size=360, wid
     for ts, ax, leg in zip(ts_list, primary_axis, legend):
         #print(isinstance(ts.index, pd.DatetimeIndex))
         assert isinstance(ts.index, pd.DatetimeIndex), "px series must have a datetime index"
-        sampled_ts = ts.iloc[::sample_size]
+        n_out = chart_points(width) if sample_size is None else int(np.ceil(ts.shape[0] / sample_size))
+        sampled_ts = downsample_series(ts, n_out, method)
         ts_plot.add_trace(go.Scatter(y=sampled_ts.values, x=sampled_ts.index, name=leg), secondary_y=not ax) # toggle bool with *-1
 
     ts_plot.update_yaxes(fixedrange= True, secondary_y=True)
 
     ts_plot.update_layout(title='<b>Sampled mid</b>', showlegend=show_legend, width=width, height=height)
+    if zoom:
+        return zoomable_figure(ts_plot, ts_list, chart_points(width), method)
     ts_plot.show()
 
 
 # Labels
-def plot_labels_line(px_ts, labels, title='Labels', width=900, height=500, **kwargs):
+def plot_labels_line(px_ts, labels, title='Labels', width=900, height=500, zoom=False, **kwargs):
     '''Plot labels against price.
     Takes two pandas timeseries as inputs. These need to be subsets of the same
-    DataFrame or have same length
+    DataFrame or have same length. Prices are downsampled with LTTB and labels with min/max buckets,
+    to about 2 points per pixel (see downsampling.py). With zoom=True a FigureWidget downsampling again
+    the visible range on zoom is returned
     '''
     #print(kwargs)
     # check index
     condition = (px_ts.index == labels.index).sum()
     assert condition == px_ts.shape[0] == labels.shape[0], 'px_ts and labels must have the same index to be correctly plotted'
 
+    n_out = chart_points(width)
     fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.add_trace(go.Scatter(y=px_ts, x=px_ts.index, name='Price'), secondary_y=False)
-    fig.add_trace(go.Scatter(y=labels, x=labels.index, name='Labels', marker=dict(color='rgba(240, 52, 52, 0.3)')), 
+    sampled_px = downsample_series(px_ts, n_out, 'lttb')
+    fig.add_trace(go.Scatter(y=sampled_px, x=sampled_px.index, name='Price'), secondary_y=False)
+    sampled_labels = downsample_series(labels, n_out, 'minmax')
+    fig.add_trace(go.Scatter(y=sampled_labels, x=sampled_labels.index, name='Labels', marker=dict(color='rgba(240, 52, 52, 0.3)')), 
         secondary_y=True)
 
 
     for arg, key in zip(kwargs.values(), kwargs.keys()):
         if 'label' in key or 'direction' in key:
-            fig.add_trace(go.Scatter(y=arg, x=arg.index, name=key), secondary_y=True)
+            sampled_arg = downsample_series(arg, n_out, 'minmax')
+            fig.add_trace(go.Scatter(y=sampled_arg, x=sampled_arg.index, name=key), secondary_y=True)
         else:
-            fig.add_trace(go.Scatter(y=arg, x=arg.index, name=key), secondary_y=False)
+            sampled_arg = downsample_series(arg, n_out, 'lttb')
+            fig.add_trace(go.Scatter(y=sampled_arg, x=sampled_arg.index, name=key), secondary_y=False)
 
     fig.update_layout(title=f'<b>{title}</b>', width=width, height=height)
     fig.update_yaxes(title_text='ccy', fixedrange= False, secondary_y=False)
@@ -79,6 +94,9 @@ def plot_labels_line(px_ts, labels, title='Labels', width=900, height=500, **kwa
         )
     )
 
+    if zoom:
+        methods = ['lttb', 'minmax'] + ['minmax' if 'label' in key or 'direction' in key else 'lttb' for key in kwargs.keys()]
+        return zoomable_figure(fig, [px_ts, labels] + list(kwargs.values()), n_out, methods)
     return fig.show()
 
 